@@ -0,0 +1,91 @@
+"""
+Compare the vertices per second of the array coordinate transforms in
+tilequeue.coords with the scalar callbacks they replaced.
+
+Run from the repository root with:
+
+    python -m tests.bench_coords
+
+Each transform is applied to the same shapes with map_coords and with
+shapely.ops.transform calling the scalar function for every vertex, as
+the lnglat projection, VTM rescale and GeoJSON precision trimming did
+before.
+"""
+
+from __future__ import print_function
+
+
+def _shapes(num_pairs):
+    from shapely.geometry import LineString
+    from shapely.geometry import Point
+    import random
+
+    rnd = random.Random(1)
+    # a mix of large polygons with holes and long lines, in mercator
+    # meters around a z10 tile.
+    shapes = []
+    for _ in range(num_pairs):
+        x = rnd.uniform(-13630000, -13590000)
+        y = rnd.uniform(4530000, 4570000)
+        outer = Point(x, y).buffer(rnd.uniform(1000, 10000), 500)
+        hole = Point(x, y).buffer(500, 100)
+        shapes.append(outer.difference(hole))
+        shapes.append(LineString(
+            [(x + rnd.uniform(-20000, 20000), y + rnd.uniform(-20000, 20000))
+             for _ in range(1000)]))
+    return shapes
+
+
+def _count_vertices(shapes):
+    from tilequeue.process import _count_vertices as count
+    return sum(count(shape) for shape in shapes)
+
+
+def _time(fn, repeat=5):
+    import timeit
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def _trim_precision(precision):
+    def trim_precision(x, y, z=None):
+        return round(x, precision), round(y, precision)
+    return trim_precision
+
+
+def main():
+    from shapely.ops import transform
+    from tilequeue import coords
+    from tilequeue.transform import mercator_point_to_lnglat
+    from tilequeue.transform import rescale_point
+
+    shapes = _shapes(100)
+    num_vertices = _count_vertices(shapes)
+    bounds = (-13630000.0, 4530000.0, -13590000.0, 4570000.0)
+    lnglat_shapes = [coords.map_coords(coords.mercator_to_lnglat, shape)
+                     for shape in shapes]
+
+    cases = [
+        ('mercator to lnglat', shapes,
+         mercator_point_to_lnglat, coords.mercator_to_lnglat),
+        ('rescale', shapes,
+         rescale_point(bounds, 4096), coords.make_rescale(bounds, 4096)),
+        ('trim precision', lnglat_shapes,
+         _trim_precision(8), coords.make_trim_precision(8)),
+    ]
+
+    print('%d vertices' % num_vertices)
+    print('%-20s %14s %14s %8s' % (
+        'transform', 'scalar v/s', 'array v/s', 'speedup'))
+    for name, case_shapes, scalar_fn, array_fn in cases:
+        scalar_time = _time(
+            lambda: [transform(scalar_fn, shape) for shape in case_shapes])
+        array_time = _time(
+            lambda: [coords.map_coords(array_fn, shape)
+                     for shape in case_shapes])
+        print('%-20s %14d %14d %7.1fx' % (
+            name, num_vertices / scalar_time, num_vertices / array_time,
+            scalar_time / array_time))
+
+
+if __name__ == '__main__':
+    main()
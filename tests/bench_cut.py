@@ -0,0 +1,112 @@
+"""
+Compare the flat and hierarchical cut strategies for formatting the child
+tiles of a metatile.
+
+Run from the repository root with:
+
+    python -m tests.bench_cut
+
+The metatile holds an ocean polygon with a long, wiggly coastline, the same
+coastline as a line, and some islands. These are the large shapes which
+the hierarchical strategy is meant for, as each child is clipped from its
+parent's already smaller features instead of the full geometry.
+"""
+
+from __future__ import print_function
+
+
+def _coastline(bounds, num_vertices, rnd):
+    # a random walk across the metatile from west to east, somewhere near
+    # the middle.
+    minx, miny, maxx, maxy = bounds
+    width = maxx - minx
+    height = maxy - miny
+    step = 2.0 * height / num_vertices
+    points = []
+    y = miny + 0.5 * height
+    for i in range(num_vertices):
+        x = minx - 0.1 * width + 1.2 * width * i / (num_vertices - 1)
+        y = min(max(y + rnd.uniform(-step, step), miny + 0.2 * height),
+                maxy - 0.2 * height)
+        points.append((x, y))
+    return points
+
+
+def _feature_layers(bounds, num_vertices):
+    from shapely.geometry import LineString
+    from shapely.geometry import Point
+    from shapely.geometry import Polygon
+    import random
+
+    rnd = random.Random(1)
+    minx, miny, maxx, maxy = bounds
+    width = maxx - minx
+    height = maxy - miny
+
+    coastline = _coastline(bounds, num_vertices, rnd)
+    # the ocean is everything south of the coastline, and past the edges
+    # of the metatile, as it would be in the query results.
+    ocean = Polygon(coastline + [
+        (maxx + 0.1 * width, miny - 0.1 * height),
+        (minx - 0.1 * width, miny - 0.1 * height)])
+    islands = []
+    for i in range(20):
+        center = Point(minx + rnd.uniform(0, width),
+                       miny + rnd.uniform(0, 0.3 * height))
+        island = center.buffer(rnd.uniform(0.005, 0.02) * width, 250)
+        islands.append(island)
+        ocean = ocean.difference(island)
+
+    def _layer(name, features):
+        return dict(
+            name=name,
+            layer_datum=dict(name=name, is_clipped=True, clip_factor=1.0),
+            features=features)
+
+    return [
+        _layer('water', [(ocean, dict(kind='ocean'), 1)]),
+        _layer('earth', [(shape, dict(kind='island'), 100 + i)
+                         for i, shape in enumerate(islands)]),
+        _layer('boundaries', [(LineString(coastline),
+                               dict(kind='coastline'), 2)]),
+    ]
+
+
+def _time(fn, repeat=3):
+    import timeit
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    from ModestMaps.Core import Coordinate
+    from tilequeue.format import mvt_format
+    from tilequeue.process import format_coord
+    from tilequeue.process import ProcessingPlan
+    from tilequeue.tile import coord_children_range
+    from tilequeue.tile import coord_to_mercator_bounds
+
+    coord = Coordinate(zoom=10, column=163, row=395)
+    bounds = coord_to_mercator_bounds(coord)
+    buffer_cfg = dict(mvt=dict(geometry=dict(line=8, polygon=8)))
+
+    print('%-10s %8s %8s %13s %13s %8s' % (
+        'vertices', 'to zoom', 'tiles', 'flat', 'hierarchical', 'speedup'))
+    for num_vertices in (10000, 50000):
+        feature_layers = _feature_layers(bounds, num_vertices)
+        for max_zoom in (12, 13):
+            cut_coords = [coord] + list(
+                coord_children_range(coord, max_zoom))
+            times = []
+            for cut_strategy in ('flat', 'hierarchical'):
+                plan = ProcessingPlan(
+                    None, (), buffer_cfg, {}, cut_strategy=cut_strategy)
+                times.append(_time(lambda: format_coord(
+                    coord, coord.zoom, feature_layers, [mvt_format],
+                    bounds, cut_coords, buffer_cfg, {}, 4096, plan)))
+            print('%-10d %8d %8d %12.3fs %12.3fs %7.1fx' % (
+                num_vertices, max_zoom, len(cut_coords), times[0], times[1],
+                times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
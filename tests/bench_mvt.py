@@ -0,0 +1,102 @@
+"""
+Compare the throughput of the native MVT encoder with mapbox_vector_tile.
+
+Run from the repository root with:
+
+    python -m tests.bench_mvt
+
+Each tile is encoded by both tilequeue.format.mvt.encode and encode_mapbox,
+and the best of several runs is reported. The tiles are built like the
+golden-output corpus in test_mvt, scaled up to the sizes of busy z14-z16
+tiles.
+"""
+
+from __future__ import print_function
+
+
+def _random_shapes_tile(rnd, num_features, num_vertices):
+    from shapely.geometry import LineString
+    from shapely.geometry import Polygon
+
+    features = []
+    for i in range(num_features):
+        coords = [(rnd.uniform(-100, 1100), rnd.uniform(-100, 1100))
+                  for _ in range(rnd.randint(3, num_vertices))]
+        features.append((LineString(coords), dict(n=i % 3), i))
+        # mostly self-intersecting, so these need repairing.
+        features.append((Polygon(coords), dict(n=i % 5), i))
+    return features
+
+
+def _large_shapes_tile(rnd):
+    from shapely.geometry import LineString
+    from shapely.geometry import Point
+
+    features = []
+    for i in range(20):
+        center = Point(rnd.uniform(0, 1000), rnd.uniform(0, 1000))
+        # 2000 segments a quarter circle gives 8000 vertices.
+        features.append((center.buffer(rnd.uniform(50, 400), 2000),
+                         dict(kind='water', area=i * 1000.0), i))
+    for i in range(50):
+        coords = [(rnd.uniform(0, 1000), rnd.uniform(0, 1000))
+                  for _ in range(500)]
+        features.append((LineString(coords),
+                         dict(kind='road', name=u'road %d' % i), 100 + i))
+    return features
+
+
+def _properties_tile(rnd):
+    from shapely.geometry import Point
+
+    features = []
+    for i in range(2000):
+        props = dict(kind=rnd.choice(['cafe', 'bar', 'shop']),
+                     name=u'poi %d' % i, min_zoom=rnd.randint(12, 16),
+                     area=rnd.random() * 1000, is_building=(i % 2 == 0))
+        features.append((Point(rnd.uniform(0, 1000), rnd.uniform(0, 1000)),
+                         props, i))
+    return features
+
+
+def _count_vertices(features):
+    from tilequeue.process import _count_vertices as count
+    return sum(count(shape) for shape, _, _ in features)
+
+
+def _time(fn, repeat):
+    import timeit
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    from StringIO import StringIO
+    from tilequeue.format.mvt import encode
+    from tilequeue.format.mvt import encode_mapbox
+    import random
+
+    rnd = random.Random(1)
+    bounds = (0.0, 0.0, 1000.0, 1000.0)
+    tiles = [
+        ('random shapes', _random_shapes_tile(rnd, 100, 30)),
+        ('large polygons and lines', _large_shapes_tile(rnd)),
+        ('points with properties', _properties_tile(rnd)),
+    ]
+
+    print('%-26s %10s %10s %10s %8s' % (
+        'tile', 'vertices', 'mapbox', 'native', 'speedup'))
+    for name, features in tiles:
+        feature_layers = [dict(name='layer', features=features)]
+
+        def _encode_with(encode_fn):
+            encode_fn(StringIO(), feature_layers, bounds, 4096)
+
+        mapbox_time = _time(lambda: _encode_with(encode_mapbox), 3)
+        native_time = _time(lambda: _encode_with(encode), 5)
+        print('%-26s %10d %9.3fs %9.3fs %7.1fx' % (
+            name, _count_vertices(features), mapbox_time, native_time,
+            mapbox_time / native_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Measure the per-tile overhead which building a ProcessingPlan once per
+worker saves.
+
+Run from the repository root with:
+
+    python -m tests.bench_plan
+
+Small tiles are processed with process_coord_no_format, where the plan is
+used, once building a new plan for each tile, which resolves the layers'
+dotted function names and the post-process steps as every tile used to,
+and once with a plan built up front, as ProcessAndFormatData does.
+Formatting is left out, as it doesn't depend on the plan and would only
+add noise.
+"""
+
+from __future__ import print_function
+
+
+def _add_kind(shape, props, fid, zoom):
+    props['kind'] = 'thing'
+    return shape, props, fid
+
+
+def _add_zoom(shape, props, fid, zoom):
+    props['zoom'] = zoom
+    return shape, props, fid
+
+
+def _sort_by_id(features, zoom):
+    return sorted(features, key=lambda f: f[2])
+
+
+def _noop_step(ctx):
+    return None
+
+
+def _layers(coord, num_layers, num_features):
+    from shapely.geometry import Point
+    from tilequeue.tile import coord_to_mercator_bounds
+
+    layer_data = []
+    feature_layers = []
+    for i in range(num_layers):
+        layer_datum = dict(
+            name='layer%d' % i,
+            geometry_types=['Point'],
+            transform_fn_names=['tests.bench_plan._add_kind',
+                                'tests.bench_plan._add_zoom'],
+            sort_fn_name='tests.bench_plan._sort_by_id',
+            is_clipped=False,
+        )
+        layer_data.append(layer_datum)
+        features = []
+        for fid in range(num_features):
+            features.append(dict(
+                __id__=fid,
+                __geometry__=Point(-13600000 + fid, 4550000).wkb,
+                __properties__=dict(name='feature %d' % fid),
+            ))
+        feature_layers.append(dict(
+            layer_datum=layer_datum,
+            padded_bounds=dict(point=coord_to_mercator_bounds(coord)),
+            features=features))
+    return layer_data, feature_layers
+
+
+def _fresh(feature_layers):
+    # processing pops the geometry and id from each row, so every run
+    # needs its own copy.
+    return [dict(feature_layer,
+                 features=[dict(row) for row in feature_layer['features']])
+            for feature_layer in feature_layers]
+
+
+def _output_fn(shape, props, fid, meta):
+    return dict(props, min_zoom=0)
+
+
+def _time(fn, number, repeat=5):
+    import timeit
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main():
+    from ModestMaps.Core import Coordinate
+    from tilequeue.process import process_coord_no_format
+    from tilequeue.process import ProcessingPlan
+    from tilequeue.tile import coord_to_mercator_bounds
+
+    coord = Coordinate(zoom=14, column=2620, row=6330)
+    bounds = coord_to_mercator_bounds(coord)
+    post_process_data = [
+        dict(fn_name='tests.bench_plan._noop_step', params={},
+             resources={})
+        for _ in range(10)]
+    buffer_cfg = dict(json=dict(geometry=dict(point=8)))
+
+    print('%-8s %-9s %14s %14s %14s' % (
+        'layers', 'features', 'new plan', 'shared plan', 'saved'))
+    for num_layers, num_features in ((10, 1), (10, 10), (30, 10)):
+        layer_data, feature_layers = _layers(
+            coord, num_layers, num_features)
+        output_calc_mapping = dict(
+            (layer_datum['name'], _output_fn) for layer_datum in layer_data)
+        shared_plan = ProcessingPlan(
+            layer_data, post_process_data, buffer_cfg, output_calc_mapping)
+
+        def _process(plan):
+            if plan is None:
+                plan = ProcessingPlan(
+                    None, post_process_data, buffer_cfg,
+                    output_calc_mapping)
+            process_coord_no_format(
+                _fresh(feature_layers), coord.zoom, bounds,
+                post_process_data, output_calc_mapping, plan)
+
+        new_time = _time(lambda: _process(None), 500)
+        shared_time = _time(lambda: _process(shared_plan), 500)
+        print('%-8d %-9d %12.1fus %12.1fus %12.1fus' % (
+            num_layers, num_features, new_time * 1e6, shared_time * 1e6,
+            (new_time - shared_time) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
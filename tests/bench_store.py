@@ -0,0 +1,96 @@
+"""
+Compare writing and reading tiles with TileDirectory and with MBTiles, with
+and without dedupe.
+
+Run from the repository root with:
+
+    python -m tests.bench_store
+
+Each store writes the same tiles, 10-14kB each, into a fresh temporary
+directory, including flushing any pending writes, and then reads them all
+back. Some of the tiles are identical, as ocean and empty land tiles are,
+which is what dedupe saves. The disk usage of the MBTiles stores includes
+SQLite's write-ahead log, which hasn't been checkpointed yet.
+"""
+
+from __future__ import print_function
+
+
+def _tiles(num_tiles, repeated_fraction, rnd):
+    from ModestMaps.Core import Coordinate
+    import os
+
+    size = 256
+    common = [os.urandom(rnd.randint(10000, 14000)) for _ in range(5)]
+    tiles = []
+    for i in range(num_tiles):
+        coord = Coordinate(zoom=14, column=2600 + i % size,
+                           row=6300 + i // size)
+        if rnd.random() < repeated_fraction:
+            tile_data = rnd.choice(common)
+        else:
+            tile_data = os.urandom(rnd.randint(10000, 14000))
+        tiles.append((coord, tile_data))
+    return tiles
+
+
+def _disk_usage(path):
+    import os
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(dir_path, file_name))
+    return total
+
+
+def _run(make_store, tiles):
+    from tilequeue.format import mvt_format
+    from tilequeue.store import flush_store
+    import shutil
+    import tempfile
+    import time
+
+    dir_path = tempfile.mkdtemp()
+    try:
+        store = make_store(dir_path)
+        start = time.time()
+        for coord, tile_data in tiles:
+            store.write_tile(tile_data, coord, mvt_format, 'all')
+        flush_store(store)
+        write_time = time.time() - start
+
+        start = time.time()
+        for coord, _ in tiles:
+            store.read_tile(coord, mvt_format, 'all')
+        read_time = time.time() - start
+
+        return write_time, read_time, _disk_usage(dir_path)
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def main():
+    from tilequeue.store import make_mbtiles_store
+    from tilequeue.store import make_tile_file_store
+    import random
+
+    stores = [
+        ('directory', make_tile_file_store),
+        ('mbtiles', lambda path: make_mbtiles_store(path, dedupe=False)),
+        ('mbtiles dedupe', lambda path: make_mbtiles_store(path)),
+    ]
+
+    print('%-10s %-16s %14s %14s %10s' % (
+        'repeated', 'store', 'write tiles/s', 'read tiles/s', 'disk'))
+    for repeated_fraction in (0.0, 0.5, 0.9):
+        tiles = _tiles(2000, repeated_fraction, random.Random(1))
+        for name, make_store in stores:
+            write_time, read_time, disk = _run(make_store, tiles)
+            print('%-10s %-16s %14d %14d %9dM' % (
+                '%d%%' % (repeated_fraction * 100), name,
+                len(tiles) / write_time, len(tiles) / read_time,
+                disk / (1024 * 1024)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Compare the output size and encode time of the TopoJSON formatter with the
+one it replaced, which emitted one arc for every line and ring.
+
+Run from the repository root with:
+
+    python -m tests.bench_topojson
+
+The tiles are a grid of adjacent polygons with wiggly shared edges, like
+landuse, and the same edges as lines, like administrative boundaries.
+"""
+
+from __future__ import print_function
+
+
+def _encode_unshared(file, features_by_layer, bounds, size=4096):
+    # the formatter before arcs were shared, for the lines and polygons the
+    # tiles here have.
+    from tilequeue.format.topojson import get_transform
+    import ujson as json
+
+    transform, forward = get_transform(bounds, size=size)
+    arcs = []
+
+    def _diff_encode(line):
+        coords = [forward(x, y) for (x, y) in line.coords]
+        pairs = zip(coords[:], coords[1:])
+        diffs = [(x2 - x1, y2 - y1) for ((x1, y1), (x2, y2)) in pairs]
+        return coords[:1] + [(x, y) for (x, y) in diffs if (x, y) != (0, 0)]
+
+    geometries_by_layer = {}
+    for layer, features in features_by_layer.iteritems():
+        geometries = []
+        for shape, props, fid in features:
+            geometry = dict(properties=props, id=fid)
+            if shape.type == 'LineString':
+                geometry.update(dict(type='LineString', arcs=[len(arcs)]))
+                arcs.append(_diff_encode(shape))
+            else:
+                assert shape.type == 'Polygon'
+                geometry.update(dict(type='Polygon', arcs=[]))
+                for ring in [shape.exterior] + list(shape.interiors):
+                    geometry['arcs'].append([len(arcs)])
+                    arcs.append(_diff_encode(ring))
+            geometries.append(geometry)
+        geometries_by_layer[layer] = dict(
+            type='GeometryCollection', geometries=geometries)
+
+    json.dump(dict(type='Topology', transform=transform,
+                   objects=geometries_by_layer, arcs=arcs), file)
+
+
+def _grid_edges(cells, segments, rnd):
+    # the wiggly edge between each pair of neighbouring grid corners, keyed
+    # by the corners, so that the cells either side of it share its points.
+    step = 1.0 / cells
+    jitter = 0.2 * step / segments
+    edges = {}
+    for i in range(cells + 1):
+        for j in range(cells + 1):
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di > cells or j + dj > cells:
+                    continue
+                points = [(i * step, j * step)]
+                for k in range(1, segments):
+                    t = float(k) / segments
+                    x = (i + di * t) * step
+                    y = (j + dj * t) * step
+                    # grid lines on the tile edge stay straight.
+                    if 0 < i < cells or dj == 0:
+                        x += rnd.uniform(-jitter, jitter)
+                    if 0 < j < cells or di == 0:
+                        y += rnd.uniform(-jitter, jitter)
+                    points.append((x, y))
+                points.append(((i + di) * step, (j + dj) * step))
+                edges[(i, j), (i + di, j + dj)] = points
+    return edges
+
+
+def _cell_ring(edges, i, j):
+    # counter-clockwise around the cell, reversing the edges which run the
+    # other way.
+    bottom = edges[(i, j), (i + 1, j)]
+    right = edges[(i + 1, j), (i + 1, j + 1)]
+    top = edges[(i, j + 1), (i + 1, j + 1)][::-1]
+    left = edges[(i, j), (i, j + 1)][::-1]
+    return bottom[:-1] + right[:-1] + top[:-1] + left
+
+
+def _tiles(cells=20, segments=40):
+    from shapely.geometry import LineString
+    from shapely.geometry import Polygon
+    import random
+
+    edges = _grid_edges(cells, segments, random.Random(1))
+    landuse = []
+    for i in range(cells):
+        for j in range(cells):
+            landuse.append((Polygon(_cell_ring(edges, i, j)),
+                            dict(kind='park'), i * cells + j))
+    boundaries = [(LineString(points), dict(kind='county'), index)
+                  for index, points in enumerate(edges.itervalues())]
+    return [
+        ('landuse', dict(landuse=landuse)),
+        ('boundaries', dict(boundaries=boundaries)),
+        ('landuse and boundaries',
+         dict(landuse=landuse, boundaries=boundaries)),
+    ]
+
+
+def _time(fn, repeat=5):
+    import timeit
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    from StringIO import StringIO
+    from tilequeue.format.topojson import encode
+
+    bounds = (0.0, 0.0, 1.0, 1.0)
+    print('%-24s %11s %11s %10s %10s' % (
+        'tile', 'old size', 'new size', 'old time', 'new time'))
+    for name, features_by_layer in _tiles():
+        sizes = []
+        times = []
+        for encode_fn in (_encode_unshared, encode):
+            out = StringIO()
+            encode_fn(out, features_by_layer, bounds)
+            sizes.append(len(out.getvalue()))
+            times.append(_time(lambda: encode_fn(
+                StringIO(), features_by_layer, bounds)))
+        print('%-24s %10dK %10dK %9.3fs %9.3fs' % (
+            name, sizes[0] / 1024, sizes[1] / 1024, times[0], times[1]))
+
+
+if __name__ == '__main__':
+    main()
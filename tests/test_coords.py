@@ -0,0 +1,62 @@
+import unittest
+
+
+class TestArrayTransforms(unittest.TestCase):
+
+    def test_lnglat_matches_scalar(self):
+        from tilequeue.coords import mercator_to_lnglat
+        from tilequeue.transform import mercator_point_to_lnglat
+        import numpy
+
+        xy = numpy.array([
+            (-20037508.342789244, -20037508.342789244),
+            (-1000.0, 5000.0),
+            (0.0, 0.0),
+            (12345.678, -98765.4),
+            (20037508.0, 20037508.0),
+        ])
+        result = mercator_to_lnglat(xy)
+        for (x, y), (lng, lat) in zip(xy, result):
+            exp_lng, exp_lat = mercator_point_to_lnglat(x, y)
+            self.assertAlmostEqual(exp_lng, lng, 9)
+            self.assertAlmostEqual(exp_lat, lat, 9)
+
+    def test_rescale_matches_scalar(self):
+        from tilequeue.coords import make_rescale
+        from tilequeue.transform import rescale_point
+        import numpy
+
+        bounds = (-100.0, -50.0, 300.0, 350.0)
+        xy = numpy.array([(-100.0, -50.0), (0.0, 0.0), (-99.95, 100.05),
+                          (299.99, 350.0), (123.456, 78.9)])
+        result = make_rescale(bounds, 4096)(xy)
+        fn = rescale_point(bounds, 4096)
+        for (x, y), actual in zip(xy, result):
+            self.assertEqual(fn(x, y), tuple(actual))
+
+    def test_trim_precision(self):
+        from tilequeue.coords import make_trim_precision
+        import numpy
+
+        xy = numpy.array([(1.23456, -1.23456), (0.5, -0.25)])
+        result = make_trim_precision(2)(xy)
+        self.assertEqual([[1.23, -1.23], [0.5, -0.25]], result.tolist())
+
+    def test_map_coords_geometry_types(self):
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        from tilequeue.coords import map_coords
+
+        def double(xy):
+            return xy * 2
+
+        point = map_coords(double, Point(1, 2))
+        self.assertEqual((2.0, 4.0), point.coords[0])
+
+        shell = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]
+        hole = [(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]
+        multi = MultiPolygon([Polygon(shell, [hole])])
+        result = map_coords(double, multi)
+        self.assertEqual('MultiPolygon', result.type)
+        self.assertAlmostEqual(4 * multi.area, result.area)
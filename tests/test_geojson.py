@@ -0,0 +1,57 @@
+import unittest
+
+
+class TestGeojsonEncode(unittest.TestCase):
+
+    def _encode(self, features, zoom):
+        from StringIO import StringIO
+        from tilequeue.format.geojson import encode_single_layer
+        import json
+        out = StringIO()
+        encode_single_layer(out, features, zoom)
+        return json.loads(out.getvalue())
+
+    def test_precision_trimmed(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import Point
+        result = self._encode([
+            (Point(1.123456789, 2.5), dict(kind='a'), 1),
+            (LineString([(0, 0), (1.123456789, -1.987654321)]), {}, None),
+            (MultiPoint([(1, 1), (2.333333333, 3)]), {}, 3),
+        ], 0)
+
+        self.assertEqual('FeatureCollection', result['type'])
+        features = result['features']
+        self.assertEqual(3, len(features))
+        self.assertEqual(dict(type='Point', coordinates=[1.12, 2.5]),
+                         features[0]['geometry'])
+        self.assertEqual(dict(kind='a'), features[0]['properties'])
+        self.assertEqual(1, features[0]['id'])
+        self.assertEqual([[0, 0], [1.12, -1.99]],
+                         features[1]['geometry']['coordinates'])
+        self.assertNotIn('id', features[1])
+        self.assertEqual([[1, 1], [2.33, 3]],
+                         features[2]['geometry']['coordinates'])
+
+    def test_invalid_after_trimming(self):
+        from shapely.geometry import Polygon
+        # collapses to a line if trimmed, so is left as it was
+        shape = Polygon([(0, 0), (1e-9, 0), (1e-9, 1), (0, 1)])
+        result = self._encode([(shape, {}, 1)], 0)
+        coords = result['features'][0]['geometry']['coordinates']
+        self.assertEqual(1e-9, coords[0][1][0])
+
+    def test_multiple_layers(self):
+        from StringIO import StringIO
+        from shapely.geometry import Point
+        from tilequeue.format.geojson import encode_multiple_layers
+        import json
+        out = StringIO()
+        encode_multiple_layers(out, dict(
+            water=[(Point(1, 1), {}, 1)],
+            roads=[]), 10)
+        result = json.loads(out.getvalue())
+        self.assertEqual(set(['water', 'roads']), set(result.keys()))
+        self.assertEqual(1, len(result['water']['features']))
+        self.assertEqual([], result['roads']['features'])
@@ -156,3 +156,164 @@ class TestMetatile(unittest.TestCase):
         self.assertEqual(
             tile(1, 1, 1),
             common_parent(tile(5, 16, 16), tile(4, 15, 15)))
+
+
+class TestIndexedMetatile(unittest.TestCase):
+
+    def _tiles(self):
+        json = "{\"json\":true}"
+        topojson = "{\"topojson\":true}"
+        return [
+            dict(tile=json, coord=Coordinate(123, 456, 17),
+                 format=json_format, layer='all'),
+            dict(tile=topojson, coord=Coordinate(123, 456, 17),
+                 format=topojson_format, layer='all'),
+            dict(tile=json + 'x', coord=Coordinate(123, 457, 17),
+                 format=json_format, layer='all'),
+            dict(tile=json + 'y', coord=Coordinate(61, 228, 16),
+                 format=json_format, layer='all'),
+        ]
+
+    def test_make_and_extract(self):
+        from tilequeue.format import indexed_metatile_format
+
+        for compress in (False, True):
+            metatiles = make_metatiles(
+                2, self._tiles(), container='indexed', compress=compress)
+            self.assertEqual(1, len(metatiles))
+            meta = metatiles[0]
+            self.assertEqual(Coordinate(61, 228, 16), meta['coord'])
+            self.assertEqual('all', meta['layer'])
+            self.assertEqual(indexed_metatile_format, meta['format'])
+
+            buf = StringIO.StringIO(meta['tile'])
+            self.assertEqual("{\"json\":true}y", extract_metatile(
+                buf, json_format))
+            self.assertEqual("{\"json\":true}", extract_metatile(
+                buf, json_format, offset=Coordinate(zoom=1, column=0, row=1)))
+            self.assertEqual("{\"topojson\":true}", extract_metatile(
+                buf, topojson_format,
+                offset=Coordinate(zoom=1, column=0, row=1)))
+            self.assertEqual("{\"json\":true}x", extract_metatile(
+                buf, json_format, offset=Coordinate(zoom=1, column=1, row=1)))
+            self.assertIsNone(extract_metatile(
+                buf, topojson_format,
+                offset=Coordinate(zoom=1, column=1, row=1)))
+            self.assertIsNone(extract_metatile(
+                buf, zip_format, offset=Coordinate(zoom=1, column=1, row=0)))
+
+    def test_extract_reads_only_member(self):
+        # extracting a tile should read the header, the index and the
+        # member, and nothing else.
+        tiles = self._tiles()
+        tiles[0]['tile'] = 'a' * 100000
+        meta = make_metatiles(2, tiles, container='indexed')[0]
+
+        class CountingIO(object):
+            def __init__(self, data):
+                self.buf = StringIO.StringIO(data)
+                self.bytes_read = 0
+
+            def seek(self, offset):
+                self.buf.seek(offset)
+
+            def read(self, size):
+                data = self.buf.read(size)
+                self.bytes_read += len(data)
+                return data
+
+        io = CountingIO(meta['tile'])
+        self.assertEqual("{\"json\":true}x", extract_metatile(
+            io, json_format, offset=Coordinate(zoom=1, column=1, row=1)))
+        self.assertTrue(io.bytes_read < 1000)
+
+    def test_zip_is_default(self):
+        metatiles = make_metatiles(2, self._tiles())
+        self.assertEqual(zip_format, metatiles[0]['format'])
+
+    def test_unknown_container(self):
+        with self.assertRaises(ValueError):
+            make_metatiles(1, self._tiles(), container='tar')
+
+    def test_equality(self):
+        from tilequeue.metatile import metatiles_are_equal
+
+        tiles = self._tiles()
+        plain = make_metatiles(2, tiles, container='indexed')[0]['tile']
+        compressed = make_metatiles(
+            2, tiles, container='indexed', compress=True)[0]['tile']
+        shuffled = make_metatiles(
+            2, list(reversed(tiles)), container='indexed')[0]['tile']
+        zipped = make_metatiles(2, tiles)[0]['tile']
+
+        self.assertEqual(plain, shuffled)
+        self.assertTrue(metatiles_are_equal(plain, compressed))
+        self.assertFalse(metatiles_are_equal(plain, zipped))
+        self.assertFalse(metatiles_are_equal(zipped, plain))
+        self.assertFalse(metatiles_are_equal(plain, plain[:-1]))
+
+        tiles[0]['tile'] = 'changed'
+        changed = make_metatiles(2, tiles, container='indexed')[0]['tile']
+        self.assertFalse(metatiles_are_equal(plain, changed))
+
+
+class TestMetatileEquality(unittest.TestCase):
+
+    def _tiles(self, json="{\"json\":true}"):
+        return [
+            dict(tile=json, coord=Coordinate(0, 0, 0),
+                 format=json_format, layer='all'),
+            dict(tile=json + 'x', coord=Coordinate(0, 0, 0),
+                 format=topojson_format, layer='all'),
+        ]
+
+    def test_member_order_deterministic(self):
+        date_time = (2018, 1, 1, 0, 0, 0)
+        tiles = self._tiles()
+        meta_1 = make_metatiles(1, tiles, date_time)[0]['tile']
+        meta_2 = make_metatiles(1, tiles[::-1], date_time)[0]['tile']
+        self.assertEqual(meta_1, meta_2)
+
+    def test_different_contents(self):
+        from tilequeue.metatile import metatiles_are_equal
+
+        meta_1 = make_metatiles(1, self._tiles())[0]['tile']
+        meta_2 = make_metatiles(
+            1, self._tiles("{\"json\":false}"))[0]['tile']
+        self.assertFalse(metatiles_are_equal(meta_1, meta_2))
+        self.assertFalse(metatiles_are_equal(meta_1, meta_2, True))
+
+    def test_different_members(self):
+        from tilequeue.metatile import metatiles_are_equal
+
+        tiles = self._tiles()
+        meta_1 = make_metatiles(1, tiles)[0]['tile']
+        meta_2 = make_metatiles(1, tiles[:1])[0]['tile']
+        self.assertFalse(metatiles_are_equal(meta_1, meta_2))
+        self.assertFalse(metatiles_are_equal(meta_2, meta_1))
+
+    def test_equal_from_central_directory(self):
+        from tilequeue.metatile import metatiles_are_equal
+
+        # a metatile with the same names, sizes and CRCs is equal without
+        # decompressing any members. corrupting the compressed data of the
+        # member shows that it wasn't read, unless contents are checked.
+        date_time = (2018, 1, 1, 0, 0, 0)
+        json = "{\"json\":true}" * 10
+        tiles = [dict(tile=json, coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+        meta = make_metatiles(1, tiles, date_time)[0]['tile']
+        newer = make_metatiles(
+            1, tiles, (2018, 1, 2, 0, 0, 0))[0]['tile']
+
+        with zipfile.ZipFile(StringIO.StringIO(meta)) as z:
+            info = z.infolist()[0]
+        data_start = info.header_offset + 30 + len(info.filename) + \
+            len(info.extra)
+        corrupt = meta[:data_start] + \
+            '\xff' * info.compress_size + \
+            meta[data_start + info.compress_size:]
+
+        self.assertTrue(metatiles_are_equal(newer, corrupt))
+        self.assertTrue(metatiles_are_equal(newer, meta, True))
+        self.assertFalse(metatiles_are_equal(newer, corrupt, True))
@@ -54,7 +54,7 @@ class MapboxVectorTileTest(unittest.TestCase):
         from tilequeue.tile import coord_to_mercator_bounds
         from tilequeue.tile import metatile_zoom_from_size
 
-        name = 'tilequeue.format.mvt.mvt_encode'
+        name = 'tilequeue.format.mvt_encode'
         with patch(name, return_value='') as encode:
             coord = Coordinate(0, 0, 0)
             bounds = coord_to_mercator_bounds(coord)
@@ -80,12 +80,9 @@ class MapboxVectorTileTest(unittest.TestCase):
             self.assertEqual(num_tiles, encode.call_count)
             for (posargs, kwargs), coord in zip(encode.call_args_list,
                                                 tile_coords):
-                self.assertIn('quantize_bounds', kwargs)
-                quantize_bounds = kwargs['quantize_bounds']
+                fp, feature_layers, quantize_bounds, actual_extent = posargs
                 extent = int(round((quantize_bounds[2] - quantize_bounds[0]) /
                                    resolution))
-                self.assertIn('extents', kwargs)
-                actual_extent = kwargs['extents']
                 self.assertEquals(extent, actual_extent,
                                   "Expected %r, not %r, for coord %r" %
                                   (extent, actual_extent, coord))
@@ -98,3 +95,99 @@ class MapboxVectorTileTest(unittest.TestCase):
 
     def test_metatile_size_4(self):
         self._check_metatile(4)
+
+
+class NativeEncoderTest(unittest.TestCase):
+
+    def _assert_same_as_mapbox(self, features, extents=4096):
+        from StringIO import StringIO
+        from tilequeue.format.mvt import encode
+        from tilequeue.format.mvt import encode_mapbox
+
+        bounds = (0.0, 0.0, 1000.0, 1000.0)
+        feature_layers = [
+            dict(name='fake_layer', features=features),
+            dict(name=u'empty_layer', features=[]),
+        ]
+        expected = StringIO()
+        encode_mapbox(expected, feature_layers, bounds, extents)
+        actual = StringIO()
+        encode(actual, feature_layers, bounds, extents)
+        self.assertEqual(expected.getvalue(), actual.getvalue())
+
+    def test_points(self):
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import Point
+        self._assert_same_as_mapbox([
+            (Point(10.4, 20.5), {}, 1),
+            (Point(-10.5, 2000.5), {}, 2),
+            (MultiPoint([(1, 1), (1, 1), (500, 3, 7)]), {}, 3),
+        ])
+
+    def test_lines(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        self._assert_same_as_mapbox([
+            # collapses to a single point, so is dropped
+            (LineString([(0, 0), (0.1, 0.1)]), {}, 1),
+            (LineString([(0, 0), (0.1, 0.1), (100, 100), (100.2, 100.2),
+                         (300, 5)]), {}, 2),
+            (MultiLineString([[(0, 0), (0.1, 0.1)], [(5, 5), (600, 600)],
+                              [(8, 8), (9, 700)]]), {}, 3),
+        ])
+
+    def test_polygons(self):
+        from shapely.geometry import box
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        ring = Point(500, 500).buffer(600, 32).difference(
+            Point(500, 500).buffer(200, 32))
+        self._assert_same_as_mapbox([
+            # wrong winding order
+            (Polygon([(10, 10), (500, 10), (500, 500), (10, 500)]), {}, 1),
+            (ring, {}, 2),
+            (MultiPolygon([box(0, 0, 10, 10), box(50, 50, 60, 60)]), {}, 3),
+            (box(-1e6, -1e6, 1e6, 1e6), {}, 4),
+        ])
+
+    def test_invalid_polygons(self):
+        from shapely.geometry import box
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Polygon
+        self._assert_same_as_mapbox([
+            # bowtie
+            (Polygon([(0, 0), (100, 100), (100, 0), (0, 100)]), {}, 1),
+            # hole collapses when quantized
+            (Polygon([(0, 0), (100, 0), (100, 100), (0, 100)],
+                     [[(0, 0), (0.05, 0), (0.05, 0.05)]]), {}, 2),
+            # parts touch when quantized
+            (MultiPolygon([box(0, 0, 10, 10), box(10.1, 0, 20, 10)]), {}, 3),
+            (MultiPolygon([box(0, 0, 0.05, 0.05), box(50, 50, 60, 60)]),
+             {}, 4),
+        ], extents=256)
+
+    def test_properties(self):
+        from shapely.geometry import Point
+        shape = Point(1, 1)
+        self._assert_same_as_mapbox([
+            (shape, dict(a=1, b=True, c=1.0), 1),
+            (shape, dict(a=u'\xe9', b='x', c=-5, d=None, e=[1], f=2**40), 2),
+            (shape, dict(b=False, c=0, g=1.5), None),
+            (shape, None, -1),
+        ])
+
+    def test_random_shapes(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Polygon
+        import random
+
+        rnd = random.Random(1)
+        features = []
+        for i in range(50):
+            coords = [(rnd.uniform(-100, 1100), rnd.uniform(-100, 1100))
+                      for _ in range(rnd.randint(3, 30))]
+            features.append((LineString(coords), dict(n=i % 3), i))
+            # mostly self-intersecting
+            features.append((Polygon(coords), dict(n=i % 5), i))
+        self._assert_same_as_mapbox(features)
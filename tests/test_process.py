@@ -206,6 +206,283 @@ class TestProcess(unittest.TestCase):
         self.assertNotIn(coord, [t['coord'] for t in tiles])
 
 
+class TestCutCoordIndex(unittest.TestCase):
+
+    def test_same_as_unindexed(self):
+        from random import Random
+        from shapely.geometry import box
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        from tilequeue.process import _cut_coord
+        from tilequeue.process import _index_feature_layers
+        from tilequeue.process import ProcessingPlan
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(zoom=10, column=163, row=395)
+        minx, miny, maxx, maxy = coord_to_mercator_bounds(coord)
+        w = maxx - minx
+        h = maxy - miny
+        rnd = Random(1)
+
+        def _rnd_point():
+            return (minx + rnd.uniform(-0.1, 1.1) * w,
+                    miny + rnd.uniform(-0.1, 1.1) * h)
+
+        features = []
+        for i in xrange(300):
+            x, y = _rnd_point()
+            kind = i % 3
+            if kind == 0:
+                shape = Point(x, y)
+            elif kind == 1:
+                shape = LineString([(x, y), _rnd_point()])
+            else:
+                size = rnd.uniform(0, 0.6)
+                shape = box(x, y, x + size * w, y + size * h)
+            features.append((shape, dict(i=i), i))
+
+        feature_layers = [dict(
+            name='fake_layer', layer_datum=dict(name='fake_layer'),
+            features=features)]
+        buffer_cfg = dict(mvt=dict(geometry=dict(
+            point=4, line=8, polygon=16)))
+        plan = ProcessingPlan(None, (), buffer_cfg, {})
+        layer_indexes = _index_feature_layers(
+            feature_layers, (minx, miny, maxx, maxy))
+
+        for child in coord_children_range(coord, coord.zoom + 2):
+            bounds = coord_to_mercator_bounds(child)
+            expected = _cut_coord(feature_layers, bounds, 10.0, plan)
+            actual = _cut_coord(
+                feature_layers, bounds, 10.0, plan, layer_indexes)
+            self.assertEqual(
+                [f[2] for f in expected[0]['features']],
+                [f[2] for f in actual[0]['features']])
+
+
+class TestHierarchicalCut(unittest.TestCase):
+
+    def test_same_as_flat(self):
+        from shapely.geometry import Point
+        from shapely.geometry import shape as make_shape
+        from tilequeue.format import json_format
+        from tilequeue.process import format_coord
+        from tilequeue.process import ProcessingPlan
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import coord_to_mercator_bounds
+        import json
+
+        coord = Coordinate(zoom=10, column=163, row=395)
+        bounds = coord_to_mercator_bounds(coord)
+        cx = 0.5 * (bounds[0] + bounds[2])
+        cy = 0.5 * (bounds[1] + bounds[3])
+        radius = 0.6 * (bounds[2] - bounds[0])
+        ocean = Point(cx, cy).buffer(radius, 64)
+        feature_layers = [dict(
+            name='water',
+            layer_datum=dict(name='water', is_clipped=True, clip_factor=1.5),
+            features=[(ocean, dict(kind='ocean'), 1)])]
+        cut_coords = [coord] + list(coord_children_range(coord, 12))
+        buffer_cfg = dict(json=dict(geometry=dict(polygon=8)))
+
+        def _format(cut_strategy):
+            plan = ProcessingPlan(
+                None, (), buffer_cfg, {}, cut_strategy=cut_strategy)
+            tiles, _ = format_coord(
+                coord, coord.zoom, feature_layers, [json_format], bounds,
+                cut_coords, buffer_cfg, {}, 4096, plan)
+            return tiles
+
+        flat = _format('flat')
+        hierarchical = _format('hierarchical')
+        self.assertEqual(len(flat), len(hierarchical))
+        for flat_tile, hier_tile in zip(flat, hierarchical):
+            self.assertEqual(flat_tile['coord'], hier_tile['coord'])
+            flat_features = json.loads(flat_tile['tile'])['features']
+            hier_features = json.loads(hier_tile['tile'])['features']
+            self.assertEqual(len(flat_features), len(hier_features))
+            for flat_feature, hier_feature in zip(
+                    flat_features, hier_features):
+                flat_shape = make_shape(flat_feature['geometry'])
+                hier_shape = make_shape(hier_feature['geometry'])
+                diff = flat_shape.symmetric_difference(hier_shape)
+                self.assertAlmostEqual(0, diff.area / flat_shape.area, 6)
+
+    def test_unknown_strategy(self):
+        from tilequeue.process import ProcessingPlan
+        with self.assertRaises(ValueError):
+            ProcessingPlan(None, (), {}, {}, cut_strategy='diagonal')
+
+
+class TestProcessingPlan(unittest.TestCase):
+
+    def test_resolves_once(self):
+        from tilequeue.format import json_format
+        from tilequeue.process import ProcessingPlan
+
+        layer_datum = dict(
+            name='fake_layer',
+            transform_fn_names=['tests.test_process._only_zoom_zero'],
+            sort_fn_name='tests.test_process._only_zoom_one',
+        )
+        post_process_data = [dict(
+            fn_name='tests.test_process._only_zoom_zero',
+            params={}, resources={})]
+        buffer_cfg = dict(json=dict(geometry=dict(point=8)))
+
+        def _test_output_fn(*args):
+            return dict(min_zoom=0)
+
+        plan = ProcessingPlan(
+            [layer_datum], post_process_data, buffer_cfg,
+            dict(fake_layer=_test_output_fn))
+
+        layer_plan = plan.layer_plan(layer_datum)
+        self.assertIs(layer_plan, plan.layer_plan(dict(name='fake_layer')))
+        self.assertIs(_only_zoom_one, layer_plan.sort_fn)
+        self.assertIs(_test_output_fn, layer_plan.output_calc)
+        self.assertIsNotNone(layer_plan.transform_fn)
+        self.assertEqual(
+            [_only_zoom_zero], [s.fn for s in plan.post_process_steps])
+
+        self.assertEqual(
+            8, plan.buffer_pixels(json_format, 'fake_layer', 'Point'))
+        self.assertIsNone(
+            plan.buffer_pixels(json_format, 'fake_layer', 'Polygon'))
+
+
+class TestSharedFormatting(unittest.TestCase):
+
+    def _format(self, formats, buffer_cfg):
+        from shapely.geometry import box
+        from shapely.geometry import Point
+        from tilequeue.process import format_coord
+        from tilequeue.process import ProcessingPlan
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(zoom=10, column=163, row=395)
+        bounds = coord_to_mercator_bounds(coord)
+        width = bounds[2] - bounds[0]
+        feature_layers = [dict(
+            name='fake_layer',
+            layer_datum=dict(name='fake_layer', is_clipped=True),
+            features=[
+                (box(bounds[0] - width, bounds[1], bounds[0] + 0.5 * width,
+                     bounds[3]), dict(kind='big'), 1),
+                (Point(bounds[0] - 0.001 * width, bounds[1] + 0.5 * width),
+                 dict(kind='edge'), 2),
+            ])]
+        plan = ProcessingPlan(None, (), buffer_cfg, {})
+        tiles, _ = format_coord(
+            coord, coord.zoom, feature_layers, formats, bounds, [coord],
+            buffer_cfg, {}, 4096, plan)
+        return [tile['tile'] for tile in tiles]
+
+    def test_same_buffer_shares_tile(self):
+        from tilequeue.format import mvt_format
+        from tilequeue.format import mvtb_format
+
+        buffer_cfg = dict(
+            mvt=dict(geometry=dict(point=8)),
+            mvtb=dict(geometry=dict(point=8)))
+        mvt_tile, mvtb_tile = self._format(
+            [mvt_format, mvtb_format], buffer_cfg)
+        self.assertIs(mvt_tile, mvtb_tile)
+        self.assertEqual(
+            [mvt_tile], self._format([mvt_format], buffer_cfg))
+
+    def test_different_buffer(self):
+        from tilequeue.format import mvt_format
+        from tilequeue.format import mvtb_format
+
+        buffer_cfg = dict(mvtb=dict(geometry=dict(point=8)))
+        mvt_tile, mvtb_tile = self._format(
+            [mvt_format, mvtb_format], buffer_cfg)
+        # the point just outside the tile is only in the buffered tile
+        self.assertNotEqual(mvt_tile, mvtb_tile)
+        self.assertEqual([mvt_tile], self._format([mvt_format], buffer_cfg))
+        self.assertEqual([mvtb_tile], self._format([mvtb_format], buffer_cfg))
+
+
+class TestReduceGeometry(unittest.TestCase):
+
+    def _reduce(self, shapes, zoom, **layer_kwargs):
+        from tilequeue.process import _reduce_geometry
+        from tilequeue.process import ProcessingPlan
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(zoom=zoom, column=0, row=0)
+        bounds = coord_to_mercator_bounds(coord)
+        layer_datum = dict(name='fake_layer', is_clipped=True,
+                           clip_factor=1.0)
+        layer_datum.update(layer_kwargs)
+        feature_layers = [dict(
+            name='fake_layer', layer_datum=layer_datum,
+            features=[(shape, {}, i) for i, shape in enumerate(shapes)])]
+        plan = ProcessingPlan(None, (), {}, {}, simplify_geometry=True)
+        layers, reduction = _reduce_geometry(
+            feature_layers, bounds, zoom, plan)
+        return bounds, layers[0]['features'], reduction['fake_layer']
+
+    def test_drops_small_and_clips(self):
+        from shapely.geometry import box
+        from tilequeue.tile import calc_meters_per_pixel_dim
+
+        zoom = 10
+        pixel = calc_meters_per_pixel_dim(zoom)
+        bounds, _, _ = self._reduce([], zoom)
+        minx, miny, maxx, maxy = bounds
+        tiny = box(minx + 10 * pixel, miny + 10 * pixel,
+                   minx + 10.5 * pixel, miny + 10.5 * pixel)
+        large = box(minx - 100 * pixel, miny - 100 * pixel,
+                    minx + 100 * pixel, miny + 100 * pixel)
+
+        _, features, reduction = self._reduce([tiny, large], zoom)
+        self.assertEqual(1, len(features))
+        shape, _, fid = features[0]
+        self.assertEqual(1, fid)
+        self.assertTrue(box(*bounds).buffer(1).contains(shape))
+        self.assertEqual(10, reduction['vertices_in'])
+        self.assertEqual(5, reduction['vertices_out'])
+        self.assertEqual(2 * 93, reduction['bytes_in'])
+        self.assertEqual(93, reduction['bytes_out'])
+
+    def test_simplify_start(self):
+        from shapely.geometry import LineString
+        from tilequeue.tile import calc_meters_per_pixel_dim
+
+        zoom = 10
+        pixel = calc_meters_per_pixel_dim(zoom)
+        bounds, _, _ = self._reduce([], zoom)
+        minx, miny = bounds[:2]
+        # a nearly straight line, which wobbles by much less than a pixel
+        coords = [(minx + i * pixel, miny + 50 * pixel + (i % 2) * 0.01)
+                  for i in range(100)]
+        line = LineString(coords)
+
+        _, features, _ = self._reduce([line], zoom, simplify_start=zoom)
+        self.assertEqual(2, len(features[0][0].coords))
+
+        _, features, _ = self._reduce([line], zoom, simplify_start=zoom + 1)
+        self.assertEqual(100, len(features[0][0].coords))
+
+    def test_wkb_size(self):
+        from shapely.geometry import shape
+        from shapely.wkb import dumps
+        from tilequeue.process import _wkb_size
+
+        for geojson in (
+                dict(type='Point', coordinates=[1, 2]),
+                dict(type='LineString', coordinates=[[0, 0], [1, 1]]),
+                dict(type='Polygon', coordinates=[
+                    [[0, 0], [4, 0], [4, 4], [0, 0]],
+                    [[1, 1], [2, 1], [2, 2], [1, 1]]]),
+                dict(type='MultiPoint', coordinates=[[0, 0], [1, 1]])):
+            geom = shape(geojson)
+            self.assertEqual(len(dumps(geom)), _wkb_size(geom))
+
+
 def _only_zoom(ctx, zoom):
     layer = ctx.feature_layers[0]
 
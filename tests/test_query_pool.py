@@ -0,0 +1,165 @@
+import unittest
+
+
+class _FakeConn(object):
+
+    def __init__(self, dbname):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        self.pool_dbname = dbname
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.server_gone = False
+        self.queries = []
+
+    def _check_server(self):
+        import psycopg2
+        if self.server_gone:
+            raise psycopg2.OperationalError(
+                'server closed the connection unexpectedly')
+
+    def poll(self):
+        self._check_server()
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class _FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def execute(self, query):
+        self.conn._check_server()
+        self.conn.queries.append(query)
+
+
+class TestDBConnectionPool(unittest.TestCase):
+
+    def _make_pool(self, dbnames, **kwargs):
+        from tilequeue.query.pool import DBConnectionPool
+        pool = DBConnectionPool(dbnames, {}, **kwargs)
+        self.made = []
+
+        def _make_conn(dbname):
+            conn = _FakeConn(dbname)
+            self.made.append(conn)
+            return conn
+
+        pool._make_conn = _make_conn
+        return pool
+
+    def test_conns_reused(self):
+        pool = self._make_pool(['a', 'b'])
+        with pool.get_conns(2) as conns:
+            first = list(conns)
+        self.assertEqual(['a', 'b'], [c.pool_dbname for c in first])
+        with pool.get_conns(2) as conns:
+            second = list(conns)
+        self.assertEqual(sorted(map(id, first)), sorted(map(id, second)))
+        self.assertEqual(2, len(self.made))
+        self.assertFalse(any(c.closed for c in self.made))
+
+    def test_broken_conn_replaced(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+        pool = self._make_pool(['a'])
+        with pool.get_conns(1) as conns:
+            conns[0].status = TRANSACTION_STATUS_UNKNOWN
+            broken = conns[0]
+        self.assertTrue(broken.closed)
+        with pool.get_conns(1) as conns:
+            self.assertIsNot(broken, conns[0])
+        self.assertEqual(2, len(self.made))
+
+    def test_closed_idle_conn_replaced(self):
+        pool = self._make_pool(['a'])
+        with pool.get_conns(1) as conns:
+            conn = conns[0]
+        conn.closed = 1
+        with pool.get_conns(1) as conns:
+            self.assertIsNot(conn, conns[0])
+        self.assertEqual(1, pool.n_open['a'])
+
+    def test_dropped_idle_conn_replaced(self):
+        pool = self._make_pool(['a'])
+        with pool.get_conns(1) as conns:
+            conn = conns[0]
+        # e.g: the server restarted while the connection was idle
+        conn.server_gone = True
+        with pool.get_conns(1) as conns:
+            self.assertIsNot(conn, conns[0])
+        self.assertTrue(conn.closed)
+        self.assertEqual(1, pool.n_open['a'])
+
+    def test_long_idle_conn_checked(self):
+        pool = self._make_pool(['a'], idle_check_seconds=60)
+        with pool.get_conns(1) as conns:
+            conn = conns[0]
+        with pool.get_conns(1) as conns:
+            self.assertIs(conn, conns[0])
+        # only just returned, so no query is needed
+        self.assertEqual([], conn.queries)
+
+        conn.idle_since -= 60
+        with pool.get_conns(1) as conns:
+            self.assertIs(conn, conns[0])
+        self.assertEqual(['SELECT 1'], conn.queries)
+
+    def test_bounded_waits_for_return(self):
+        import threading
+        pool = self._make_pool(['a'], max_conns_per_db=1)
+        ctx = pool.get_conns(1)
+        got_conn = threading.Event()
+
+        def _get():
+            with pool.get_conns(1):
+                got_conn.set()
+
+        t = threading.Thread(target=_get)
+        t.start()
+        self.assertFalse(got_conn.wait(0.1))
+        pool.put_conns(ctx.conns)
+        t.join(5)
+        self.assertTrue(got_conn.is_set())
+        self.assertEqual(1, len(self.made))
+
+
+class TestSplitConnInfo(unittest.TestCase):
+
+    def test_settings_removed(self):
+        from tilequeue.query.pool import split_conn_info
+        postgresql_cfg = dict(
+            host='localhost', user='osm', dbnames=['a', 'b'],
+            max_conns_per_db=2, fetch_batch_size=1000)
+
+        conn_info, settings = split_conn_info(postgresql_cfg)
+        self.assertEqual(dict(host='localhost', user='osm'), conn_info)
+        self.assertEqual(
+            dict(dbnames=['a', 'b'], max_conns_per_db=2,
+                 fetch_batch_size=1000),
+            settings)
+        # the config isn't modified
+        self.assertIn('dbnames', postgresql_cfg)
+
+    def test_settings_default_none(self):
+        from tilequeue.query.pool import split_conn_info
+        conn_info, settings = split_conn_info(dict(dbnames=['a']))
+        self.assertEqual({}, conn_info)
+        self.assertIsNone(settings['max_conns_per_db'])
+        self.assertIsNone(settings['fetch_batch_size'])
@@ -0,0 +1,90 @@
+import unittest
+
+
+class TestBoundsParams(unittest.TestCase):
+
+    def test_bbox_filter_uses_params(self):
+        from tilequeue.query.postgres import bounds_params
+        from tilequeue.query.postgres import jinja_filter_bbox_filter
+        sql = jinja_filter_bbox_filter(bounds_params, 'way')
+        self.assertEqual(
+            'way && ST_SetSrid(ST_MakeBox2D(ST_MakePoint($1, $2), '
+            'ST_MakePoint($3, $4)), 3857)', sql)
+
+    def test_literal_bounds_unchanged(self):
+        from tilequeue.query.postgres import jinja_filter_bbox
+        sql = jinja_filter_bbox((0, 1, 2.5, 3))
+        self.assertEqual(
+            'ST_SetSrid(ST_MakeBox2D('
+            'ST_MakePoint(0.000000000000, 1.000000000000), '
+            'ST_MakePoint(2.500000000000, 3.000000000000)), 3857)', sql)
+
+    def test_padded_matches_literal(self):
+        from tilequeue.query.postgres import BoundsParams
+        from tilequeue.transform import calculate_padded_bounds
+        bounds = (10.0, 20.0, 30.0, 60.0)
+        exprs = BoundsParams(['%r' % x for x in bounds]).padded(1.1)
+        padded = [eval(expr) for expr in exprs]
+        expected = calculate_padded_bounds(1.1, bounds).bounds
+        for exp, act in zip(expected, padded):
+            self.assertAlmostEqual(exp, act)
+
+
+class TestPreparedSourcesQueriesGenerator(unittest.TestCase):
+
+    def test_compiled_once_per_zoom(self):
+        from tilequeue.query.postgres import DataSource
+        from tilequeue.query.postgres import PreparedSourcesQueriesGenerator
+        from tilequeue.query.postgres import TemplateSpec
+        calls = []
+
+        def query_generator(template, bounds, zoom):
+            calls.append((template, zoom))
+            return 'SELECT %s, %d, %s' % (template, zoom, bounds[0])
+
+        sources = [DataSource('water', [TemplateSpec('w.jinja2', 0, 20)])]
+        gen = PreparedSourcesQueriesGenerator(sources, query_generator, True)
+        q1, = gen(5, (0, 0, 1, 1))
+        q2, = gen(5, (1, 1, 2, 2))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(q1.name, q2.name)
+        self.assertEqual('SELECT w.jinja2, 5, $1', q1.sql)
+        self.assertEqual((1.0, 1.0, 2.0, 2.0), q2.params)
+        q3, = gen(6, (0, 0, 1, 1))
+        self.assertNotEqual(q1.name, q3.name)
+
+
+class _FakeColumn(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _FakeCursor(object):
+
+    def __init__(self, col_names, rows):
+        self.description = [_FakeColumn(name) for name in col_names]
+        self.rows = list(rows)
+        self.batch_sizes = []
+
+    def fetchmany(self, size):
+        self.batch_sizes.append(size)
+        batch = self.rows[:size]
+        self.rows = self.rows[size:]
+        return batch
+
+
+class TestReadRows(unittest.TestCase):
+
+    def test_batches_and_nulls(self):
+        from tilequeue.query.postgres import _read_rows
+        cursor = _FakeCursor(
+            ['__id__', '__geometry__', 'name'],
+            [(1, 'wkb1', None), (2, 'wkb2', 'foo'), (3, 'wkb3', None)])
+        rows = _read_rows(cursor, 2)
+        self.assertEqual([
+            dict(__id__=1, __geometry__='wkb1'),
+            dict(__id__=2, __geometry__='wkb2', name='foo'),
+            dict(__id__=3, __geometry__='wkb3'),
+        ], rows)
+        self.assertEqual([2, 2, 2], cursor.batch_sizes)
@@ -56,6 +56,100 @@ class TestTileDirectory(unittest.TestCase):
 
             os.remove(expected_path)
 
+    def test_list_tiles(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import topojson_format
+        from tilequeue import store
+        import os
+
+        tile_dir = store.TileDirectory(self.dir_path, list_workers=2)
+        coords = [Coordinate(zoom=z, column=x, row=y)
+                  for z in range(3) for x in range(1 << z) for y in range(2)]
+        for coord in coords:
+            tile_dir.write_tile('json', coord, json_format, 'all')
+        tile_dir.write_tile(
+            'topojson', Coordinate(zoom=5, column=1, row=1), topojson_format,
+            'all')
+        tile_dir.write_tile(
+            'json', Coordinate(zoom=5, column=1, row=1), json_format,
+            'other')
+        # stray files are ignored
+        open(os.path.join(self.dir_path, 'all', '2', '1', '0.json.swp-1'),
+             'w').close()
+        open(os.path.join(self.dir_path, 'all', '2', 'README'), 'w').close()
+
+        listed = list(tile_dir.list_tiles(json_format, 'all'))
+        self.assertEquals(len(coords), len(listed))
+        self.assertEquals(set(coords), set(listed))
+        self.assertEquals([], list(tile_dir.list_tiles(json_format, 'none')))
+
+    def test_write_after_dir_removed(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+        import shutil
+        import os
+
+        tile_dir = store.TileDirectory(self.dir_path)
+        coord = Coordinate(zoom=1, column=1, row=1)
+        tile_dir.write_tile('a', coord, json_format, 'all')
+        shutil.rmtree(os.path.join(self.dir_path, 'all'))
+        tile_dir.write_tile('b', coord, json_format, 'all')
+        self.assertEquals('b', tile_dir.read_tile(coord, json_format, 'all'))
+
+    def test_fsync_batch(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+
+        tile_dir = store.TileDirectory(self.dir_path, fsync_batch_size=3)
+        for x in range(4):
+            tile_dir.write_tile(
+                'a', Coordinate(zoom=2, column=x, row=0), json_format, 'all')
+        self.assertEquals(1, len(tile_dir.unsynced_paths))
+        tile_dir.flush()
+        self.assertEquals([], tile_dir.unsynced_paths)
+
+    def test_fsync_batch_flushed_at_exit(self):
+        from mock import patch
+        from tilequeue import store
+
+        with patch('tilequeue.store.atexit.register') as register:
+            store.TileDirectory(self.dir_path)
+            self.assertFalse(register.called)
+            tile_dir = store.TileDirectory(self.dir_path, fsync_batch_size=3)
+        register.assert_called_once_with(tile_dir.flush)
+
+    def test_fsync_removed_dir(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+        import shutil
+        import os
+
+        tile_dir = store.TileDirectory(self.dir_path, fsync_batch_size=2)
+        tile_dir.write_tile(
+            'a', Coordinate(zoom=2, column=0, row=0), json_format, 'all')
+        shutil.rmtree(os.path.join(self.dir_path, 'all'))
+        # the batch is synced by this write, and the first tile's directory
+        # has gone.
+        tile_dir.write_tile(
+            'b', Coordinate(zoom=2, column=1, row=0), json_format, 'all')
+        self.assertEquals([], tile_dir.unsynced_paths)
+
+    def test_tile_digest(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+        tile_dir = store.TileDirectory(self.dir_path)
+        coord = Coordinate(row=1, column=2, zoom=3)
+        self.assertIsNone(tile_dir.tile_digest(coord, json_format, 'all'))
+        tile_dir.write_tile('data', coord, json_format, 'all')
+        self.assertEqual(
+            store.calc_tile_digest('data', json_format),
+            tile_dir.tile_digest(coord, json_format, 'all'))
+
 
 class TestStoreKey(unittest.TestCase):
 
@@ -124,3 +218,961 @@ class WriteTileIfChangedTest(unittest.TestCase):
         did_write = self._call_fut('data')
         self.assertFalse(did_write)
         self.assertIsNone(self._out)
+
+
+class WriteTileIfChangedDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self._in = None
+        self._out = None
+        self.reads = 0
+        self.store = type(
+            'test-store',
+            (),
+            dict(read_tile=self._read_tile, write_tile=self._write_tile,
+                 tile_digest=self._tile_digest)
+        )
+
+    def _read_tile(self, coord, format, layer):
+        self.reads += 1
+        return self._in
+
+    def _write_tile(self, tile_data, coord, format, layer):
+        self._out = tile_data
+
+    def _tile_digest(self, coord, format, layer):
+        from tilequeue.store import calc_tile_digest
+        if self._in is None:
+            return None
+        return calc_tile_digest(self._in, format)
+
+    def _call_fut(self, tile_data, format=None):
+        from tilequeue.store import write_tile_if_changed
+        coord = layer = None
+        result = write_tile_if_changed(
+            self.store, tile_data, coord, format, layer)
+        return result
+
+    def test_no_data(self):
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals('data', self._out)
+
+    def test_diff_data(self):
+        self._in = 'different data'
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals('data', self._out)
+
+    def test_same_data(self):
+        self._in = 'data'
+        did_write = self._call_fut('data')
+        self.assertFalse(did_write)
+        self.assertIsNone(self._out)
+        self.assertEquals(0, self.reads)
+
+    def test_same_metatile_different_time(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        from tilequeue.metatile import make_metatiles
+
+        tiles = [dict(tile='{"json":true}', coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+        self._in = make_metatiles(
+            1, tiles, (2018, 1, 1, 0, 0, 0))[0]['tile']
+        new = make_metatiles(1, tiles, (2018, 1, 2, 0, 0, 0))[0]['tile']
+        self.assertNotEqual(self._in, new)
+
+        did_write = self._call_fut(new, zip_format)
+        self.assertFalse(did_write)
+
+
+class S3TileDigestTest(unittest.TestCase):
+
+    def _make_store(self, keys):
+        from tilequeue.store import S3
+
+        class Key(object):
+            def __init__(self, data, etag, metadata):
+                self.data = data
+                self.etag = etag
+                self.metadata = metadata
+                self.reads = 0
+
+            def get_metadata(self, name):
+                return self.metadata.get(name)
+
+            def get_contents_as_string(self):
+                self.reads += 1
+                return self.data
+
+        class Bucket(object):
+            def get_key(self, key_name):
+                key = keys.get(key_name)
+                return Key(*key) if key else None
+
+        return S3(Bucket(), '', 'osm', False, 0, None)
+
+    def _key_name(self, coord, fmt):
+        from tilequeue.store import s3_tile_key
+        return s3_tile_key('', 'osm', 'all', coord, fmt.extension)
+
+    def test_missing(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        store = self._make_store({})
+        self.assertIsNone(store.tile_digest(
+            Coordinate(0, 0, 0), json_format, 'all'))
+
+    def test_metadata(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import zip_format
+        coord = Coordinate(0, 0, 0)
+        keys = {self._key_name(coord, zip_format): (
+            'data', '"etag"', {'tile-digest': 'abc'})}
+        store = self._make_store(keys)
+        self.assertEquals('abc', store.tile_digest(coord, zip_format, 'all'))
+
+    def test_etag(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import calc_tile_digest
+        coord = Coordinate(0, 0, 0)
+        digest = calc_tile_digest('data', json_format)
+        keys = {self._key_name(coord, json_format): (
+            'not read', '"%s"' % digest, {})}
+        store = self._make_store(keys)
+        self.assertEquals(
+            digest, store.tile_digest(coord, json_format, 'all'))
+
+    def test_multipart_etag(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import calc_tile_digest
+        coord = Coordinate(0, 0, 0)
+        keys = {self._key_name(coord, json_format): (
+            'data', '"abc-2"', {})}
+        store = self._make_store(keys)
+        self.assertEquals(
+            calc_tile_digest('data', json_format),
+            store.tile_digest(coord, json_format, 'all'))
+
+
+class TileHashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_index(self, max_entries=100):
+        from tilequeue.store import TileHashIndex
+        import os
+        return TileHashIndex(
+            os.path.join(self.dir_path, 'index.sqlite'), max_entries)
+
+    def test_put_get(self):
+        index = self._make_index()
+        self.assertIsNone(index.get('a'))
+        index.put('a', '1')
+        index.put('a', '2')
+        self.assertEquals('2', index.get('a'))
+        self.assertEquals(1, index.num_entries)
+
+        # persists across instances
+        index = self._make_index()
+        self.assertEquals('2', index.get('a'))
+        self.assertEquals(1, index.num_entries)
+
+    def test_bounded(self):
+        index = self._make_index(max_entries=10)
+        for i in range(25):
+            index.put(str(i), 'digest')
+        self.assertEquals(10, index.num_entries)
+        # the most recently written are kept
+        self.assertEquals('digest', index.get('24'))
+        self.assertIsNone(index.get('0'))
+
+    def test_shared(self):
+        first = self._make_index(max_entries=10)
+        second = self._make_index(max_entries=10)
+        for i in range(25):
+            index = first if i % 2 else second
+            index.put(str(i), 'digest')
+        self.assertTrue(first.num_entries <= 10)
+        self.assertEquals(first.num_entries, second.num_entries)
+        # the most recently written by either are kept
+        self.assertEquals('digest', first.get('23'))
+        self.assertEquals('digest', first.get('24'))
+        self.assertIsNone(second.get('13'))
+
+    def test_other_host(self):
+        index = self._make_index()
+        with index.conn:
+            index.conn.execute("UPDATE index_host SET host = 'elsewhere'")
+        with self.assertRaises(IOError):
+            self._make_index()
+
+    def test_invalidate(self):
+        index = self._make_index()
+        index.put('a', '1')
+        index.put('b', '2')
+        index.invalidate(['a', 'c'])
+        self.assertIsNone(index.get('a'))
+        self.assertEquals('2', index.get('b'))
+        self.assertEquals(1, index.num_entries)
+
+
+class HashIndexedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_store(self):
+        from tilequeue.store import HashIndexedStore
+        from tilequeue.store import TileHashIndex
+        import os
+
+        calls = []
+
+        class Store(object):
+            def __init__(self):
+                self.tiles = {}
+
+            def write_tile(self, tile_data, coord, format, layer):
+                calls.append('write')
+                self.tiles[coord] = tile_data
+
+            def read_tile(self, coord, format, layer):
+                calls.append('read')
+                return self.tiles.get(coord)
+
+            def delete_tiles(self, coords, format, layer):
+                calls.append('delete')
+                for coord in coords:
+                    self.tiles.pop(coord, None)
+                return len(coords)
+
+        index = TileHashIndex(os.path.join(self.dir_path, 'index.sqlite'))
+        return HashIndexedStore(Store(), index), calls
+
+    def test_skip_unchanged_without_store_request(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import write_tile_if_changed
+
+        store, calls = self._make_store()
+        coord = Coordinate(0, 0, 0)
+
+        self.assertTrue(write_tile_if_changed(
+            store, 'data', coord, json_format, 'all'))
+        self.assertEquals(['read', 'write'], calls)
+        self.assertEquals(dict(hits=0, misses=1), store.index_counts)
+
+        del calls[:]
+        self.assertFalse(write_tile_if_changed(
+            store, 'data', coord, json_format, 'all'))
+        self.assertEquals([], calls)
+
+        self.assertTrue(write_tile_if_changed(
+            store, 'new data', coord, json_format, 'all'))
+        self.assertEquals(['write'], calls)
+        self.assertEquals(dict(hits=2, misses=1), store.index_counts)
+
+    def test_index_failure(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        import sqlite3
+
+        store, calls = self._make_store()
+        coord = Coordinate(0, 0, 0)
+        store.write_tile('old', coord, json_format, 'all')
+
+        def _locked(key, digest):
+            raise sqlite3.OperationalError('database is locked')
+        store.index.put = _locked
+
+        # the tile is still written, and its old digest dropped.
+        store.write_tile('new', coord, json_format, 'all')
+        self.assertEquals('new', store.store.tiles[coord])
+        self.assertEquals(0, store.index.num_entries)
+
+    def test_namespaced_keys(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import HashIndexedStore
+        from tilequeue.store import write_tile_if_changed
+
+        store, calls = self._make_store()
+        other = HashIndexedStore(store.store, store.index, 'other:')
+        coord = Coordinate(0, 0, 0)
+
+        write_tile_if_changed(store, 'data', coord, json_format, 'all')
+        self.assertEquals(dict(hits=0, misses=1), store.index_counts)
+        write_tile_if_changed(other, 'data', coord, json_format, 'all')
+        self.assertEquals(dict(hits=0, misses=1), other.index_counts)
+
+    def test_make_store_namespace(self):
+        from tilequeue.store import make_store
+        import os
+
+        def namespace(**kwargs):
+            cfg = {
+                'type': 'directory',
+                'name': os.path.join(self.dir_path, 'tiles'),
+                'hash-index': dict(
+                    path=os.path.join(self.dir_path, 'index.sqlite')),
+            }
+            cfg.update(kwargs)
+            return make_store(cfg).namespace
+
+        self.assertEquals(namespace(), namespace())
+        self.assertNotEquals(
+            namespace(), namespace(**{'date-prefix': '20180101'}))
+        self.assertNotEquals(
+            namespace(), namespace(name=os.path.join(self.dir_path, 'b')))
+
+    def test_existing_tiles_warm_index(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import write_tile_if_changed
+
+        store, calls = self._make_store()
+        coord = Coordinate(0, 0, 0)
+        # a tile which was in the store before the index was
+        store.store.tiles[coord] = 'data'
+
+        for _ in range(3):
+            self.assertFalse(write_tile_if_changed(
+                store, 'data', coord, json_format, 'all'))
+        self.assertEquals(['read'], calls)
+        self.assertEquals(dict(hits=2, misses=1), store.index_counts)
+
+    def test_delete_invalidates(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import write_tile_if_changed
+
+        store, calls = self._make_store()
+        coord = Coordinate(0, 0, 0)
+
+        write_tile_if_changed(store, 'data', coord, json_format, 'all')
+        store.delete_tiles([coord], json_format, 'all')
+        del calls[:]
+        self.assertTrue(write_tile_if_changed(
+            store, 'data', coord, json_format, 'all'))
+        self.assertEquals(['read', 'write'], calls)
+
+
+class MBTilesTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_store(self, dedupe=True):
+        from tilequeue.store import make_store
+        import os
+        return make_store({
+            'type': 'mbtiles',
+            'name': os.path.join(self.dir_path, str(dedupe)),
+            'dedupe': dedupe,
+            'batch-size': 2,
+        })
+
+    def test_write_read_delete(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import mvt_format
+
+        for dedupe in (True, False):
+            store = self._make_store(dedupe)
+            coord_1 = Coordinate(zoom=3, column=2, row=1)
+            coord_2 = Coordinate(zoom=3, column=2, row=2)
+
+            self.assertIsNone(store.read_tile(coord_1, json_format, 'all'))
+            store.write_tile('tile1', coord_1, json_format, 'all')
+            store.write_tile('tile2', coord_2, json_format, 'all')
+            store.write_tile('mvt1', coord_1, mvt_format, 'all')
+            store.write_tile('tile1b', coord_1, json_format, 'all')
+
+            self.assertEquals(
+                'tile1b', store.read_tile(coord_1, json_format, 'all'))
+            self.assertEquals(
+                'tile2', store.read_tile(coord_2, json_format, 'all'))
+            self.assertEquals(
+                'mvt1', store.read_tile(coord_1, mvt_format, 'all'))
+            self.assertEquals(
+                set([coord_1, coord_2]),
+                set(store.list_tiles(json_format, 'all')))
+
+            self.assertEquals(
+                1, store.delete_tiles([coord_1], json_format, 'all'))
+            self.assertIsNone(store.read_tile(coord_1, json_format, 'all'))
+            self.assertEquals(
+                [coord_2], list(store.list_tiles(json_format, 'all')))
+            store.delete_tiles([coord_2], json_format, 'all')
+            store.delete_tiles([coord_1], mvt_format, 'all')
+            store.flush()
+            self.assertEquals(
+                dedupe, store.files[('all', 'json')].dedupe)
+
+    def test_mbtiles_layout(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        import os
+        import sqlite3
+
+        store = self._make_store()
+        coord = Coordinate(zoom=3, column=2, row=1)
+        store.write_tile('tile', coord, json_format, 'all')
+        store.flush()
+
+        conn = sqlite3.connect(
+            os.path.join(self.dir_path, 'True', 'all.json.mbtiles'))
+        rows = conn.execute(
+            'SELECT zoom_level, tile_column, tile_row, tile_data '
+            'FROM tiles').fetchall()
+        # rows are flipped, as in TMS
+        self.assertEquals([(3, 2, 6, 'tile')],
+                          [(z, x, y, str(d)) for z, x, y, d in rows])
+        metadata = dict(conn.execute('SELECT name, value FROM metadata'))
+        self.assertEquals('application/json', metadata['format'])
+
+    def test_format_metadata(self):
+        from tilequeue.format import json_format
+        from tilequeue.format import mvt_format
+        from tilequeue.format import mvtb_format
+        from tilequeue.format import vtm_format
+        from tilequeue.format import zip_format
+        from tilequeue.store import mbtiles_format
+        self.assertEquals('pbf', mbtiles_format(mvt_format))
+        self.assertEquals('pbf', mbtiles_format(mvtb_format))
+        self.assertEquals('application/json', mbtiles_format(json_format))
+        self.assertEquals('application/x-protobuf', mbtiles_format(vtm_format))
+        self.assertEquals('application/zip', mbtiles_format(zip_format))
+
+    def test_dedupe(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import calc_tile_digest
+
+        store = self._make_store()
+        coords = [Coordinate(zoom=3, column=x, row=0) for x in range(4)]
+        for coord in coords:
+            store.write_tile('ocean', coord, json_format, 'all')
+        store.write_tile('land', coords[0], json_format, 'all')
+
+        mbtiles = store.files[('all', 'json')]
+        self.assertEquals(2, mbtiles.conn.execute(
+            'SELECT COUNT(*) FROM images').fetchone()[0])
+        self.assertEquals(
+            calc_tile_digest('ocean', json_format),
+            store.tile_digest(coords[1], json_format, 'all'))
+
+        # images no longer referred to are removed
+        store.delete_tiles(coords[1:], json_format, 'all')
+        self.assertEquals(1, mbtiles.conn.execute(
+            'SELECT COUNT(*) FROM images').fetchone()[0])
+
+    def test_dedupe_by_bytes(self):
+        from tilequeue.format import zip_format
+
+        store = self._make_store()
+        mbtiles = store._file(zip_format, 'all', True)
+
+        # tiles with the same digest but different bytes, as a collision of
+        # metatile digests would give, keep their own data.
+        mbtiles.write(3, 0, 0, 'first', 'digest')
+        mbtiles.write(3, 1, 0, 'second', 'digest')
+        self.assertEquals('first', mbtiles.read(3, 0, 0))
+        self.assertEquals('second', mbtiles.read(3, 1, 0))
+        self.assertEquals('digest', mbtiles.digest(3, 1, 0))
+
+    def test_concurrent_writes(self):
+        from ModestMaps.Core import Coordinate
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.format import json_format
+
+        store = self._make_store()
+        coords = [Coordinate(zoom=8, column=x, row=x) for x in range(200)]
+        pool = ThreadPool(8)
+        pool.map(lambda c: store.write_tile(
+            str(c.column), c, json_format, 'all'), coords)
+        pool.close()
+        pool.join()
+        store.flush()
+        for coord in coords:
+            self.assertEquals(
+                str(coord.column), store.read_tile(coord, json_format, 'all'))
+
+
+class MemoryTest(unittest.TestCase):
+
+    def _coord(self, x):
+        from ModestMaps.Core import Coordinate
+        return Coordinate(zoom=10, column=x, row=0)
+
+    def test_store_interface(self):
+        from tilequeue.format import json_format
+        from tilequeue.format import mvt_format
+        from tilequeue.store import make_store
+
+        store = make_store(dict(type='memory'))
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        store.write_tile('b', self._coord(1), json_format, 'all')
+        store.write_tile('c', self._coord(0), mvt_format, 'all')
+        store.write_tile('d', self._coord(0), json_format, 'other')
+
+        self.assertEquals(
+            'a', store.read_tile(self._coord(0), json_format, 'all'))
+        self.assertEquals(
+            'c', store.read_tile(self._coord(0), mvt_format, 'all'))
+        self.assertIsNone(
+            store.read_tile(self._coord(1), mvt_format, 'all'))
+        self.assertEquals(
+            set([self._coord(0), self._coord(1)]),
+            set(store.list_tiles(json_format, 'all')))
+
+        self.assertEquals(1, store.delete_tiles(
+            [self._coord(0), self._coord(2)], json_format, 'all'))
+        self.assertIsNone(
+            store.read_tile(self._coord(0), json_format, 'all'))
+        self.assertEquals(
+            [self._coord(1)], list(store.list_tiles(json_format, 'all')))
+        self.assertEquals(3, store.num_bytes)
+        self.assertEquals(dict(hits=2, misses=2, evictions=0), store.counts)
+
+    def test_lru_eviction(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import Memory
+
+        store = Memory(max_bytes=30)
+        for x in range(3):
+            store.write_tile('x' * 10, self._coord(x), json_format, 'all')
+        # reading makes 0 the most recently used, so 1 is evicted next.
+        store.read_tile(self._coord(0), json_format, 'all')
+        store.write_tile('y' * 10, self._coord(3), json_format, 'all')
+
+        self.assertIsNone(store.read_tile(self._coord(1), json_format, 'all'))
+        for x in (0, 2, 3):
+            self.assertIsNotNone(
+                store.read_tile(self._coord(x), json_format, 'all'))
+        self.assertEquals(30, store.num_bytes)
+        self.assertEquals(1, store.counts['evictions'])
+
+        # a tile bigger than the budget isn't kept, and doesn't evict others
+        store.write_tile('z' * 31, self._coord(4), json_format, 'all')
+        self.assertIsNone(store.read_tile(self._coord(4), json_format, 'all'))
+        self.assertEquals(30, store.num_bytes)
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.format import json_format
+        from tilequeue.store import Memory
+
+        store = Memory(max_bytes=1000)
+
+        def write_and_read(x):
+            store.write_tile('x' * 10, self._coord(x), json_format, 'all')
+            store.read_tile(self._coord(x), json_format, 'all')
+
+        pool = ThreadPool(8)
+        pool.map(write_and_read, range(1000))
+        pool.close()
+        pool.join()
+
+        self.assertEquals(1000, store.num_bytes)
+        self.assertEquals(100, len(list(store.list_tiles(json_format, 'all'))))
+        self.assertEquals(900, store.counts['evictions'])
+
+
+class TieredTest(unittest.TestCase):
+
+    def _coord(self, x):
+        from ModestMaps.Core import Coordinate
+        return Coordinate(zoom=10, column=x, row=0)
+
+    def _make_store(self, **kwargs):
+        from tilequeue.store import Memory
+        from tilequeue.store import Tiered
+        tiers = [Memory(max_bytes=100), Memory()]
+        return Tiered(tiers, ['cache', 'backing'], **kwargs), tiers
+
+    def test_read_through(self):
+        from tilequeue.format import json_format
+
+        store, (cache, backing) = self._make_store()
+        backing.write_tile('a', self._coord(0), json_format, 'all')
+
+        self.assertEquals(
+            'a', store.read_tile(self._coord(0), json_format, 'all'))
+        self.assertEquals(
+            'a', cache.read_tile(self._coord(0), json_format, 'all'))
+        self.assertEquals(
+            'a', store.read_tile(self._coord(0), json_format, 'all'))
+        self.assertIsNone(
+            store.read_tile(self._coord(1), json_format, 'all'))
+
+        cache_stats, backing_stats = store.tier_stats()
+        self.assertEquals('cache', cache_stats['name'])
+        self.assertEquals(1, cache_stats['hits'])
+        self.assertEquals(2, cache_stats['misses'])
+        self.assertEquals(1.0 / 3, cache_stats['hit_ratio'])
+        self.assertEquals(1, backing_stats['hits'])
+        self.assertEquals(1, backing_stats['misses'])
+        self.assertIsNotNone(backing_stats['read_millis'])
+
+    def test_tile_digest_stats(self):
+        from tilequeue.format import json_format
+
+        ops = []
+
+        def _stats_handler(tier_name, op, millis, hit):
+            ops.append((tier_name, op, hit))
+
+        store, (cache, backing) = self._make_store(
+            stats_handler=_stats_handler)
+        # the backing tier can find digests without reading the tile.
+        backing.tile_digest = lambda coord, format, layer: 'digest'
+        self.assertEquals(
+            'digest', store.tile_digest(self._coord(0), json_format, 'all'))
+        self.assertEquals(
+            [('cache', 'read_tile', False),
+             ('backing', 'tile_digest', True)], ops)
+
+        cache_stats, backing_stats = store.tier_stats()
+        self.assertEquals(1, cache_stats['misses'])
+        self.assertEquals(1, backing_stats['hits'])
+        self.assertIsNotNone(backing_stats['digest_millis'])
+
+    def test_tier_stats_handler(self):
+        from tilequeue.format import json_format
+        from tilequeue.stats import TierStatsHandler
+        from tilequeue.store import make_store
+
+        calls = []
+
+        class Pipeline(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def timing(self, name, value):
+                calls.append(('timing', name))
+
+            def incr(self, name, value=1):
+                calls.append(('incr', name))
+
+        class Stats(object):
+            def pipeline(self):
+                return Pipeline()
+
+        store = make_store(
+            dict(type='tiered', tiers=[dict(type='memory')]),
+            tier_stats_handler=TierStatsHandler(Stats()))
+        store.read_tile(self._coord(0), json_format, 'all')
+        self.assertEquals(
+            [('timing', 'store.tier.0-memory.read_tile.time'),
+             ('incr', 'store.tier.0-memory.read_tile.misses')], calls)
+
+    def test_write_through(self):
+        from tilequeue.format import json_format
+
+        store, tiers = self._make_store()
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        for tier in tiers:
+            self.assertEquals(
+                'a', tier.read_tile(self._coord(0), json_format, 'all'))
+
+    def test_write_back(self):
+        from tilequeue.format import json_format
+
+        store, (cache, backing) = self._make_store(
+            write_policy='back', write_back_batch_size=3)
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        store.write_tile('b', self._coord(1), json_format, 'all')
+        self.assertEquals(
+            [], list(backing.list_tiles(json_format, 'all')))
+        self.assertEquals(
+            'a', store.read_tile(self._coord(0), json_format, 'all'))
+
+        # a third tile fills the batch, and all are written back.
+        store.write_tile('c', self._coord(2), json_format, 'all')
+        self.assertEquals(
+            set(self._coord(x) for x in range(3)),
+            set(backing.list_tiles(json_format, 'all')))
+
+        store.write_tile('d', self._coord(3), json_format, 'all')
+        store.flush()
+        self.assertEquals(
+            'd', backing.read_tile(self._coord(3), json_format, 'all'))
+
+    def test_write_back_flushed_at_exit(self):
+        from mock import patch
+        from tilequeue.format import json_format
+
+        with patch('tilequeue.store.atexit.register') as register:
+            store, (cache, backing) = self._make_store(write_policy='back')
+        register.assert_called_once_with(store.flush)
+
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        self.assertIsNone(
+            backing.read_tile(self._coord(0), json_format, 'all'))
+
+        # what the atexit hook does when the interpreter exits
+        exit_func = register.call_args[0][0]
+        exit_func()
+        self.assertEquals(
+            'a', backing.read_tile(self._coord(0), json_format, 'all'))
+
+    def test_flush_store(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import InstrumentedStore
+        from tilequeue.store import Memory
+        from tilequeue.store import flush_store
+
+        store, (cache, backing) = self._make_store(write_policy='back')
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        flush_store(InstrumentedStore(store))
+        self.assertEquals(
+            'a', backing.read_tile(self._coord(0), json_format, 'all'))
+
+        # stores without flush are left alone
+        flush_store(Memory())
+
+    def test_flushed_when_storage_stops(self):
+        from Queue import Queue
+        from tilequeue.format import json_format
+        from tilequeue.worker import S3Storage
+        import threading
+
+        class Logger(object):
+            def lifecycle(self, msg):
+                pass
+
+        store, (cache, backing) = self._make_store(write_policy='back')
+        store.write_tile('a', self._coord(0), json_format, 'all')
+
+        input_queue = Queue()
+        input_queue.put(None)
+        storage = S3Storage(input_queue, Queue(), None, store, Logger(), None)
+        storage(threading.Event())
+        self.assertEquals(
+            'a', backing.read_tile(self._coord(0), json_format, 'all'))
+
+    def test_delete_invalidates(self):
+        from tilequeue.format import json_format
+
+        store, (cache, backing) = self._make_store(write_policy='back')
+        store.write_tile('a', self._coord(0), json_format, 'all')
+        store.write_tile('b', self._coord(1), json_format, 'all')
+        store.flush()
+        store.write_tile('c', self._coord(2), json_format, 'all')
+
+        self.assertEquals(2, store.delete_tiles(
+            [self._coord(0), self._coord(1), self._coord(2)], json_format,
+            'all'))
+        for x in range(3):
+            self.assertIsNone(
+                store.read_tile(self._coord(x), json_format, 'all'))
+        store.flush()
+        self.assertEquals([], list(backing.list_tiles(json_format, 'all')))
+
+    def test_make_store(self):
+        from tilequeue.store import Memory
+        from tilequeue.store import Tiered
+        from tilequeue.store import make_store
+
+        store = make_store(dict(
+            type='tiered',
+            tiers=[dict(type='memory'), dict(type='memory')],
+        ))
+        self.assertTrue(isinstance(store, Tiered))
+        self.assertEquals(2, len(store.tiers))
+        self.assertTrue(all(isinstance(t, Memory) for t in store.tiers))
+        self.assertEquals(
+            ['0-memory', '1-memory'],
+            [stats['name'] for stats in store.tier_stats()])
+
+        with self.assertRaises(ValueError):
+            make_store(dict(type='tiered', tiers=[dict(type='memory')],
+                            **{'write-policy': 'around'}))
+
+    def test_make_store_hash_index_write_back(self):
+        from tilequeue.store import make_store
+        import os
+        import shutil
+        import tempfile
+
+        dir_path = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(ValueError):
+                make_store({
+                    'type': 'tiered',
+                    'tiers': [dict(type='memory'), dict(type='memory')],
+                    'write-policy': 'back',
+                    'hash-index': dict(
+                        path=os.path.join(dir_path, 'index.sqlite')),
+                })
+        finally:
+            shutil.rmtree(dir_path)
+
+
+class InstrumentedStoreTest(unittest.TestCase):
+
+    def _make_store(self, store):
+        from tilequeue.store import InstrumentedStore
+
+        ops = []
+
+        def stats_handler(*args):
+            ops.append(args)
+
+        return InstrumentedStore(store, stats_handler), ops
+
+    def test_operations(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import Memory
+
+        store, ops = self._make_store(Memory())
+        coord = Coordinate(zoom=3, column=1, row=2)
+        store.write_tile('data', coord, json_format, 'all')
+        self.assertEquals('data', store.read_tile(coord, json_format, 'all'))
+        self.assertIsNone(store.read_tile(
+            Coordinate(zoom=4, column=1, row=2), json_format, 'all'))
+        self.assertEquals(1, store.delete_tiles(
+            [coord, Coordinate(zoom=4, column=0, row=0)], json_format,
+            'all'))
+        # passed through to the wrapped store
+        self.assertEquals(dict(hits=1, misses=1, evictions=0), store.counts)
+        self.assertFalse(hasattr(store, 'tile_digest'))
+
+        self.assertEquals(
+            [('write_tile', 'json', 3, 0, 4, 0, None),
+             ('read_tile', 'json', 3, 4, 0, 0, None),
+             ('read_tile', 'json', 4, 0, 0, 0, None),
+             ('delete_tiles', 'json', 'mixed', 0, 0, 0, None)],
+            [(op, ext, zoom, bytes_in, bytes_out, retries, error_class)
+             for op, ext, zoom, millis, bytes_in, bytes_out, retries,
+             error_class in ops])
+
+    def test_retries_and_errors(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import mvt_format
+        from tilequeue.store import _backoff_and_retry
+
+        class FlakyStore(object):
+            def __init__(self):
+                self.failures = 2
+
+            def write_tile(self, tile_data, coord, format, layer):
+                @_backoff_and_retry(IOError, num_tries=3, retry_interval=0)
+                def write():
+                    if self.failures:
+                        self.failures -= 1
+                        raise IOError('flaky')
+                write()
+
+            def read_tile(self, coord, format, layer):
+                raise KeyError('broken')
+
+            def tile_digest(self, coord, format, layer):
+                return 'digest'
+
+        store, ops = self._make_store(FlakyStore())
+        coord = Coordinate(zoom=5, column=1, row=2)
+        store.write_tile('data', coord, mvt_format, 'all')
+        with self.assertRaises(KeyError):
+            store.read_tile(coord, mvt_format, 'all')
+        self.assertEquals(
+            'digest', store.tile_digest(coord, mvt_format, 'all'))
+
+        self.assertEquals(
+            [('write_tile', 2, None),
+             ('read_tile', 0, 'KeyError'),
+             ('tile_digest', 0, None)],
+            [(op[0], op[6], op[7]) for op in ops])
+
+    def test_stats_and_log(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.log import JsonStoreLogger
+        from tilequeue.stats import StoreStatsHandler
+        from tilequeue.store import InstrumentedStore
+        from tilequeue.store import Memory
+        import json
+        import logging
+
+        class Pipeline(object):
+            def __init__(self, calls):
+                self.calls = calls
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def timing(self, name, value):
+                self.calls.append(('timing', name))
+
+            def incr(self, name, value=1):
+                self.calls.append(('incr', name, value))
+
+        class Stats(object):
+            def __init__(self):
+                self.calls = []
+
+            def pipeline(self):
+                return Pipeline(self.calls)
+
+        class Logger(object):
+            def __init__(self):
+                self.lines = []
+                self.level = logging.DEBUG
+
+            def isEnabledFor(self, level):
+                return level >= self.level
+
+            def log(self, level, msg):
+                self.lines.append((level, msg))
+
+        stats = Stats()
+        logger = Logger()
+        store = InstrumentedStore(
+            Memory(), StoreStatsHandler(stats), JsonStoreLogger(logger))
+        coord = Coordinate(zoom=3, column=1, row=2)
+        store.write_tile('data', coord, json_format, 'all')
+
+        self.assertEquals(
+            [('timing', 'store.write_tile.json.3.time'),
+             ('incr', 'store.write_tile.json.3.bytes_out', 4)],
+            stats.calls)
+        self.assertEquals(1, len(logger.lines))
+        log_obj = json.loads(logger.lines[0][1])
+        self.assertEquals('store', log_obj['category'])
+        self.assertEquals('write_tile', log_obj['op'])
+        self.assertEquals(dict(z=3, x=1, y=2), log_obj['coord'])
+        self.assertEquals(4, log_obj['bytes_out'])
+
+        # operations below the logger's level aren't logged.
+        logger.level = logging.INFO
+        store.write_tile('data', coord, json_format, 'all')
+        self.assertEquals(1, len(logger.lines))
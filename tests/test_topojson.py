@@ -0,0 +1,102 @@
+import unittest
+
+
+def _decode_arc(arcs, index):
+    if index < 0:
+        return list(reversed(_decode_arc(arcs, ~index)))
+    x = y = 0
+    points = []
+    for dx, dy in arcs[index]:
+        x += dx
+        y += dy
+        points.append((x, y))
+    return points
+
+
+def _decode_path(arcs, refs):
+    points = []
+    for ref in refs:
+        arc = _decode_arc(arcs, ref)
+        # arcs which follow on from each other share their end points
+        points.extend(arc if not points else arc[1:])
+    return points
+
+
+class TestTopojsonEncode(unittest.TestCase):
+
+    def _encode(self, features_by_layer):
+        from StringIO import StringIO
+        from tilequeue.format.topojson import encode
+        import json
+        out = StringIO()
+        encode(out, features_by_layer, (0, 0, 4096, 4096), 4096)
+        return json.loads(out.getvalue())
+
+    def _decode_polygon(self, arcs, geometry):
+        from shapely.geometry import Polygon
+        rings = [_decode_path(arcs, refs) for refs in geometry['arcs']]
+        return Polygon(rings[0], rings[1:])
+
+    def test_shared_boundary(self):
+        from shapely.geometry import box
+        left = box(0, 0, 10, 10)
+        right = box(10, 0, 20, 10)
+        # the whole of the hole is filled by the inner polygon
+        outer = box(30, 0, 60, 30).difference(box(40, 10, 50, 20))
+        inner = box(40, 10, 50, 20)
+        topology = self._encode(dict(landuse=[
+            (left, {}, 1), (right, {}, 2), (outer, {}, 3), (inner, {}, 4)]))
+
+        arcs = topology['arcs']
+        geometries = topology['objects']['landuse']['geometries']
+        for geometry, shape in zip(geometries, (left, right, outer, inner)):
+            self.assertEqual('Polygon', geometry['type'])
+            self.assertTrue(
+                shape.equals(self._decode_polygon(arcs, geometry)))
+
+        def _arc_indexes(refs):
+            return set(ref if ref >= 0 else ~ref for ref in refs)
+
+        # the edge between left and right is one arc, used in opposite
+        # directions, and the hole and the inner polygon share their ring.
+        left_refs = set(geometries[0]['arcs'][0])
+        right_refs = set(geometries[1]['arcs'][0])
+        shared = [ref for ref in left_refs if ~ref in right_refs]
+        self.assertEqual(1, len(shared))
+        self.assertEqual(
+            _arc_indexes(geometries[2]['arcs'][1]),
+            _arc_indexes(geometries[3]['arcs'][0]))
+        # 3 arcs for the two boxes, one for each ring of the others.
+        self.assertEqual(5, len(arcs))
+
+    def test_lines_and_points(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import Point
+        road = LineString([(0, 0), (0.2, 0.2), (10, 0), (20, 5)])
+        branch = MultiLineString([[(10, 0), (10, 10)], [(20, 5), (10, 0)]])
+        topology = self._encode(dict(roads=[
+            (road, dict(kind='major'), 7),
+            (branch, {}, None),
+            (Point(1.6, 2.4), {}, 8),
+            (MultiPoint([(1, 1), (2, 2)]), {}, None),
+        ]))
+
+        arcs = topology['arcs']
+        road_json, branch_json, point_json, multi_json = \
+            topology['objects']['roads']['geometries']
+        self.assertEqual(7, road_json['id'])
+        self.assertEqual(dict(kind='major'), road_json['properties'])
+        self.assertEqual(
+            [(0, 0), (10, 0), (20, 5)],
+            _decode_path(arcs, road_json['arcs']))
+        self.assertEqual(
+            [[(10, 0), (10, 10)], [(20, 5), (10, 0)]],
+            [_decode_path(arcs, refs) for refs in branch_json['arcs']])
+        # the last part of the branch is the same as the end of the road
+        self.assertTrue(branch_json['arcs'][1][0] < 0)
+        self.assertEqual('Point', point_json['type'])
+        self.assertEqual(8, point_json['id'])
+        self.assertEqual([2, 2], point_json['coordinates'])
+        self.assertEqual([[1, 1], [2, 2]], multi_json['coordinates'])
@@ -0,0 +1,129 @@
+import unittest
+
+
+class TestLngLatProjection(unittest.TestCase):
+
+    def test_cache_projects_once(self):
+        from shapely.geometry import LineString
+        from tilequeue.transform import LngLatProjectionCache
+
+        cache = LngLatProjectionCache()
+        shape = LineString([(0, 0), (100000, 100000)])
+        projected = cache(shape)
+        self.assertIs(projected, cache(shape))
+        self.assertAlmostEqual(0.898315, projected.coords[1][0], 6)
+
+
+class TestClipToRect(unittest.TestCase):
+
+    bounds = (0.0, 0.0, 100.0, 100.0)
+
+    def _corpus(self):
+        from random import Random
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        import math
+
+        rnd = Random(42)
+
+        def _pt():
+            return rnd.uniform(-50, 150), rnd.uniform(-50, 150)
+
+        def _star(cx, cy, n, r_in, r_out):
+            coords = []
+            for i in xrange(2 * n):
+                r = r_out if i % 2 == 0 else r_in
+                a = math.pi * i / n
+                coords.append((cx + r * math.cos(a), cy + r * math.sin(a)))
+            return Polygon(coords)
+
+        shapes = []
+        for i in xrange(200):
+            kind = i % 6
+            if kind == 0:
+                shapes.append(LineString([_pt() for _ in xrange(10)]))
+            elif kind == 1:
+                shapes.append(MultiLineString(
+                    [[_pt(), _pt(), _pt()] for _ in xrange(3)]))
+            elif kind == 2:
+                x, y = _pt()
+                shapes.append(Point(x, y).buffer(rnd.uniform(5, 80)))
+            elif kind == 3:
+                x, y = _pt()
+                shapes.append(_star(x, y, rnd.randint(3, 12),
+                                    rnd.uniform(5, 30), rnd.uniform(30, 90)))
+            elif kind == 4:
+                x, y = _pt()
+                outer = Point(x, y).buffer(60)
+                hole = Point(x + rnd.uniform(-20, 20),
+                             y + rnd.uniform(-20, 20)).buffer(15)
+                shapes.append(outer.difference(hole))
+            else:
+                parts = []
+                for _ in xrange(3):
+                    x, y = _pt()
+                    parts.append(Point(x, y).buffer(rnd.uniform(5, 20)))
+                shapes.append(MultiPolygon(
+                    [p for p in parts if p.is_valid]).buffer(0))
+        # shapes on and along the bounds
+        shapes.append(LineString([(0, -10), (0, 110)]))
+        shapes.append(LineString([(-10, 50), (50, 50), (50, 150)]))
+        shapes.append(Polygon([(0, 0), (100, 0), (100, 100), (0, 100)]))
+        shapes.append(Polygon([(-10, 50), (50, -10), (110, 50), (50, 110)]))
+        # a vertex on the bounds with both neighbours inside, which would
+        # make the shell touch itself if the polygon was cut there.
+        shapes.append(Polygon([(-25, 5), (50, 5), (50, 25), (15, 25), (0, 30),
+                               (15, 35), (50, 35), (50, 55), (-25, 55)]))
+        # a hole with an edge on the bounds, which the clipped shell would
+        # then run along.
+        shapes.append(Polygon([(50, 10), (150, 10), (150, 90), (50, 90)],
+                              [[(60, 20), (100, 20), (100, 40), (60, 40)]]))
+        return shapes
+
+    def test_matches_geos(self):
+        from shapely.geometry import box
+        from tilequeue.transform import clip_to_rect
+
+        rect = box(*self.bounds)
+        for shape in self._corpus():
+            expected = shape.intersection(rect)
+            actual = clip_to_rect(shape, self.bounds)
+            self.assertEqual(expected.is_empty, actual.is_empty)
+            if expected.is_empty:
+                continue
+            if 'Polygon' in shape.type:
+                self.assertTrue(actual.is_valid)
+                diff = expected.symmetric_difference(actual)
+                self.assertAlmostEqual(0, diff.area, 6)
+            else:
+                self.assertAlmostEqual(expected.length, actual.length, 6)
+                self.assertTrue(actual.buffer(1e-6).contains(expected))
+
+    def test_vertex_on_bounds(self):
+        from shapely.geometry import Polygon
+        from tilequeue.transform import clip_to_rect
+
+        shape = Polygon([(-5, 0), (10, 0), (10, 4), (3, 4), (0, 5), (3, 6),
+                         (10, 6), (10, 10), (-5, 10)])
+        bounds = (0, -1, 20, 20)
+        clipped = clip_to_rect(shape, bounds)
+        self.assertTrue(clipped.is_valid)
+        self.assertAlmostEqual(
+            shape.intersection(Polygon.from_bounds(*bounds)).area,
+            clipped.area, 6)
+
+    def test_hole_on_bounds(self):
+        from shapely.geometry import Polygon
+        from tilequeue.transform import clip_to_rect
+
+        shape = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)],
+                        [[(2, 2), (5, 2), (5, 4), (2, 4)]])
+        bounds = (0, 0, 5, 10)
+        clipped = clip_to_rect(shape, bounds)
+        self.assertTrue(clipped.is_valid)
+        self.assertAlmostEqual(
+            shape.intersection(Polygon.from_bounds(*bounds)).area,
+            clipped.area, 6)
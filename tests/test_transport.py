@@ -0,0 +1,59 @@
+import unittest
+
+
+class TestMmapTransport(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.arena_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.arena_path)
+
+    def _make_transport(self):
+        from tilequeue.transport import MmapTransport
+        return MmapTransport(self.arena_path)
+
+    def test_round_trip(self):
+        import os
+        transport = self._make_transport()
+        rows = [
+            dict(__id__=1, __geometry__='\x01\x02\x03' * 1000,
+                 __properties__=dict(kind='water')),
+            dict(__id__=2, __geometry__='\x00' * 10,
+                 __properties__={}),
+        ]
+        payload, size = transport.put(rows)
+        self.assertTrue(size > 0)
+        self.assertEqual(size, payload.size)
+        self.assertEqual(1, len(os.listdir(self.arena_path)))
+
+        self.assertEqual(rows, transport.take(payload))
+        # the arena is freed once the rows have been taken
+        self.assertEqual([], os.listdir(self.arena_path))
+
+    def test_release(self):
+        import os
+        transport = self._make_transport()
+        payload, size = transport.put([dict(__id__=1)])
+        self.assertEqual(1, len(os.listdir(self.arena_path)))
+        transport.release(payload)
+        self.assertEqual([], os.listdir(self.arena_path))
+
+
+class TestMakeTransport(unittest.TestCase):
+
+    def test_default_is_queue(self):
+        from tilequeue.transport import make_source_rows_transport
+        transport = make_source_rows_transport(None)
+        self.assertEqual('queue', transport.name)
+        rows = [dict(__id__=1)]
+        payload, size = transport.put(rows)
+        self.assertIsNone(size)
+        self.assertIs(rows, transport.take(payload))
+
+    def test_unknown_type(self):
+        from tilequeue.transport import make_source_rows_transport
+        with self.assertRaises(ValueError):
+            make_source_rows_transport(dict(type='carrier-pigeon'))
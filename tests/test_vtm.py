@@ -0,0 +1,53 @@
+import unittest
+
+
+class TestShapeEncoder(unittest.TestCase):
+
+    def _merge(self, feature_layers):
+        from StringIO import StringIO
+        from tilequeue.format.vtm import merge
+        out = StringIO()
+        merge(out, feature_layers)
+        return out.getvalue()
+
+    def _assert_same_as_wkb(self, shapes):
+        props = dict(kind='park', name='Some Park', layer='2')
+        shape_layers = [dict(
+            name='landuse',
+            features=[(shape, props, i) for i, shape in enumerate(shapes)],
+        )]
+        wkb_layers = [dict(
+            name='landuse',
+            features=[(shape.wkb, props, i)
+                      for i, shape in enumerate(shapes)],
+        )]
+        self.assertEqual(self._merge(wkb_layers), self._merge(shape_layers))
+
+    def test_same_as_wkb(self):
+        from shapely.geometry import box
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        self._assert_same_as_wkb([
+            Point(10, 20),
+            Point(10.5, -2.5, 3),
+            MultiPoint([(1, 1), (1, 1), (2, 3), (2, 3), (1, 1)]),
+            LineString([(0, 0), (0, 0), (10, 10), (10, 10), (20, 0)]),
+            MultiLineString([[(0, 0), (5, 5)], [(5, 5), (5, 5), (9, 1)]]),
+            box(0, 0, 100, 100),
+            Polygon([(0, 0), (100, 0), (100, 100), (0, 100)],
+                    [[(10, 10), (20, 10), (20, 20), (10, 10)]]),
+            MultiPolygon([box(0, 0, 10, 10), box(20, 20, 30, 30)]),
+        ])
+
+    def test_random_lines(self):
+        from shapely.geometry import LineString
+        import random
+        rnd = random.Random(1)
+        self._assert_same_as_wkb([
+            LineString([(rnd.randint(-10, 4100), rnd.randint(-10, 4100))
+                        for _ in range(rnd.randint(2, 50))])
+            for _ in range(20)])
@@ -8,14 +8,17 @@ from random import randrange
 from tilequeue.config import create_query_bounds_pad_fn
 from tilequeue.config import make_config_from_argparse
 from tilequeue.format import lookup_format_by_extension
+from tilequeue.metatile import metatile_format
 from tilequeue.metro_extract import city_bounds
 from tilequeue.metro_extract import parse_metro_extract
 from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
 from tilequeue.query import DBConnectionPool
+from tilequeue.query import split_conn_info
 from tilequeue.query import make_data_fetcher
 from tilequeue.queue import make_sqs_queue
 from tilequeue.queue import make_visibility_manager
+from tilequeue.store import flush_store
 from tilequeue.store import make_store
 from tilequeue.tile import coord_children_range
 from tilequeue.tile import coord_int_zoom_up
@@ -34,6 +37,7 @@ from tilequeue.tile import tile_generator_for_single_bounds
 from tilequeue.tile import zoom_mask
 from tilequeue.toi import load_set_from_fp
 from tilequeue.toi import save_set_to_fp
+from tilequeue.transport import make_source_rows_transport
 from tilequeue.top_tiles import parse_top_tiles
 from tilequeue.utils import grouper
 from tilequeue.utils import parse_log_file
@@ -405,8 +409,18 @@ def _make_store(cfg, logger=None):
     credentials = cfg.subtree('aws credentials')
     if logger is None:
         logger = make_logger(cfg, 'process')
-    store = make_store(store_cfg, credentials=credentials, logger=logger)
-    return store
+    if not store_cfg.get('instrumented'):
+        return make_store(store_cfg, credentials=credentials, logger=logger)
+
+    from tilequeue.log import JsonStoreLogger
+    from tilequeue.stats import StoreStatsHandler
+    from tilequeue.stats import TierStatsHandler
+    from tilequeue.store import InstrumentedStore
+    stats = make_statsd_client_from_cfg(cfg)
+    store = make_store(store_cfg, credentials=credentials, logger=logger,
+                       tier_stats_handler=TierStatsHandler(stats))
+    return InstrumentedStore(
+        store, StoreStatsHandler(stats), JsonStoreLogger(logger))
 
 
 def explode_and_intersect(coord_ints, tiles_of_interest, until=0):
@@ -663,7 +677,8 @@ def tilequeue_process(cfg, peripherals):
     n_max_io_workers = 50
     n_io_workers = min(n_total_needed, n_max_io_workers)
     io_pool = ThreadPool(n_io_workers)
-    feature_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    feature_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, io_pool, peripherals.stats)
 
     # create all queues used to manage pipeline
 
@@ -699,18 +714,27 @@ def tilequeue_process(cfg, peripherals):
         tile_proc_logger, stats_handler, thread_tile_queue_reader_stop,
         cfg.max_zoom, cfg.group_by_zoom)
 
+    # how the fetched rows get from the data fetch threads to the data
+    # processor processes.
+    source_rows_transport = make_source_rows_transport(
+        cfg.source_rows_transport_cfg)
+    tile_proc_logger.lifecycle(
+        'source rows transport: %s' % source_rows_transport.name)
+
     data_fetch = DataFetch(
         feature_fetcher, tile_input_queue, sql_data_fetch_queue, io_pool,
         tile_proc_logger, stats_handler, cfg.metatile_zoom, cfg.max_zoom,
-        cfg.metatile_start_zoom)
+        cfg.metatile_start_zoom, source_rows_transport)
 
     data_processor = ProcessAndFormatData(
         post_process_data, formats, sql_data_fetch_queue, processor_queue,
         cfg.buffer_cfg, output_calc_mapping, layer_data, tile_proc_logger,
-        stats_handler)
+        stats_handler, source_rows_transport, cfg.cut_strategy,
+        cfg.simplify_geometry)
 
     s3_storage = S3Storage(processor_queue, s3_store_queue, io_pool, store,
-                           tile_proc_logger, cfg.metatile_size)
+                           tile_proc_logger, cfg.metatile_size,
+                           cfg.metatile_container, cfg.metatile_compress)
 
     thread_tile_writer_stop = threading.Event()
     tile_queue_writer = TileQueueWriter(
@@ -1145,31 +1169,31 @@ def tilequeue_consume_tile_traffic(cfg, peripherals):
         logger.info("Couldn't parse log file")
         sys.exit(1)
 
-    conn_info = dict(cfg.postgresql_conn_info)
-    dbnames = conn_info.pop('dbnames')
-    sql_conn_pool = DBConnectionPool(dbnames, conn_info, False)
-    sql_conn = sql_conn_pool.get_conns(1)[0]
-    with sql_conn.cursor() as cursor:
+    conn_info, settings = split_conn_info(cfg.postgresql_conn_info)
+    sql_conn_pool = DBConnectionPool(settings['dbnames'], conn_info, False)
+    with sql_conn_pool.get_conns(1) as sql_conns:
+        sql_conn = sql_conns[0]
+        with sql_conn.cursor() as cursor:
 
-        # insert the log records after the latest_date
-        cursor.execute('SELECT max(date) from tile_traffic_v4')
-        max_timestamp = cursor.fetchone()[0]
+            # insert the log records after the latest_date
+            cursor.execute('SELECT max(date) from tile_traffic_v4')
+            max_timestamp = cursor.fetchone()[0]
 
-        n_coords_inserted = 0
-        for host, timestamp, coord_int in tile_log_records:
-            if not max_timestamp or timestamp > max_timestamp:
-                coord = coord_unmarshall_int(coord_int)
-                cursor.execute(
-                    "INSERT into tile_traffic_v4 "
-                    "(date, z, x, y, tilesize, service, host) VALUES "
-                    "('%s', %d, %d, %d, %d, '%s', '%s')"
-                    % (timestamp, coord.zoom, coord.column, coord.row, 512,
-                       'vector-tiles', host))
-                n_coords_inserted += 1
+            n_coords_inserted = 0
+            for host, timestamp, coord_int in tile_log_records:
+                if not max_timestamp or timestamp > max_timestamp:
+                    coord = coord_unmarshall_int(coord_int)
+                    cursor.execute(
+                        "INSERT into tile_traffic_v4 "
+                        "(date, z, x, y, tilesize, service, host) VALUES "
+                        "('%s', %d, %d, %d, %d, '%s', '%s')"
+                        % (timestamp, coord.zoom, coord.column, coord.row,
+                           512, 'vector-tiles', host))
+                    n_coords_inserted += 1
 
-        logger.info('Inserted %d records' % n_coords_inserted)
+            logger.info('Inserted %d records' % n_coords_inserted)
 
-    sql_conn_pool.put_conns([sql_conn])
+    sql_conn_pool.closeall()
 
 
 def emit_toi_stats(toi_set, peripherals):
@@ -1544,7 +1568,7 @@ def tilequeue_stuck_tiles(cfg, peripherals):
     Check which files exist on s3 but are not in toi.
     """
     store = _make_store(cfg)
-    format = lookup_format_by_extension('zip')
+    format = metatile_format(cfg.metatile_container)
     layer = 'all'
 
     assert peripherals.toi, 'Missing toi'
@@ -1559,7 +1583,7 @@ def tilequeue_stuck_tiles(cfg, peripherals):
 def tilequeue_delete_stuck_tiles(cfg, peripherals):
     logger = make_logger(cfg, 'delete_stuck_tiles')
 
-    format = lookup_format_by_extension('zip')
+    format = metatile_format(cfg.metatile_container)
     layer = 'all'
 
     store = _make_store(cfg)
@@ -1599,7 +1623,7 @@ def tilequeue_tile_status(cfg, peripherals, args):
         toi = peripherals.toi.fetch_tiles_of_interest()
 
     # TODO: make these configurable!
-    tile_format = lookup_format_by_extension('zip')
+    tile_format = metatile_format(cfg.metatile_container)
     tile_layer = 'all'
     store = _make_store(cfg)
 
@@ -2018,8 +2042,7 @@ def tilequeue_batch_process(cfg, args):
     batch_logger.begin_run(queue_coord)
 
     layer = 'all'
-    zip_format = lookup_format_by_extension('zip')
-    assert zip_format
+    meta_format = metatile_format(cfg.metatile_container)
 
     job_coords = find_job_coords_for(queue_coord, group_by_zoom)
     for job_coord in job_coords:
@@ -2043,7 +2066,7 @@ def tilequeue_batch_process(cfg, args):
             unpadded_bounds = coord_to_mercator_bounds(coord)
 
             if check_metatile_exists:
-                existing_data = store.read_tile(coord, zip_format, layer)
+                existing_data = store.read_tile(coord, meta_format, layer)
                 if existing_data is not None:
                     batch_logger.metatile_already_exists(coord)
                     continue
@@ -2071,7 +2094,10 @@ def tilequeue_batch_process(cfg, args):
                 continue
 
             try:
-                tiles = make_metatiles(cfg.metatile_size, formatted_tiles)
+                tiles = make_metatiles(
+                    cfg.metatile_size, formatted_tiles,
+                    container=cfg.metatile_container,
+                    compress=cfg.metatile_compress)
                 for tile in tiles:
                     store.write_tile(
                         tile['tile'], tile['coord'], tile['format'],
@@ -2084,6 +2110,7 @@ def tilequeue_batch_process(cfg, args):
 
         batch_logger.end_pyramid(job_coord)
 
+    flush_store(store)
     batch_logger.end_run(queue_coord)
 
 
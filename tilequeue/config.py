@@ -102,9 +102,13 @@ class Configuration(object):
         self.query_cfg = process_cfg['query-config']
         self.template_path = process_cfg['template-path']
         self.reload_templates = process_cfg['reload-templates']
+        self.prepared_queries = process_cfg['prepared-queries']
         self.output_formats = process_cfg['formats']
         self.buffer_cfg = process_cfg['buffer']
+        self.cut_strategy = process_cfg['cut-strategy']
+        self.simplify_geometry = process_cfg['simplify-geometry']
         self.process_yaml_cfg = process_cfg['yaml']
+        self.source_rows_transport_cfg = process_cfg['source-rows-transport']
 
         self.postgresql_conn_info = self.yml['postgresql']
         dbnames = self.postgresql_conn_info.get('dbnames')
@@ -118,6 +122,8 @@ class Configuration(object):
         self.metatile_size = self._cfg('metatile size')
         self.metatile_zoom = metatile_zoom_from_size(self.metatile_size)
         self.metatile_start_zoom = self._cfg('metatile start-zoom')
+        self.metatile_container = self._cfg('metatile container')
+        self.metatile_compress = self._cfg('metatile compress')
 
         self.max_zoom_with_changes = self._cfg('tiles max-zoom-with-changes')
         assert self.max_zoom_with_changes > self.metatile_zoom
@@ -163,6 +169,8 @@ def default_yml_config():
             'reduced-redundancy': False,
             'date-prefix': '',
             'delete-retry-interval': 60,
+            'hash-index': None,
+            'instrumented': False,
         },
         'aws': {
             'credentials': {
@@ -216,8 +224,15 @@ def default_yml_config():
             'query-config': None,
             'template-path': None,
             'reload-templates': False,
+            'prepared-queries': False,
             'formats': ['json'],
             'buffer': {},
+            'cut-strategy': 'flat',
+            'simplify-geometry': False,
+            'source-rows-transport': {
+                'type': 'queue',
+                'path': None,
+            },
             'yaml': {
                 'type': None,
                 'parse': {
@@ -248,6 +263,8 @@ def default_yml_config():
         'metatile': {
             'size': None,
             'start-zoom': 0,
+            'container': 'zip',
+            'compress': False,
         },
         'queue_buffer_size': {
             'sql': None,
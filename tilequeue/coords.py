@@ -0,0 +1,111 @@
+# array based coordinate transforms.
+#
+# shapely.ops.transform calls back into python for each vertex, unless the
+# function happens to work on sequences. the functions here instead take a
+# whole coordinate sequence as an (N, 2) numpy array and return the
+# transformed array, and map_coords rebuilds the geometry from those.
+#
+# this module doesn't import any of the formatters, so that they can use it
+# without an import cycle via tilequeue.transform.
+
+from shapely.geometry import LinearRing
+from shapely.geometry import LineString
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+import math
+import numpy
+
+
+half_circumference_meters = 20037508.342789244
+
+
+def coords_array(coords):
+    """
+    Return a coordinate sequence as an (N, 2) array of floats.
+    """
+
+    arr = numpy.array(coords, dtype=numpy.float64)
+    if arr.ndim == 2 and arr.shape[1] > 2:
+        # drop any z coordinates, as the scalar transforms do.
+        arr = arr[:, :2]
+    return arr
+
+
+def map_coords(fn, shape):
+    """
+    Return a copy of shape with its coordinates transformed by fn, which
+    is called once for each coordinate sequence (each line, ring or point)
+    with an (N, 2) array, and should return an array of the same shape.
+    """
+
+    if shape.is_empty:
+        return shape
+
+    geom_type = shape.type
+    if geom_type == 'Point':
+        return Point(fn(coords_array(shape.coords))[0])
+    elif geom_type == 'LineString':
+        return LineString(fn(coords_array(shape.coords)))
+    elif geom_type == 'LinearRing':
+        return LinearRing(fn(coords_array(shape.coords)))
+    elif geom_type == 'Polygon':
+        shell = fn(coords_array(shape.exterior.coords))
+        holes = [fn(coords_array(ring.coords))
+                 for ring in shape.interiors]
+        return Polygon(shell, holes)
+    elif geom_type.startswith('Multi') or \
+            geom_type == 'GeometryCollection':
+        return type(shape)([map_coords(fn, part) for part in shape.geoms])
+    else:
+        raise ValueError('Unsupported geometry type: %s' % geom_type)
+
+
+def mercator_to_lnglat(xy):
+    """
+    Project an array of mercator coordinates to lnglat, as
+    tilequeue.transform.mercator_point_to_lnglat does for a single point.
+    """
+
+    result = xy / half_circumference_meters
+    y = result[:, 1]
+    y[:] = (2 * numpy.arctan(numpy.exp(y * math.pi)) - (math.pi / 2)) / \
+        math.pi
+    result *= 180
+    return result
+
+
+def round_half_away(values):
+    # python 2's round() rounds halves away from zero, where numpy.round
+    # rounds them to even. match python, so that output doesn't change.
+    return numpy.copysign(numpy.floor(numpy.abs(values) + 0.5), values)
+
+
+def make_rescale(bounds, scale):
+    """
+    Return a function which rescales an array of coordinates within bounds
+    to integer coordinates from 0 to scale, as
+    tilequeue.transform.rescale_point does for a single point.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    factors = numpy.array([scale / (maxx - minx), scale / (maxy - miny)])
+    origin = numpy.array([minx, miny])
+
+    def rescale(xy):
+        return round_half_away((xy - origin) * factors)
+
+    return rescale
+
+
+def make_trim_precision(precision):
+    """
+    Return a function which rounds an array of coordinates to the given
+    number of decimal places.
+    """
+
+    factor = 10.0 ** precision
+
+    def trim_precision(xy):
+        return round_half_away(xy * factor) / factor
+
+    return trim_precision
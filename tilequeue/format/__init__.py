@@ -63,25 +63,10 @@ def format_topojson(fp, feature_layers, zoom, bounds_merc, bounds_lnglat,
 
 
 def format_mvt(fp, feature_layers, zoom, bounds_merc, bounds_lnglat, extents):
-    mvt_layers = []
-    for feature_layer in feature_layers:
-        mvt_features = []
-        for shape, props, feature_id in feature_layer['features']:
-            mvt_feature = dict(
-                geometry=shape,
-                properties=props,
-                id=feature_id,
-            )
-            mvt_features.append(mvt_feature)
-        mvt_layer = dict(
-            name=feature_layer['name'],
-            features=mvt_features,
-        )
-        mvt_layers.append(mvt_layer)
-    mvt_encode(fp, mvt_layers, bounds_merc, extents)
-
-
-def format_vtm(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
+    mvt_encode(fp, feature_layers, bounds_merc, extents)
+
+
+def format_vtm(fp, feature_layers, zoom, bounds_merc, bounds_lnglat, extents):
     vtm_encode(fp, feature_layers)
 
 
@@ -92,7 +77,7 @@ topojson_format = OutputFormat('TopoJSON', 'topojson', 'application/json',
                                format_topojson, 2, supports_shapely_geom)
 # TODO image/png mimetype? app doesn't work unless image/png?
 vtm_format = OutputFormat('OpenScienceMap', 'vtm', 'image/png', format_vtm, 3,
-                          not supports_shapely_geom)
+                          supports_shapely_geom)
 mvt_format = OutputFormat('MVT', 'mvt', 'application/x-protobuf',
                           format_mvt, 4, supports_shapely_geom)
 # buffered mvt - same exact format as mvt, exception for extension and
@@ -102,6 +87,9 @@ mvtb_format = OutputFormat('MVT Buffered', 'mvtb', 'application/x-protobuf',
 # package of tiles as a metatile zip
 zip_format = OutputFormat('ZIP Metatile', 'zip', 'application/zip',
                           None, None, None)
+# package of tiles as an indexed metatile, see tilequeue.metatile
+indexed_metatile_format = OutputFormat(
+    'Indexed Metatile', 'tqm', 'application/octet-stream', None, None, None)
 
 extension_to_format = dict(
     json=json_format,
@@ -109,7 +97,8 @@ extension_to_format = dict(
     vtm=vtm_format,
     mvt=mvt_format,
     mvtb=mvtb_format,
-    zip=zip_format
+    zip=zip_format,
+    tqm=indexed_metatile_format,
 )
 
 name_to_format = {
@@ -118,7 +107,8 @@ name_to_format = {
     'TopoJSON': topojson_format,
     'MVT': mvt_format,
     'MVT Buffered': mvtb_format,
-    'ZIP Metatile': zip_format
+    'ZIP Metatile': zip_format,
+    'Indexed Metatile': indexed_metatile_format,
 }
 
 
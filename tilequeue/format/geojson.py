@@ -1,8 +1,12 @@
 from math import ceil
 from math import log
+from shapely.geometry import Polygon
+from tilequeue.coords import coords_array
+from tilequeue.coords import make_trim_precision
+from tilequeue.coords import map_coords
+import numpy
 import ujson as json
 import shapely.geometry
-import shapely.ops
 import shapely.wkb
 
 precisions = [int(ceil(log(1 << zoom + 8+2) / log(10)) - 2)
@@ -11,13 +15,63 @@ precisions = [int(ceil(log(1 << zoom + 8+2) / log(10)) - 2)
 precisions[16] = 8
 
 
+def _polygon_rings(shape):
+    return [coords_array(shape.exterior.coords)] + \
+        [coords_array(ring.coords) for ring in shape.interiors]
+
+
+def _polygon_coordinates(shape, trim_precision):
+    # trimming the precision of a polygon can make it invalid, for example
+    # by collapsing a thin part, in which case the original is used.
+    rings = _polygon_rings(shape)
+    trimmed = [trim_precision(ring) for ring in rings]
+    if Polygon(trimmed[0], trimmed[1:]).is_valid:
+        rings = trimmed
+    return [ring.tolist() for ring in rings]
+
+
+def _geometry(shape, trim_precision):
+    """
+    Return the GeoJSON geometry of shape, with its coordinates rounded by
+    trim_precision.
+    """
+
+    geom_type = shape.type
+    if geom_type == 'Point':
+        coordinates = trim_precision(coords_array(shape.coords))[0].tolist()
+    elif geom_type == 'LineString':
+        coordinates = trim_precision(coords_array(shape.coords)).tolist()
+    elif geom_type == 'MultiPoint':
+        xy = numpy.array([point.coords[0][:2] for point in shape.geoms],
+                         dtype=numpy.float64)
+        coordinates = trim_precision(xy).tolist()
+    elif geom_type == 'MultiLineString':
+        coordinates = [trim_precision(coords_array(line.coords)).tolist()
+                       for line in shape.geoms]
+    elif geom_type == 'Polygon':
+        coordinates = _polygon_coordinates(shape, trim_precision)
+    elif geom_type == 'MultiPolygon':
+        trimmed_shape = map_coords(trim_precision, shape)
+        if trimmed_shape.is_valid:
+            shape = trimmed_shape
+        coordinates = [
+            [ring.tolist() for ring in _polygon_rings(polygon)]
+            for polygon in shape.geoms]
+    else:
+        trimmed_shape = map_coords(trim_precision, shape)
+        if trimmed_shape.is_valid:
+            shape = trimmed_shape
+        return shape.__geo_interface__
+
+    return dict(type=geom_type, coordinates=coordinates)
+
+
 class JsonFeatureCreator(object):
 
     def __init__(self, precision=None):
         self.precision = precision
-
-    def _trim_precision(self, x, y, z=None):
-        return round(x, self.precision), round(y, self.precision)
+        if precision:
+            self._trim_precision = make_trim_precision(precision)
 
     def __call__(self, feature):
         assert len(feature) == 3
@@ -27,24 +81,27 @@ class JsonFeatureCreator(object):
         else:
             shape = shapely.wkb.loads(wkb_or_shape)
 
-        if self.precision:
-            truncated_precision_shape = shapely.ops.transform(
-                self._trim_precision, shape)
-            if truncated_precision_shape.is_valid:
-                shape = truncated_precision_shape
-
-        geometry = shape.__geo_interface__
+        if self.precision and not shape.is_empty:
+            geometry = _geometry(shape, self._trim_precision)
+        else:
+            geometry = shape.__geo_interface__
         result = dict(type='Feature', properties=props, geometry=geometry)
         if fid is not None:
             result['id'] = fid
         return result
 
 
-def create_layer_feature_collection(features, precision):
+def _write_feature_collection(out, features, precision):
+    # write the features one at a time, so that only one is held as JSON
+    # objects and text at once, rather than the whole tile.
     create_json_feature = JsonFeatureCreator(precision)
-    fs = map(create_json_feature, features)
-    feature_collection = dict(type='FeatureCollection', features=fs)
-    return feature_collection
+    out.write('{"type":"FeatureCollection","features":[')
+    separator = ''
+    for feature in features:
+        out.write(separator)
+        out.write(json.dumps(create_json_feature(feature)))
+        separator = ','
+    out.write(']}')
 
 
 def precision_for_zoom(zoom):
@@ -63,8 +120,7 @@ def encode_single_layer(out, features, zoom):
     Geometries in the features list are assumed to be lon, lats.
     """
     precision = precision_for_zoom(zoom)
-    fs = create_layer_feature_collection(features, precision)
-    json.dump(fs, out)
+    _write_feature_collection(out, features, precision)
 
 
 def encode_multiple_layers(out, features_by_layer, zoom):
@@ -72,8 +128,12 @@ def encode_multiple_layers(out, features_by_layer, zoom):
     features_by_layer should be a dict: layer_name -> feature tuples
     """
     precision = precision_for_zoom(zoom)
-    geojson = {}
+    out.write('{')
+    separator = ''
     for layer_name, features in features_by_layer.items():
-        fs = create_layer_feature_collection(features, precision)
-        geojson[layer_name] = fs
-    json.dump(geojson, out)
+        out.write(separator)
+        out.write(json.dumps(layer_name))
+        out.write(':')
+        _write_feature_collection(out, features, precision)
+        separator = ','
+    out.write('}')
@@ -1,10 +1,447 @@
 from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+from mapbox_vector_tile.encoder import VectorTile
 from mapbox_vector_tile import encode as mvt_encode
+from numbers import Number
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Polygon
+from tilequeue.coords import coords_array
+from tilequeue.coords import make_rescale
+import numpy
+import struct
+
+
+# this module writes the protobuf encoding of the tile directly, rather
+# than building it up in a mapbox_vector_tile / protobuf tile object. the
+# output is the same, byte for byte, as mapbox_vector_tile.encode with the
+# options we use: quantized to the tile bounds with python's round, y up and
+# winding order checked, with invalid polygons made valid.
+#
+# coordinates are quantized, and the command streams built, over whole
+# coordinate arrays at once. the only per-geometry work left in python is
+# checking that quantized polygons are still valid, which is needed to
+# decide whether to repair them. repairing is left to mapbox_vector_tile,
+# so that repaired polygons come out the same way too.
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_SEG_END = 7
+
+GEOM_TYPE_POINT = 1
+GEOM_TYPE_LINESTRING = 2
+GEOM_TYPE_POLYGON = 3
+
+# the maximum value which can be stored in the uint32 packed fields.
+_MAX_UINT32 = 0xffffffff
+_VARINT_SHIFTS = numpy.arange(0, 35, 7, dtype=numpy.int64)
+
+_MIN_INT64 = -(1 << 63)
+_MAX_INT64 = (1 << 63) - 1
+_UINT64_MASK = (1 << 64) - 1
+
+
+def _command(cmd, length):
+    return (length << 3) | cmd
+
+
+def _zigzag(values):
+    # same as mapbox_vector_tile.geom_encoder.zigzag, which shifts by 31
+    # whatever the size of the value.
+    return (values << 1) ^ (values >> 31)
+
+
+def _varint(value):
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return result
+
+
+def _packed_varints(values):
+    """
+    Return the varint encoding of an array of non-negative integers which
+    fit in a uint32, as bytes.
+    """
+
+    if len(values) and (values.min() < 0 or values.max() > _MAX_UINT32):
+        raise ValueError('Value out of range: %r' % values)
+
+    groups = (values[:, None] >> _VARINT_SHIFTS) & 0x7f
+    # a byte needs the continuation bit set if there are more significant
+    # bits after it.
+    more = (values[:, None] >> _VARINT_SHIFTS[1:]) != 0
+    groups[:, :-1] |= more * 0x80
+    n_bytes = 1 + more.sum(axis=1)
+    keep = numpy.arange(len(_VARINT_SHIFTS)) < n_bytes[:, None]
+    return groups[keep].astype(numpy.uint8).tobytes()
+
+
+def _field(tag, data):
+    # length delimited field
+    result = bytearray(tag)
+    result += _varint(len(data))
+    result += data
+    return result
+
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return b'\x38' + (b'\x01' if value else b'\x00')
+    elif isinstance(value, str):
+        # check it's valid, as protobuf would
+        value.decode('utf-8')
+        return bytes(_field(b'\x0a', value))
+    elif isinstance(value, unicode):
+        return bytes(_field(b'\x0a', value.encode('utf-8')))
+    elif isinstance(value, (int, long)):
+        if not _MIN_INT64 <= value <= _MAX_INT64:
+            raise ValueError('Value out of range: %d' % value)
+        return b'\x20' + bytes(_varint(value & _UINT64_MASK))
+    else:
+        return b'\x19' + struct.pack('<d', value)
+
+
+def _can_handle_attr(key, value):
+    return isinstance(key, (str, unicode)) and \
+        isinstance(value, (str, unicode, bool, int, long, float))
+
+
+class _LayerValues(object):
+
+    """
+    Interns the keys and values of a layer's properties.
+
+    These are looked up in dicts, just as in mapbox_vector_tile, so that
+    equal values of different types, such as 1 and True, share an entry in
+    the same way.
+    """
+
+    def __init__(self):
+        self.key_idx = {}
+        self.keys = []
+        self.value_idx = {}
+        self.values = []
+
+    def tags(self, props):
+        tags = []
+        for key, value in props.items():
+            if not _can_handle_attr(key, value):
+                continue
+            if isinstance(key, str):
+                key = key.decode('utf-8')
+
+            idx = self.key_idx.get(key)
+            if idx is None:
+                idx = self.key_idx[key] = len(self.keys)
+                self.keys.append(key)
+            tags.append(idx)
+
+            idx = self.value_idx.get(value)
+            if idx is None:
+                idx = self.value_idx[value] = len(self.values)
+                self.values.append(_encode_value(value))
+            tags.append(idx)
+
+        return tags
+
+
+class _FeatureEncoder(object):
+
+    """
+    Builds the command stream for the geometry of a feature, from arrays of
+    quantized coordinates.
+    """
+
+    def __init__(self, extents):
+        self.extents = extents
+        self.parts = []
+        self.cursor = numpy.zeros(2, dtype=numpy.int64)
+
+    def _on_grid(self, xy):
+        grid = xy.astype(numpy.int64)
+        grid[:, 1] = self.extents - grid[:, 1]
+        return grid
+
+    def points(self, xy):
+        grid = self._on_grid(xy)
+        deltas = numpy.empty_like(grid)
+        deltas[0] = grid[0]
+        deltas[1:] = grid[1:] - grid[:-1]
+        self.parts.append(numpy.array(
+            [_command(CMD_MOVE_TO, len(grid))], dtype=numpy.int64))
+        self.parts.append(_zigzag(deltas).ravel())
+
+    def arc(self, xy):
+        """
+        Add a move to the first point and a line through the rest. Points
+        which are the same as the one before are skipped. Returns False,
+        having added nothing, if there aren't any points left after the
+        first.
+        """
+
+        grid = self._on_grid(xy)
+        moved = (grid[1:] != grid[:-1]).any(axis=1)
+        n_line_to = int(numpy.count_nonzero(moved))
+        if n_line_to == 0:
+            return False
+        if n_line_to < len(moved):
+            grid = numpy.concatenate((grid[:1], grid[1:][moved]))
+
+        deltas = numpy.empty_like(grid)
+        deltas[0] = grid[0] - self.cursor
+        deltas[1:] = grid[1:] - grid[:-1]
+        zigzag = _zigzag(deltas).ravel()
+
+        stream = numpy.empty(len(zigzag) + 2, dtype=numpy.int64)
+        stream[0] = _command(CMD_MOVE_TO, 1)
+        stream[1:3] = zigzag[:2]
+        stream[3] = _command(CMD_LINE_TO, n_line_to)
+        stream[4:] = zigzag[2:]
+        self.parts.append(stream)
+        self.cursor = grid[-1]
+        return True
+
+    def ring(self, xy):
+        # the closing point is implied by the close path command.
+        if not self.arc(xy[:-1]):
+            return False
+        self.parts.append(numpy.array(
+            [_command(CMD_SEG_END, 1)], dtype=numpy.int64))
+        return True
+
+    def polygons(self, polygons):
+        for rings in polygons:
+            if not self.ring(rings[0]):
+                continue
+            for ring in rings[1:]:
+                self.ring(ring)
+
+    def geometry(self):
+        if not self.parts:
+            return None
+        return _packed_varints(numpy.concatenate(self.parts))
+
+
+def _ring_area_sign(xy):
+    # sign of the area of a closed ring of whole number coordinates, which
+    # is positive for counter-clockwise rings. this is worked out exactly,
+    # in integers, so that it agrees with shapely's orient for small
+    # rings.
+    grid = xy.astype(numpy.int64)
+    x = grid[:, 0]
+    y = grid[:, 1]
+    return numpy.sign((x[:-1] * y[1:] - x[1:] * y[:-1]).sum())
+
+
+def _polygon_rings(shape):
+    return [coords_array(shape.exterior.coords)] + \
+        [coords_array(ring.coords) for ring in shape.interiors]
+
+
+class _PolygonQuantizer(object):
+
+    """
+    Quantizes polygons and orients them with clockwise exterior rings, as
+    mapbox_vector_tile does with y up. Polygons which aren't valid after
+    quantizing are repaired by mapbox_vector_tile.
+    """
+
+    def __init__(self, rescale, extents):
+        self.rescale = rescale
+        self.extents = extents
+        self._vector_tile = None
+
+    def _repair(self):
+        if self._vector_tile is None:
+            self._vector_tile = VectorTile(
+                self.extents, on_invalid_geometry_make_valid, round_fn=round)
+        return self._vector_tile
+
+    def _polygon(self, shape):
+        """
+        Returns a list of (shape, rings) pairs, for each polygon which the
+        shape became after quantizing and repairing.
+        """
+
+        quantized_rings = [self.rescale(xy) for xy in _polygon_rings(shape)]
+        rings = list(quantized_rings)
+        if _ring_area_sign(rings[0]) > 0:
+            rings[0] = rings[0][::-1]
+        for i in range(1, len(rings)):
+            if _ring_area_sign(rings[i]) < 0:
+                rings[i] = rings[i][::-1]
+
+        oriented = Polygon(rings[0], rings[1:])
+        if oriented.is_valid:
+            return [(oriented, rings)]
+
+        # the quantized polygon needs repairing, which is rare enough that
+        # it's simplest to let mapbox_vector_tile do it, from the start.
+        quantized = Polygon(quantized_rings[0], quantized_rings[1:])
+        repaired = self._repair().enforce_polygon_winding_order(
+            quantized, False, 1)
+        return self._parts(repaired)
+
+    def _parts(self, shape):
+        if shape is None or shape.is_empty:
+            return []
+        elif shape.type == 'Polygon':
+            return [(shape, _polygon_rings(shape))]
+        elif shape.type == 'MultiPolygon':
+            return [(part, _polygon_rings(part)) for part in shape.geoms]
+        else:
+            return []
+
+    def quantize(self, shape):
+        if shape.type == 'Polygon':
+            return self._polygon(shape)
+
+        parts = []
+        for part in shape.geoms:
+            if not part.is_empty:
+                parts.extend(self._polygon(part))
+        if len(parts) > 1:
+            multi = MultiPolygon([part for part, _ in parts])
+            if not multi.is_valid:
+                multi = self._repair().handle_shape_validity(multi, False, 1)
+                parts = self._parts(multi)
+        return parts
+
+
+def _encode_geometry(shape, rescale, polygon_quantizer, extents):
+    """
+    Returns the feature type and packed geometry command stream for the
+    shape, or None if nothing would be left of it in the tile.
+    """
+
+    geom_type = shape.type
+    encoder = _FeatureEncoder(extents)
+
+    if geom_type == 'Point':
+        encoder.points(rescale(coords_array(shape.coords)))
+        feature_type = GEOM_TYPE_POINT
+
+    elif geom_type == 'MultiPoint':
+        coords = [point.coords[0][:2] for point in shape.geoms
+                  if not point.is_empty]
+        xy = numpy.array(coords, dtype=numpy.float64)
+        encoder.points(rescale(xy))
+        feature_type = GEOM_TYPE_POINT
+
+    elif geom_type == 'LineString':
+        encoder.arc(rescale(coords_array(shape.coords)))
+        feature_type = GEOM_TYPE_LINESTRING
+
+    elif geom_type == 'MultiLineString':
+        for part in shape.geoms:
+            if not part.is_empty:
+                encoder.arc(rescale(coords_array(part.coords)))
+        feature_type = GEOM_TYPE_LINESTRING
+
+    elif geom_type in ('Polygon', 'MultiPolygon'):
+        polygons = polygon_quantizer.quantize(shape)
+        encoder.polygons([rings for _, rings in polygons])
+        feature_type = GEOM_TYPE_POLYGON
+
+    elif geom_type == 'GeometryCollection':
+        raise ValueError('Encoding geometry collections not supported')
+
+    else:
+        raise NotImplementedError("Can't do %s geometries" % geom_type)
+
+    geometry = encoder.geometry()
+    if not geometry:
+        return None
+    return feature_type, geometry
+
+
+def _encode_layer(name, features, bounds_merc, extents):
+    rescale = make_rescale(bounds_merc, extents)
+    polygon_quantizer = _PolygonQuantizer(rescale, extents)
+    layer_values = _LayerValues()
+
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    layer = _field(b'\x0a', name)
+
+    for shape, props, feature_id in features:
+        if shape is None or shape.is_empty:
+            continue
+
+        encoded = _encode_geometry(
+            shape, rescale, polygon_quantizer, extents)
+        if encoded is None:
+            continue
+        feature_type, geometry = encoded
+
+        feature = bytearray()
+        if isinstance(feature_id, Number) and feature_id >= 0:
+            feature += b'\x08'
+            feature += _varint(int(feature_id))
+        if props is not None:
+            tags = layer_values.tags(props)
+            if tags:
+                feature += _field(
+                    b'\x12', _packed_varints(numpy.array(
+                        tags, dtype=numpy.int64)))
+        feature += b'\x18'
+        feature += _varint(feature_type)
+        feature += _field(b'\x22', geometry)
+
+        layer += _field(b'\x12', feature)
+
+    for key in layer_values.keys:
+        layer += _field(b'\x1a', key.encode('utf-8'))
+    for value in layer_values.values:
+        layer += _field(b'\x22', value)
+    layer += b'\x28'
+    layer += _varint(extents)
+    # version 1
+    layer += b'\x78\x01'
+
+    return _field(b'\x1a', layer)
 
 
 def encode(fp, feature_layers, bounds_merc, extents=4096):
+    """
+    Write the MVT encoding of feature_layers, a list of dicts with the
+    layer name and a list of (shape, properties, id) features, quantized to
+    bounds_merc, to fp.
+    """
+
+    tile = bytearray()
+    for feature_layer in feature_layers:
+        tile += _encode_layer(
+            feature_layer['name'], feature_layer['features'], bounds_merc,
+            extents)
+    fp.write(bytes(tile))
+
+
+def encode_mapbox(fp, feature_layers, bounds_merc, extents=4096):
+    """
+    Encode the same way as encode, using mapbox_vector_tile. This is
+    slower, and is kept as the reference for the output of encode.
+    """
+
+    mvt_layers = []
+    for feature_layer in feature_layers:
+        mvt_features = []
+        for shape, props, feature_id in feature_layer['features']:
+            mvt_feature = dict(
+                geometry=shape,
+                properties=props,
+                id=feature_id,
+            )
+            mvt_features.append(mvt_feature)
+        mvt_layer = dict(
+            name=feature_layer['name'],
+            features=mvt_features,
+        )
+        mvt_layers.append(mvt_layer)
+
     tile = mvt_encode(
-        feature_layers,
+        mvt_layers,
         quantize_bounds=bounds_merc,
         on_invalid_geometry=on_invalid_geometry_make_valid,
         round_fn=round,
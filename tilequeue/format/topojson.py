@@ -1,42 +1,9 @@
+from tilequeue.coords import coords_array
+from tilequeue.coords import round_half_away
+import numpy
 import ujson as json
 
 
-def update_arc_indexes(geometry, merged_arcs, old_arcs):
-    """ Updated geometry arc indexes, and add arcs to merged_arcs along the way.
-
-        Arguments are modified in-place, and nothing is returned.
-    """
-    if geometry['type'] in ('Point', 'MultiPoint'):
-        return
-
-    elif geometry['type'] == 'LineString':
-        for arc_index, old_arc in enumerate(geometry['arcs']):
-            geometry['arcs'][arc_index] = len(merged_arcs)
-            merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'Polygon':
-        for ring in geometry['arcs']:
-            for arc_index, old_arc in enumerate(ring):
-                ring[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'MultiLineString':
-        for part in geometry['arcs']:
-            for arc_index, old_arc in enumerate(part):
-                part[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'MultiPolygon':
-        for part in geometry['arcs']:
-            for ring in part:
-                for arc_index, old_arc in enumerate(ring):
-                    ring[arc_index] = len(merged_arcs)
-                    merged_arcs.append(old_arcs[old_arc])
-
-    else:
-        raise NotImplementedError("Can't do %s geometries" % geometry['type'])
-
-
 def get_transform(bounds, size=4096):
     """ Return a TopoJSON transform dictionary and a point-transforming function.
 
@@ -54,15 +21,182 @@ def get_transform(bounds, size=4096):
     return dict(translate=(tx, ty), scale=(sx, sy)), forward
 
 
-def diff_encode(line, transform):
-    """ Differentially encode a shapely linestring or ring.
+def get_array_transform(bounds, size=4096):
+    """ Return a function which transforms an array of longitudes and
+        latitudes to TopoJSON integer space, as the forward function from
+        get_transform does for a single point.
     """
-    coords = [transform(x, y) for (x, y) in line.coords]
+    translate = numpy.array([bounds[0], bounds[1]])
+    scale = numpy.array([(bounds[2] - bounds[0]) / size,
+                         (bounds[3] - bounds[1]) / size])
+
+    def forward(xy):
+        return round_half_away((xy - translate) / scale).astype(numpy.int64)
+
+    return forward
+
+
+def _drop_repeats(xy):
+    moved = numpy.ones(len(xy), dtype=bool)
+    moved[1:] = (xy[1:] != xy[:-1]).any(axis=1)
+    return xy[moved]
+
+
+class Topology(object):
+
+    """ Collects the lines and rings of a tile's geometries, and splits them
+        into arcs which are shared between them.
+
+        Lines and rings are quantized, and a junction is found wherever a
+        point is reached from different neighbouring points by different
+        paths, or is the end of a line. Each path is cut into arcs at its
+        junctions, and arcs which are the same as another, or the same
+        reversed, are only kept once. A reversed arc is referred to by the
+        ones' complement of its index, as in the TopoJSON spec.
+    """
+
+    def __init__(self, forward):
+        self.forward = forward
+        # quantized points of each path, and whether it's a ring. rings
+        # don't repeat their first point at the end.
+        self.paths = []
+        self.is_ring = []
 
-    pairs = zip(coords[:], coords[1:])
-    diffs = [(x2 - x1, y2 - y1) for ((x1, y1), (x2, y2)) in pairs]
+    def add_line(self, line):
+        """ Add a line, returning an index to look up its arcs with.
+        """
+        xy = _drop_repeats(self.forward(coords_array(line.coords)))
+        self.paths.append(xy)
+        self.is_ring.append(False)
+        return len(self.paths) - 1
 
-    return coords[:1] + [(x, y) for (x, y) in diffs if (x, y) != (0, 0)]
+    def add_ring(self, ring):
+        """ Add a ring, returning an index to look up its arcs with.
+        """
+        xy = _drop_repeats(self.forward(coords_array(ring.coords)))
+        if len(xy) > 1 and (xy[0] == xy[-1]).all():
+            xy = xy[:-1]
+        self.paths.append(xy)
+        self.is_ring.append(True)
+        return len(self.paths) - 1
+
+    def _point_keys(self):
+        # a single integer for each point, so that points can be compared
+        # and sorted as scalars.
+        all_xy = numpy.concatenate(self.paths)
+        origin = all_xy.min(axis=0)
+        height = all_xy[:, 1].max() - origin[1] + 1
+        return [(xy[:, 0] - origin[0]) * height + (xy[:, 1] - origin[1])
+                for xy in self.paths]
+
+    def _junctions(self, path_keys):
+        keys = numpy.concatenate(path_keys)
+        prev_keys = numpy.empty_like(keys)
+        next_keys = numpy.empty_like(keys)
+        ends = []
+        offset = 0
+        for path, is_ring in zip(path_keys, self.is_ring):
+            end = offset + len(path)
+            prev_keys[offset + 1:end] = path[:-1]
+            next_keys[offset:end - 1] = path[1:]
+            if is_ring:
+                prev_keys[offset] = path[-1]
+                next_keys[end - 1] = path[0]
+            else:
+                prev_keys[offset] = -1
+                next_keys[end - 1] = -1
+                ends.append(path[[0, -1]])
+            offset = end
+
+        # the neighbours are the same whichever direction the point is
+        # reached from.
+        lo = numpy.minimum(prev_keys, next_keys)
+        hi = numpy.maximum(prev_keys, next_keys)
+
+        order = numpy.lexsort((hi, lo, keys))
+        keys, lo, hi = keys[order], lo[order], hi[order]
+        # distinct (point, neighbours) combinations
+        distinct = numpy.ones(len(keys), dtype=bool)
+        distinct[1:] = (keys[1:] != keys[:-1]) | (lo[1:] != lo[:-1]) | \
+            (hi[1:] != hi[:-1])
+        keys = keys[distinct]
+        # points with more than one set of neighbours
+        shared = keys[1:][keys[1:] == keys[:-1]]
+
+        return numpy.union1d(shared, numpy.concatenate(ends + [shared[:0]]))
+
+    def _cut(self, path, keys, is_ring, at_junction):
+        """ Return the points and keys of each arc in the path, given the
+            indexes of the junctions in it.
+        """
+        if is_ring:
+            if len(at_junction):
+                start = at_junction[0]
+                at_junction = at_junction - start
+            else:
+                # start rings which touch nothing at their lowest point, so
+                # that the same ring added twice gives the same arc.
+                start = keys.argmin()
+                at_junction = numpy.array([0])
+            # rotate to the start, and close the ring.
+            order = numpy.arange(start, start + len(keys) + 1) % len(keys)
+            path = path[order]
+            keys = keys[order]
+            at_junction = numpy.append(at_junction, len(keys) - 1)
+
+        if len(at_junction) < 2:
+            return [(path, keys)]
+
+        return [(path[i:j + 1], keys[i:j + 1])
+                for i, j in zip(at_junction[:-1], at_junction[1:])]
+
+    def arcs(self):
+        """ Return the list of delta encoded arcs, and the list of arc
+            indexes for each path.
+        """
+        if not self.paths:
+            return [], []
+
+        path_keys = self._point_keys()
+        junctions = self._junctions(path_keys)
+        is_junction = numpy.in1d(numpy.concatenate(path_keys), junctions)
+
+        arcs = []
+        arc_index = {}
+        path_arcs = []
+        offset = 0
+        for path, keys, is_ring in zip(
+                self.paths, path_keys, self.is_ring):
+            end = offset + len(keys)
+            at_junction = numpy.nonzero(is_junction[offset:end])[0]
+            offset = end
+
+            refs = []
+            for arc, arc_keys in self._cut(path, keys, is_ring, at_junction):
+                forward_key = arc_keys.tobytes()
+                index = arc_index.get(forward_key)
+                if index is None:
+                    reverse_index = arc_index.get(arc_keys[::-1].tobytes())
+                    if reverse_index is not None:
+                        refs.append(~reverse_index)
+                        continue
+                    index = len(arcs)
+                    arc_index[forward_key] = index
+                    deltas = numpy.empty_like(arc)
+                    deltas[0] = arc[0]
+                    deltas[1:] = arc[1:] - arc[:-1]
+                    arcs.append(deltas.tolist())
+                refs.append(index)
+            path_arcs.append(refs)
+
+        return arcs, path_arcs
+
+
+def _resolve_arcs(value, path_arcs):
+    # replace the path indexes in a geometry's arcs with the arc indexes.
+    if isinstance(value, list):
+        return [_resolve_arcs(item, path_arcs) for item in value]
+    return path_arcs[value]
 
 
 def encode(file, features_by_layer, bounds, size=4096):
@@ -78,10 +212,13 @@ def encode(file, features_by_layer, bounds, size=4096):
         Size is the number of integer coordinates which span the extent
         of the tile.
     """
-    transform, forward = get_transform(bounds, size=size)
-    arcs = []
+    transform, _ = get_transform(bounds, size=size)
+    forward = get_array_transform(bounds, size=size)
+    topology = Topology(forward)
 
     geometries_by_layer = {}
+    # geometries with arcs, which hold path indexes until the arcs are cut.
+    geometries_with_arcs = []
 
     for layer, features in features_by_layer.iteritems():
         geometries = []
@@ -94,54 +231,49 @@ def encode(file, features_by_layer, bounds, size=4096):
             if fid is not None:
                 geometry['id'] = fid
 
-            elif shape.type == 'Point':
+            if shape.type == 'Point':
                 geometry.update(dict(
                     type='Point',
-                    coordinates=forward(shape.x, shape.y)))
+                    coordinates=forward(
+                        coords_array(shape.coords))[0].tolist()))
 
             elif shape.type == 'LineString':
-                geometry.update(dict(type='LineString', arcs=[len(arcs)]))
-                arcs.append(diff_encode(shape, forward))
+                geometry.update(dict(
+                    type='LineString', arcs=topology.add_line(shape)))
 
             elif shape.type == 'Polygon':
-                geometry.update(dict(type='Polygon', arcs=[]))
-
                 rings = [shape.exterior] + list(shape.interiors)
-
-                for ring in rings:
-                    geometry['arcs'].append([len(arcs)])
-                    arcs.append(diff_encode(ring, forward))
+                geometry.update(dict(
+                    type='Polygon',
+                    arcs=[topology.add_ring(ring) for ring in rings]))
 
             elif shape.type == 'MultiPoint':
-                geometry.update(dict(type='MultiPoint', coordinates=[]))
-
-                for point in shape.geoms:
-                    geometry['coordinates'].append(forward(point.x, point.y))
+                xy = numpy.array(
+                    [point.coords[0][:2] for point in shape.geoms],
+                    dtype=numpy.float64)
+                geometry.update(dict(
+                    type='MultiPoint', coordinates=forward(xy).tolist()))
 
             elif shape.type == 'MultiLineString':
-                geometry.update(dict(type='MultiLineString', arcs=[]))
-
-                for line in shape.geoms:
-                    geometry['arcs'].append([len(arcs)])
-                    arcs.append(diff_encode(line, forward))
+                geometry.update(dict(
+                    type='MultiLineString',
+                    arcs=[topology.add_line(line) for line in shape.geoms]))
 
             elif shape.type == 'MultiPolygon':
-                geometry.update(dict(type='MultiPolygon', arcs=[]))
-
+                polygons_arcs = []
                 for polygon in shape.geoms:
                     rings = [polygon.exterior] + list(polygon.interiors)
-                    polygon_arcs = []
-
-                    for ring in rings:
-                        polygon_arcs.append([len(arcs)])
-                        arcs.append(diff_encode(ring, forward))
-
-                    geometry['arcs'].append(polygon_arcs)
+                    polygons_arcs.append(
+                        [topology.add_ring(ring) for ring in rings])
+                geometry.update(dict(
+                    type='MultiPolygon', arcs=polygons_arcs))
 
             else:
                 raise NotImplementedError("Can't do %s geometries" %
                                           shape.type)
 
+            if 'arcs' in geometry:
+                geometries_with_arcs.append(geometry)
             geometries.append(geometry)
 
         geometries_by_layer[layer] = dict(
@@ -149,6 +281,10 @@ def encode(file, features_by_layer, bounds, size=4096):
             geometries=geometries,
         )
 
+    arcs, path_arcs = topology.arcs()
+    for geometry in geometries_with_arcs:
+        geometry['arcs'] = _resolve_arcs(geometry['arcs'], path_arcs)
+
     result = dict(
         type='Topology',
         transform=transform,
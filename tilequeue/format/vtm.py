@@ -5,7 +5,11 @@ from OSciMap4.GeomEncoder import GeomEncoder
 from OSciMap4.StaticVals import getValues
 from OSciMap4.StaticKeys import getKeys
 from OSciMap4.TagRewrite import fixTag
+from shapely.geometry.base import BaseGeometry
+from tilequeue.coords import coords_array
+from tilequeue.coords import round_half_away
 import logging
+import numpy
 import struct
 
 statickeys = getKeys()
@@ -53,11 +57,96 @@ def merge(file, feature_layers):
     file.write(data)
 
 
+class ShapeEncoder(object):
+    """
+    Encodes shapely geometries in the same way as OSciMap4's GeomEncoder
+    does WKB, with the same coordinates, index, isPoint and isPoly results,
+    but working on whole coordinate arrays at a time.
+
+    Coordinates are delta encoded, continuing from the end of one part to
+    the start of the next. The first point of each line or ring is always
+    kept, and after that points which are the same as the one before are
+    dropped. Rings don't include their closing point.
+    """
+
+    def __init__(self, tileSize):
+        self.tileSize = tileSize - 1
+        self._reset()
+
+    def _reset(self):
+        self.coordinates = []
+        self.index = []
+        self.isPoint = True
+        self.isPoly = False
+        self.last = numpy.zeros(2, dtype=numpy.int64)
+        self.first = True
+
+    def _add(self, xy):
+        # encode a sequence of points, returning the number kept.
+        if len(xy) == 0:
+            return 0
+        grid = round_half_away(xy).astype(numpy.int64)
+        # flip upside down
+        grid[:, 1] = self.tileSize - grid[:, 1]
+
+        deltas = numpy.empty_like(grid)
+        deltas[0] = grid[0] - self.last
+        deltas[1:] = grid[1:] - grid[:-1]
+        keep = deltas.any(axis=1)
+        if self.first:
+            keep[0] = True
+        deltas = deltas[keep]
+
+        self.coordinates.extend(deltas.ravel().tolist())
+        self.last = grid[-1]
+        self.first = False
+        return len(deltas)
+
+    def _line(self, xy):
+        self.isPoint = False
+        self.index.append(self._add(xy))
+        self.first = True
+
+    def _polygon(self, shape):
+        self.isPoint = False
+        for ring in [shape.exterior] + list(shape.interiors):
+            # skip the last point
+            self._line(coords_array(ring.coords)[:-1])
+        self.isPoly = True
+
+    def _dispatch(self, shape):
+        geom_type = shape.type
+        if geom_type == 'Point':
+            self._add(coords_array(shape.coords))
+        elif geom_type == 'LineString':
+            self._line(coords_array(shape.coords))
+        elif geom_type == 'Polygon':
+            self._polygon(shape)
+        elif geom_type == 'MultiPoint':
+            for point in shape.geoms:
+                self._add(coords_array(point.coords))
+        elif geom_type == 'MultiPolygon':
+            for n, polygon in enumerate(shape.geoms):
+                if n > 0:
+                    self.index.append(0)
+                self._polygon(polygon)
+        elif geom_type in ('MultiLineString', 'GeometryCollection'):
+            for part in shape.geoms:
+                self._dispatch(part)
+        else:
+            raise ValueError('Unsupported geometry type: %s' % geom_type)
+
+    def parseGeometry(self, shape):
+        self._reset()
+        self._dispatch(shape)
+
+
 class VectorTile:
     """
     """
     def __init__(self, extents):
         self.geomencoder = GeomEncoder(extents)
+        self.shapeencoder = ShapeEncoder(extents)
 
         # TODO count to sort by number of occurrences
         self.keydict = {}
@@ -89,7 +178,10 @@ class VectorTile:
             self.addFeature(feature, this_layer)
 
     def addFeature(self, row, this_layer):
-        geom = self.geomencoder
+        if isinstance(row[0], BaseGeometry):
+            geom = self.shapeencoder
+        else:
+            geom = self.geomencoder
         tags = []
 
         # height = None
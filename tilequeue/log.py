@@ -36,6 +36,7 @@ class LogCategory(Enum):
     LIFECYCLE = 2
     QUEUE_SIZES = 3
     RAWR_PROCESS = 4
+    STORE = 5
 
 
 class MsgType(Enum):
@@ -115,6 +116,10 @@ class JsonTileProcessingLogger(object):
             size=coord_proc_data.size,
             storage=coord_proc_data.store_info,
         )
+        if coord_proc_data.transport_info:
+            json_obj['transport'] = coord_proc_data.transport_info
+        if coord_proc_data.reduction:
+            json_obj['reduction'] = coord_proc_data.reduction
         json_str = json.dumps(json_obj)
         self.logger.info(json_str)
 
@@ -321,3 +326,38 @@ class BatchProcessLogger(object):
 
     def metatile_already_exists(self, coord):
         self._log('metatile already exists', coord)
+
+
+class JsonStoreLogger(object):
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def operation(self, op, extension, layer, coord, millis, bytes_in,
+                  bytes_out, retries, error_class):
+        """
+        Log a store operation. Successful ones are logged at debug level, as
+        there's one for every tile.
+        """
+
+        log_level = LogLevel.ERROR if error_class else LogLevel.DEBUG
+        # skip building the message for every tile when it won't be logged.
+        if not self.logger.isEnabledFor(log_level.value):
+            return
+        json_obj = dict(
+            type=log_level_name(log_level),
+            category=log_category_name(LogCategory.STORE),
+            op=op,
+            format=extension,
+            layer=layer,
+            time=millis,
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+            retries=retries,
+        )
+        if coord is not None:
+            json_obj['coord'] = make_coord_dict(coord)
+        if error_class:
+            json_obj['error'] = error_class
+        json_str = json.dumps(json_obj)
+        self.logger.log(log_level.value, json_str)
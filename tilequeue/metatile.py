@@ -1,10 +1,70 @@
+import hashlib
+import struct
 import zipfile
+import zlib
 import cStringIO as StringIO
 from collections import defaultdict
+from tilequeue.format import indexed_metatile_format
 from tilequeue.format import zip_format
 from time import gmtime
 
 
+# the indexed metatile container starts with a fixed size header, followed
+# by one fixed size index entry per member, sorted by (dz, dx, dy, format
+# extension), and then the member payloads one after the other. a member can
+# be found by reading the header and index and seeking straight to it.
+INDEXED_MAGIC = 'TQMT'
+INDEXED_VERSION = 1
+# magic, version, compression, reserved, number of members
+_INDEXED_HEADER = struct.Struct('>4sBBHI')
+# dz, dx, dy, format extension, payload offset, payload length
+_INDEXED_ENTRY = struct.Struct('>BII8sQI')
+
+_COMPRESS_NONE = 0
+_COMPRESS_ZLIB = 1
+
+metatile_containers = {
+    'zip': zip_format,
+    'indexed': indexed_metatile_format,
+}
+
+
+def metatile_format(container):
+    """
+    Return the format of metatiles made with the given container name.
+    """
+
+    fmt = metatile_containers.get(container)
+    if fmt is None:
+        raise ValueError('Unknown metatile container: %r' % (container,))
+    return fmt
+
+
+def _tile_offset(parent, coord):
+    """
+    Return the (delta_z, delta_column, delta_row) of coord relative to the
+    parent.
+    """
+
+    # change in zoom level from parent to coord. since parent should be a
+    # parent, its zoom should always be equal or smaller to that of coord.
+    delta_z = coord.zoom - parent.zoom
+    assert delta_z >= 0, "Coordinates must be descendents of parent"
+
+    # change in row/col coordinates are relative to the upper left coordinate
+    # at that zoom. both should be positive.
+    delta_row = coord.row - (int(parent.row) << delta_z)
+    delta_column = coord.column - (int(parent.column) << delta_z)
+    assert delta_row >= 0, \
+        "Coordinates must be contained by their parent, but " + \
+        "row is not."
+    assert delta_column >= 0, \
+        "Coordinates must be contained by their parent, but " + \
+        "column is not."
+
+    return delta_z, delta_column, delta_row
+
+
 def make_multi_metatile(parent, tiles, date_time=None):
     """
     Make a metatile containing a list of tiles all having the same layer,
@@ -24,33 +84,23 @@ def make_multi_metatile(parent, tiles, date_time=None):
 
     layer = tiles[0]['layer']
 
+    members = []
+    for tile in tiles:
+        assert tile['layer'] == layer
+
+        delta_z, delta_column, delta_row = _tile_offset(parent, tile['coord'])
+
+        tile_name = '%d/%d/%d.%s' % \
+            (delta_z, delta_column, delta_row, tile['format'].extension)
+        members.append((tile_name, tile['tile']))
+
+    # write members in a fixed order, so that the same tiles always make the
+    # same zip, whichever order they were formatted in.
+    members.sort(key=lambda m: m[0])
+
     buf = StringIO.StringIO()
     with zipfile.ZipFile(buf, mode='w') as z:
-        for tile in tiles:
-            assert tile['layer'] == layer
-
-            coord = tile['coord']
-
-            # change in zoom level from parent to coord. since parent should
-            # be a parent, its zoom should always be equal or smaller to that
-            # of coord.
-            delta_z = coord.zoom - parent.zoom
-            assert delta_z >= 0, "Coordinates must be descendents of parent"
-
-            # change in row/col coordinates are relative to the upper left
-            # coordinate at that zoom. both should be positive.
-            delta_row = coord.row - (int(parent.row) << delta_z)
-            delta_column = coord.column - (int(parent.column) << delta_z)
-            assert delta_row >= 0, \
-                "Coordinates must be contained by their parent, but " + \
-                "row is not."
-            assert delta_column >= 0, \
-                "Coordinates must be contained by their parent, but " + \
-                "column is not."
-
-            tile_name = '%d/%d/%d.%s' % \
-                (delta_z, delta_column, delta_row, tile['format'].extension)
-            tile_data = tile['tile']
+        for tile_name, tile_data in members:
             info = zipfile.ZipInfo(tile_name, date_time)
             z.writestr(info, tile_data, zipfile.ZIP_DEFLATED)
 
@@ -58,6 +108,56 @@ def make_multi_metatile(parent, tiles, date_time=None):
                  layer=layer)]
 
 
+def make_indexed_metatile(parent, tiles, compress=False):
+    """
+    Make an indexed metatile containing a list of tiles all having the same
+    layer, with coordinates relative to the given parent. Members are stored
+    uncompressed unless compress is set, in which case each member is
+    compressed with zlib on its own, so that any one of them can still be
+    read without the others.
+    """
+
+    assert parent is not None, \
+        "Parent tile must be provided and not None to make a metatile."
+
+    if len(tiles) == 0:
+        return []
+
+    layer = tiles[0]['layer']
+
+    members = []
+    for tile in tiles:
+        assert tile['layer'] == layer
+
+        delta_z, delta_column, delta_row = _tile_offset(
+            parent, tile['coord'])
+        ext = tile['format'].extension
+        assert len(ext) <= 8, "Format extension too long: %r" % ext
+
+        tile_data = tile['tile']
+        if compress:
+            tile_data = zlib.compress(tile_data)
+
+        members.append(((delta_z, delta_column, delta_row, ext), tile_data))
+
+    members.sort(key=lambda m: m[0])
+    for (key_1, _), (key_2, _) in zip(members, members[1:]):
+        assert key_1 != key_2, "Duplicate metatile member: %r" % (key_1,)
+
+    compression = _COMPRESS_ZLIB if compress else _COMPRESS_NONE
+    parts = [_INDEXED_HEADER.pack(
+        INDEXED_MAGIC, INDEXED_VERSION, compression, 0, len(members))]
+    offset = _INDEXED_HEADER.size + _INDEXED_ENTRY.size * len(members)
+    for (delta_z, delta_column, delta_row, ext), tile_data in members:
+        parts.append(_INDEXED_ENTRY.pack(
+            delta_z, delta_column, delta_row, ext, offset, len(tile_data)))
+        offset += len(tile_data)
+    parts.extend(tile_data for _, tile_data in members)
+
+    return [dict(tile=''.join(parts), format=indexed_metatile_format,
+                 coord=parent, layer=layer)]
+
+
 def common_parent(a, b):
     """
     Find the common parent tile of both a and b. The common parent is the tile
@@ -94,14 +194,20 @@ def _parent_tile(tiles):
     return parent
 
 
-def make_metatiles(size, tiles, date_time=None):
+def make_metatiles(size, tiles, date_time=None, container='zip',
+                   compress=False):
     """
     Group by layers, and make metatiles out of all the tiles which share those
     properties relative to the "top level" tile which is parent of them all.
     Provide a 6-tuple date_time to set the timestamp on each tile within the
     metatile, or leave it as None to use the current time.
+
+    The container is either 'zip' or 'indexed'. The date_time only applies
+    to zip metatiles, and compress only to indexed ones.
     """
 
+    metatile_format(container)
+
     groups = defaultdict(list)
     for tile in tiles:
         key = tile['layer']
@@ -110,17 +216,142 @@ def make_metatiles(size, tiles, date_time=None):
     metatiles = []
     for group in groups.itervalues():
         parent = _parent_tile(t['coord'] for t in group)
-        metatiles.extend(make_multi_metatile(parent, group, date_time))
+        if container == 'indexed':
+            metatiles.extend(make_indexed_metatile(parent, group, compress))
+        else:
+            metatiles.extend(make_multi_metatile(parent, group, date_time))
 
     return metatiles
 
 
+def _is_indexed_metatile(io):
+    io.seek(0)
+    magic = io.read(len(INDEXED_MAGIC))
+    io.seek(0)
+    return magic == INDEXED_MAGIC
+
+
+def _read_indexed_header(io):
+    header = io.read(_INDEXED_HEADER.size)
+    if len(header) != _INDEXED_HEADER.size:
+        raise ValueError('Truncated indexed metatile header')
+    magic, version, compression, _, count = _INDEXED_HEADER.unpack(header)
+    if magic != INDEXED_MAGIC:
+        raise ValueError('Not an indexed metatile')
+    if version != INDEXED_VERSION:
+        raise ValueError('Unsupported indexed metatile version: %d' % version)
+    if compression not in (_COMPRESS_NONE, _COMPRESS_ZLIB):
+        raise ValueError('Unknown indexed metatile compression: %d' %
+                         compression)
+    index = io.read(_INDEXED_ENTRY.size * count)
+    if len(index) != _INDEXED_ENTRY.size * count:
+        raise ValueError('Truncated indexed metatile index')
+    return compression, count, index
+
+
+def _read_indexed_member(io, compression, offset, length):
+    io.seek(offset)
+    tile_data = io.read(length)
+    if len(tile_data) != length:
+        raise ValueError('Truncated indexed metatile member')
+    if compression == _COMPRESS_ZLIB:
+        tile_data = zlib.decompress(tile_data)
+    return tile_data
+
+
+def _extract_indexed_metatile(io, key):
+    """
+    Extract the member with the given (dz, dx, dy, extension) key from the
+    indexed metatile in io, or None if there isn't one. Only the header, the
+    index and the member itself are read.
+    """
+
+    compression, count, index = _read_indexed_header(io)
+
+    # binary search of the index, unpacking only the entries looked at.
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        dz, dx, dy, ext, offset, length = _INDEXED_ENTRY.unpack_from(
+            index, mid * _INDEXED_ENTRY.size)
+        entry_key = (dz, dx, dy, ext.rstrip('\0'))
+        if entry_key == key:
+            return _read_indexed_member(io, compression, offset, length)
+        elif entry_key < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return None
+
+
+def _indexed_metatile_index(tile_data):
+    """
+    Return the compression of the indexed metatile tile_data, and a dict of
+    (dz, dx, dy, extension) to the stored bytes of each member.
+    """
+
+    io = StringIO.StringIO(tile_data)
+    compression, count, index = _read_indexed_header(io)
+    members = {}
+    for i in xrange(count):
+        dz, dx, dy, ext, offset, length = _INDEXED_ENTRY.unpack_from(
+            index, i * _INDEXED_ENTRY.size)
+        stored = tile_data[offset:offset + length]
+        if len(stored) != length:
+            raise ValueError('Truncated indexed metatile member')
+        members[(dz, dx, dy, ext.rstrip('\0'))] = stored
+    return compression, members
+
+
+def _indexed_metatiles_equal(tile_data_1, tile_data_2):
+    """
+    Return True if the two indexed metatiles have the same members with the
+    same contents. Members are only decompressed when their stored bytes
+    differ and at least one of them is compressed.
+    """
+
+    compression_1, members_1 = _indexed_metatile_index(tile_data_1)
+    compression_2, members_2 = _indexed_metatile_index(tile_data_2)
+
+    if len(members_1) != len(members_2):
+        return False
+
+    for key, stored_1 in members_1.iteritems():
+        stored_2 = members_2.get(key)
+        if stored_2 is None:
+            return False
+
+        if compression_1 == compression_2 and stored_1 == stored_2:
+            continue
+
+        if compression_1 == compression_2 == _COMPRESS_NONE:
+            return False
+
+        if compression_1 == _COMPRESS_ZLIB:
+            stored_1 = zlib.decompress(stored_1)
+        if compression_2 == _COMPRESS_ZLIB:
+            stored_2 = zlib.decompress(stored_2)
+        if stored_1 != stored_2:
+            return False
+
+    return True
+
+
 def extract_metatile(io, fmt, offset=None):
     """
     Extract the tile at the given offset (defaults to 0/0/0) and format from
-    the metatile in the file-like object io.
+    the metatile in the file-like object io. Both zip and indexed metatiles
+    are supported, and are told apart by their first bytes.
     """
 
+    if _is_indexed_metatile(io):
+        if offset is None:
+            key = (0, 0, 0, fmt.extension)
+        else:
+            key = (offset.zoom, offset.column, offset.row, fmt.extension)
+        return _extract_indexed_metatile(io, key)
+
     ext = fmt.extension
     if offset is None:
         tile_name = '0/0/0.%s' % ext
@@ -135,21 +366,30 @@ def extract_metatile(io, fmt, offset=None):
             return None
 
 
-def _metatile_contents_equal(zip_1, zip_2):
+def _metatile_contents_equal(zip_1, zip_2, check_contents=False):
     """
     Given two open zip files as arguments, this returns True if the zips
     both contain the same set of files, having the same names, and each
     file within the zip is byte-wise identical to the one with the same
     name in the other zip.
+
+    This is decided from the names, uncompressed sizes and CRC32s in the
+    central directories, without decompressing anything. Set check_contents
+    to also compare the bytes of each file when all of those match.
     """
 
-    names_1 = set(zip_1.namelist())
-    names_2 = set(zip_2.namelist())
+    infos_1 = dict((info.filename, (info.file_size, info.CRC))
+                   for info in zip_1.infolist())
+    infos_2 = dict((info.filename, (info.file_size, info.CRC))
+                   for info in zip_2.infolist())
 
-    if names_1 != names_2:
+    if infos_1 != infos_2:
         return False
 
-    for n in names_1:
+    if not check_contents:
+        return True
+
+    for n in infos_1:
         bytes_1 = zip_1.read(n)
         bytes_2 = zip_2.read(n)
 
@@ -159,26 +399,71 @@ def _metatile_contents_equal(zip_1, zip_2):
     return True
 
 
-def metatiles_are_equal(tile_data_1, tile_data_2):
+def metatiles_are_equal(tile_data_1, tile_data_2, check_contents=False):
     """
     Return True if the two tiles are both zipped metatiles and contain the
     same set of files with the same contents. This ignores the timestamp of
     the individual files in the zip files, as well as their order or any
     other metadata.
+
+    Files with the same name, size and CRC32 are taken to have the same
+    contents, unless check_contents is set, in which case their bytes are
+    compared too.
+
+    Two indexed metatiles are equal if they contain the same members with
+    the same (uncompressed) contents. An indexed metatile is never equal to
+    a zip one.
     """
 
+    # metatiles made from the same tiles at the same time are the same
+    # bytes, and there's no need to look inside them.
+    if tile_data_1 == tile_data_2:
+        return True
+
     try:
+        indexed_1 = tile_data_1.startswith(INDEXED_MAGIC)
+        indexed_2 = tile_data_2.startswith(INDEXED_MAGIC)
+        if indexed_1 or indexed_2:
+            if not (indexed_1 and indexed_2):
+                return False
+            return _indexed_metatiles_equal(tile_data_1, tile_data_2)
+
         buf_1 = StringIO.StringIO(tile_data_1)
         buf_2 = StringIO.StringIO(tile_data_2)
 
         with zipfile.ZipFile(buf_1, mode='r') as zip_1:
             with zipfile.ZipFile(buf_2, mode='r') as zip_2:
-                return _metatile_contents_equal(zip_1, zip_2)
+                return _metatile_contents_equal(
+                    zip_1, zip_2, check_contents)
 
-    except (StandardError, zipfile.BadZipFile, zipfile.LargeZipFile):
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile,
+            zlib.error):
         # errors, such as files not being proper zip files, or missing
         # some attributes or contents that we expect, are treated as not
         # equal.
         pass
 
     return False
+
+
+def metatile_digest(tile_data):
+    """
+    Return a hex digest of the contents of a metatile.
+
+    For zip metatiles this is made from the names, uncompressed sizes and
+    CRC32s of the members, so that it ignores timestamps and ordering in the
+    same way that metatiles_are_equal does. Indexed metatiles are always
+    written the same way for the same tiles, so their digest is of the bytes.
+    """
+
+    if tile_data.startswith(INDEXED_MAGIC):
+        return hashlib.md5(tile_data).hexdigest()
+
+    with zipfile.ZipFile(StringIO.StringIO(tile_data), mode='r') as z:
+        members = sorted((info.filename, info.file_size, info.CRC)
+                         for info in z.infolist())
+
+    m = hashlib.md5()
+    for name, size, crc in members:
+        m.update('%s\0%d\0%d\n' % (name, size, crc))
+    return m.hexdigest()
@@ -6,13 +6,29 @@ from shapely import geometry
 from shapely.wkb import loads
 from sys import getsizeof
 from tilequeue.config import create_query_bounds_pad_fn
+from tilequeue.tile import calc_meters_per_pixel_area
 from tilequeue.tile import calc_meters_per_pixel_dim
 from tilequeue.tile import coord_to_mercator_bounds
 from tilequeue.tile import normalize_geometry_type
+from tilequeue.tile import tolerance_for_zoom
+from tilequeue.transform import calc_buffer_pixels
+from tilequeue.transform import calculate_padded_bounds
+from tilequeue.transform import clip_to_rect
+from tilequeue.transform import ClipCache
+from tilequeue.transform import format_transform_kind
+from tilequeue.transform import LngLatProjectionCache
 from tilequeue.transform import mercator_point_to_lnglat
 from tilequeue.transform import transform_feature_layers_shape
 from tilequeue import utils
 from zope.dottedname.resolve import resolve
+import shapely.errors
+
+
+# strategies for cutting child tiles out of a metatile. 'flat' cuts every
+# child from the full metatile geometry. 'hierarchical' cuts each child from
+# its parent, which has already been clipped down to the area covered by it
+# and its own children.
+CUT_STRATEGIES = ('flat', 'hierarchical')
 
 
 def make_transform_fn(transform_fns):
@@ -60,26 +76,144 @@ Context = namedtuple('Context', [
 ])
 
 
+# a post-process step with its function already resolved.
+PostProcessStep = namedtuple('PostProcessStep', 'fn params resources')
+
+
+def resolve_post_process_steps(post_process_data):
+    steps = []
+    for step in post_process_data:
+        steps.append(PostProcessStep(
+            fn=resolve(step['fn_name']),
+            params=step['params'],
+            resources=step['resources'],
+        ))
+    return steps
+
+
+# the callables needed to process a layer.
+LayerPlan = namedtuple('LayerPlan', [
+    'transform_fn',      # combined transform function, or None
+    'sort_fn',           # sort function, or None
+    'output_calc',       # output calculation, or None if not configured
+    'pad_fn',            # function to pad the bounds for cutting tiles
+])
+
+
+class ProcessingPlan(object):
+
+    """
+    Everything about processing tiles which depends only on configuration.
+
+    The dotted function names in the layer and post-process configuration
+    are resolved, and the buffer configuration looked up, once rather than
+    for every tile. A plan can be built once when a worker starts and then
+    passed to process_coord for each tile.
+
+    Layer plans and buffer lookups are made on first use, so layers which
+    are created by post-processing steps are handled too.
+    """
+
+    def __init__(self, layer_data, post_process_data, buffer_cfg,
+                 output_calc_mapping, cut_strategy='flat',
+                 simplify_geometry=False):
+        if cut_strategy not in CUT_STRATEGIES:
+            raise ValueError('Unrecognized cut strategy: `{}`'.format(
+                cut_strategy))
+        self.cut_strategy = cut_strategy
+        self.simplify_geometry = simplify_geometry
+        self.buffer_cfg = buffer_cfg
+        self.output_calc_mapping = output_calc_mapping
+        self.post_process_steps = resolve_post_process_steps(
+            post_process_data)
+        self.layer_plans = {}
+        self.buffer_pixels_cache = {}
+        self.format_signature_cache = {}
+        for layer_datum in layer_data or ():
+            self.layer_plan(layer_datum)
+
+    def layer_plan(self, layer_datum):
+        layer_name = layer_datum['name']
+        plan = self.layer_plans.get(layer_name)
+        if plan is None:
+            transform_fns = resolve_transform_fns(
+                layer_datum.get('transform_fn_names'))
+            sort_fn_name = layer_datum.get('sort_fn_name')
+            pad_fn = layer_datum.get('query_bounds_pad_fn')
+            if pad_fn is None:
+                pad_fn = create_query_bounds_pad_fn(
+                    self.buffer_cfg, layer_name)
+            plan = LayerPlan(
+                transform_fn=make_transform_fn(transform_fns),
+                sort_fn=resolve(sort_fn_name) if sort_fn_name else None,
+                output_calc=self.output_calc_mapping.get(layer_name),
+                pad_fn=pad_fn,
+            )
+            self.layer_plans[layer_name] = plan
+        return plan
+
+    def pad_fn(self, layer_name):
+        plan = self.layer_plans.get(layer_name)
+        if plan is not None:
+            return plan.pad_fn
+        return create_query_bounds_pad_fn(self.buffer_cfg, layer_name)
+
+    def buffer_pixels(self, format, layer_name, geometry_type):
+        key = format.extension, layer_name, geometry_type
+        try:
+            return self.buffer_pixels_cache[key]
+        except KeyError:
+            pixels = calc_buffer_pixels(
+                format, layer_name, geometry_type, self.buffer_cfg)
+            self.buffer_pixels_cache[key] = pixels
+            return pixels
+
+    def format_signature(self, format, layer_names):
+        """
+        Return a key which is the same for formats which make the same tile
+        from the same layers, because they use the same formatter and
+        geometry transformation, and buffer each layer's geometry by the
+        same amount. For example, mvt and mvtb with the same buffers.
+        """
+
+        key = format.extension, layer_names
+        try:
+            return self.format_signature_cache[key]
+        except KeyError:
+            buffers = tuple(
+                tuple(self.buffer_pixels(format, layer_name, geometry_type)
+                      for geometry_type in ('Point', 'LineString', 'Polygon'))
+                for layer_name in layer_names)
+            signature = (
+                format.format_fn,
+                format_transform_kind(format),
+                format.supports_shapely_geometry,
+                buffers,
+            )
+            self.format_signature_cache[key] = signature
+            return signature
+
+
 # post-process all the layers simultaneously, which allows new
 # layers to be created from processing existing ones (e.g: for
 # computed centroids) or modifying layers based on the contents
 # of other layers (e.g: projecting attributes, deleting hidden
 # features, etc...)
+#
+# the steps are PostProcessStep objects, see resolve_post_process_steps.
 def _postprocess_data(
-        feature_layers, post_process_data, nominal_zoom, unpadded_bounds):
-
-    for step in post_process_data:
-        fn = resolve(step['fn_name'])
+        feature_layers, post_process_steps, nominal_zoom, unpadded_bounds):
 
+    for step in post_process_steps:
         ctx = Context(
             feature_layers=feature_layers,
             nominal_zoom=nominal_zoom,
             unpadded_bounds=unpadded_bounds,
-            params=step['params'],
-            resources=step['resources'],
+            params=step.params,
+            resources=step.resources,
         )
 
-        layer = fn(ctx)
+        layer = step.fn(ctx)
         feature_layers = ctx.feature_layers
         if layer is not None:
             for index, feature_layer in enumerate(feature_layers):
@@ -97,28 +231,149 @@ def _postprocess_data(
     return feature_layers
 
 
+class _FeatureGrid(object):
+
+    """
+    Index of the bounding boxes of a layer's features on a regular grid.
+
+    The grid covers the given extent in size x size cells. Features outside
+    the extent are put in the cells along the edge, so that queries are still
+    correct. Features which cover a lot of cells are kept in a separate list,
+    which is returned for every query, rather than being added to them all.
+    """
+
+    def __init__(self, feature_bounds, extent, size=16, max_cells=16):
+        self.minx, self.miny, maxx, maxy = extent
+        self.size = size
+        self.cell_w = float(maxx - self.minx) / size
+        self.cell_h = float(maxy - self.miny) / size
+        self.cells = defaultdict(list)
+        self.always = []
+
+        for index, bounds in enumerate(feature_bounds):
+            if not bounds:
+                self.always.append(index)
+                continue
+            x0, y0, x1, y1 = self._cell_range(bounds)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > max_cells:
+                self.always.append(index)
+                continue
+            for x in xrange(x0, x1 + 1):
+                for y in xrange(y0, y1 + 1):
+                    self.cells[x, y].append(index)
+
+    def _cell(self, value, origin, cell_dim):
+        if cell_dim <= 0:
+            return 0
+        cell = int((value - origin) / cell_dim)
+        return min(max(cell, 0), self.size - 1)
+
+    def _cell_range(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        return (self._cell(minx, self.minx, self.cell_w),
+                self._cell(miny, self.miny, self.cell_h),
+                self._cell(maxx, self.minx, self.cell_w),
+                self._cell(maxy, self.miny, self.cell_h))
+
+    def query(self, bounds):
+        """
+        Return the indexes, in order, of the features which might intersect
+        the bounds.
+        """
+
+        x0, y0, x1, y1 = self._cell_range(bounds)
+        candidates = set(self.always)
+        for x in xrange(x0, x1 + 1):
+            for y in xrange(y0, y1 + 1):
+                candidates.update(self.cells.get((x, y), ()))
+        return sorted(candidates)
+
+
+class _LayerIndex(object):
+
+    """
+    Bounding boxes of a layer's features, and a grid index of them, which
+    are computed once and used for cutting each of the child tiles.
+    """
+
+    def __init__(self, features, extent):
+        self.bounds = []
+        self.geom_types = []
+        for shape, props, feature_id in features:
+            self.bounds.append(shape.bounds)
+            self.geom_types.append(normalize_geometry_type(shape.type))
+        self.grid = _FeatureGrid(self.bounds, extent)
+
+
+def _index_feature_layers(feature_layers, extent):
+    return [_LayerIndex(feature_layer['features'], extent)
+            for feature_layer in feature_layers]
+
+
+def _bounds_union(all_bounds):
+    return (min(b[0] for b in all_bounds), min(b[1] for b in all_bounds),
+            max(b[2] for b in all_bounds), max(b[3] for b in all_bounds))
+
+
+def _feature_in_bounds(shape, shape_bounds, bounds):
+    """
+    Return whether the shape intersects the bounds. Only shapes whose
+    bounding box straddles the edge of the bounds need an exact test.
+    """
+
+    if not shape_bounds:
+        return geometry.box(*bounds).intersects(shape)
+
+    minx, miny, maxx, maxy = bounds
+    s_minx, s_miny, s_maxx, s_maxy = shape_bounds
+    if s_maxx < minx or s_minx > maxx or s_maxy < miny or s_miny > maxy:
+        return False
+    if (minx <= s_minx and s_maxx <= maxx and
+            miny <= s_miny and s_maxy <= maxy):
+        return True
+    return geometry.box(*bounds).intersects(shape)
+
+
 def _cut_coord(
-        feature_layers, unpadded_bounds, meters_per_pixel_dim, buffer_cfg):
+        feature_layers, unpadded_bounds, meters_per_pixel_dim, plan,
+        layer_indexes=None):
+    # layer_indexes, if given, is a list of _LayerIndex, one for each
+    # feature layer, used to avoid testing every feature against the bounds.
     cut_feature_layers = []
-    for feature_layer in feature_layers:
+    for layer_no, feature_layer in enumerate(feature_layers):
         features = feature_layer['features']
-        padded_bounds_fn = create_query_bounds_pad_fn(
-            buffer_cfg, feature_layer['name'])
+        padded_bounds_fn = plan.pad_fn(feature_layer['name'])
         padded_bounds = padded_bounds_fn(unpadded_bounds, meters_per_pixel_dim)
 
         cut_features = []
-        for feature in features:
-            shape, props, feature_id = feature
+        if layer_indexes is None:
+            for feature in features:
+                shape, props, feature_id = feature
+
+                geom_type_bounds = padded_bounds[
+                    normalize_geometry_type(shape.type)]
+                shape_padded_bounds = geometry.box(*geom_type_bounds)
+                if not shape_padded_bounds.intersects(shape):
+                    continue
+                props_copy = props.copy()
+                cut_feature = shape, props_copy, feature_id
 
-            geom_type_bounds = padded_bounds[
-                normalize_geometry_type(shape.type)]
-            shape_padded_bounds = geometry.box(*geom_type_bounds)
-            if not shape_padded_bounds.intersects(shape):
-                continue
-            props_copy = props.copy()
-            cut_feature = shape, props_copy, feature_id
+                cut_features.append(cut_feature)
+
+        else:
+            layer_index = layer_indexes[layer_no]
+            query_bounds = _bounds_union(padded_bounds.values())
+            for index in layer_index.grid.query(query_bounds):
+                shape, props, feature_id = features[index]
+
+                geom_type_bounds = padded_bounds[layer_index.geom_types[index]]
+                if not _feature_in_bounds(
+                        shape, layer_index.bounds[index], geom_type_bounds):
+                    continue
+                props_copy = props.copy()
+                cut_feature = shape, props_copy, feature_id
 
-            cut_features.append(cut_feature)
+                cut_features.append(cut_feature)
 
         cut_feature_layer = dict(
             name=feature_layer['name'],
@@ -131,6 +386,133 @@ def _cut_coord(
     return cut_feature_layers
 
 
+def _clip_node_shape(shape, clip_bounds):
+    """
+    Clip a shape for a node of the hierarchical cut. Returns None if the
+    shape doesn't intersect the clip bounds at all.
+
+    If clipping changes the type of the geometry, for example a polygon
+    which only touches the edge becomes a line, or the result is invalid,
+    then the original shape is kept. The final clip for each tile will
+    deal with it.
+    """
+
+    if shape.is_empty:
+        return None
+    shape_bounds = shape.bounds
+    if not _feature_in_bounds(shape, shape_bounds, clip_bounds):
+        return None
+    if shape.type in ('Point', 'MultiPoint'):
+        return shape
+
+    try:
+        clipped = clip_to_rect(shape, clip_bounds)
+    except shapely.errors.TopologicalError:
+        return shape
+
+    if clipped.is_empty:
+        return None
+    if normalize_geometry_type(shape.type) != \
+            _geom_type_lookup_or_none(clipped.type):
+        return shape
+    if not clipped.is_valid:
+        return shape
+    return clipped
+
+
+def _geom_type_lookup_or_none(geom_type):
+    if geom_type == 'GeometryCollection':
+        return None
+    return normalize_geometry_type(geom_type)
+
+
+def _clip_node(feature_layers, unpadded_bounds, meters_per_pixel_dim, plan):
+    """
+    Clip the features of the clipped layers to the area which could be
+    needed by the tile with the given bounds, or any of its children.
+
+    The children's bounds are all inside the tile's bounds, and their
+    buffers are the same size in meters, as they're all formatted at the
+    same nominal zoom. So the largest area any of them could clip to is the
+    tile's own buffered bounds, expanded by the layer's clip factor.
+    """
+
+    node_feature_layers = []
+    for feature_layer in feature_layers:
+        layer_datum = feature_layer['layer_datum']
+        if not layer_datum.get('is_clipped', True):
+            node_feature_layers.append(feature_layer)
+            continue
+
+        padded_bounds_fn = plan.pad_fn(feature_layer['name'])
+        padded_bounds = padded_bounds_fn(unpadded_bounds, meters_per_pixel_dim)
+        buffered_bounds = _bounds_union(padded_bounds.values())
+        clip_factor = layer_datum.get('clip_factor', 1.0)
+        clip_bounds = calculate_padded_bounds(
+            max(clip_factor, 1.0), buffered_bounds).bounds
+
+        clipped_features = []
+        for shape, props, feature_id in feature_layer['features']:
+            shape = _clip_node_shape(shape, clip_bounds)
+            if shape is not None:
+                clipped_features.append((shape, props, feature_id))
+
+        node_feature_layer = dict(feature_layer)
+        node_feature_layer['features'] = clipped_features
+        node_feature_layers.append(node_feature_layer)
+
+    return node_feature_layers
+
+
+class _HierarchicalCutter(object):
+
+    """
+    Cut child tiles from their parent's clipped features rather than from
+    the full metatile.
+
+    The clipped features for each tile between the metatile and the cut
+    coordinates are computed on demand, and kept for the other children of
+    the same parent.
+    """
+
+    def __init__(self, coord, feature_layers, meters_per_pixel_dim, plan):
+        self.root = coord
+        self.meters_per_pixel_dim = meters_per_pixel_dim
+        self.plan = plan
+        self.nodes = {self._key(coord): feature_layers}
+
+    def _key(self, coord):
+        return int(coord.zoom), int(coord.column), int(coord.row)
+
+    def is_descendant(self, coord):
+        dz = int(coord.zoom) - int(self.root.zoom)
+        if dz <= 0:
+            return False
+        return (int(coord.column) >> dz == int(self.root.column) and
+                int(coord.row) >> dz == int(self.root.row))
+
+    def node_feature_layers(self, coord):
+        key = self._key(coord)
+        feature_layers = self.nodes.get(key)
+        if feature_layers is None:
+            parent = coord.zoomBy(-1).container()
+            parent_feature_layers = self.node_feature_layers(parent)
+            feature_layers = _clip_node(
+                parent_feature_layers, coord_to_mercator_bounds(coord),
+                self.meters_per_pixel_dim, self.plan)
+            self.nodes[key] = feature_layers
+        return feature_layers
+
+    def parent_feature_layers(self, coord):
+        """
+        Return the feature layers to cut the given descendant coordinate
+        from.
+        """
+
+        assert self.is_descendant(coord)
+        return self.node_feature_layers(coord.zoomBy(-1).container())
+
+
 def _make_valid_if_necessary(shape):
     """
     attempt to correct invalid shapes if necessary
@@ -176,14 +558,191 @@ def _visible_shape(shape, area_threshold_meters):
         return shape
 
 
+def _count_vertices(shape):
+    geom_type = shape.type
+    if shape.is_empty:
+        return 0
+    elif geom_type in ('Point', 'LineString', 'LinearRing'):
+        return len(shape.coords)
+    elif geom_type == 'Polygon':
+        return len(shape.exterior.coords) + sum(
+            len(ring.coords) for ring in shape.interiors)
+    else:
+        return sum(_count_vertices(part) for part in shape.geoms)
+
+
+def _wkb_size(shape):
+    # size of the 2D WKB encoding of the shape, worked out from its
+    # structure rather than by encoding it.
+    geom_type = shape.type
+    header = 1 + 4
+    if geom_type == 'Point':
+        return header + 16
+    elif geom_type in ('LineString', 'LinearRing'):
+        return header + 4 + 16 * len(shape.coords)
+    elif geom_type == 'Polygon':
+        if shape.is_empty:
+            return header + 4
+        rings = [shape.exterior] + list(shape.interiors)
+        return header + 4 + sum(4 + 16 * len(r.coords) for r in rings)
+    else:
+        return header + 4 + sum(_wkb_size(part) for part in shape.geoms)
+
+
+def _filter_geom_types(shape, geom_type):
+    """
+    Return the parts of a geometry collection which have the same
+    dimension as geom_type, or None if there aren't any.
+    """
+
+    keep_type = normalize_geometry_type(geom_type)
+    parts = []
+    for part in shape.geoms:
+        if part.type != 'GeometryCollection' and not part.is_empty and \
+                normalize_geometry_type(part.type) == keep_type:
+            parts.append(part)
+
+    if not parts:
+        return None
+    elif len(parts) == 1:
+        return parts[0]
+    elif keep_type == 'polygon':
+        polys = []
+        for part in parts:
+            polys.extend(getattr(part, 'geoms', [part]))
+        return MultiPolygon(polys)
+    elif keep_type == 'line':
+        lines = []
+        for part in parts:
+            lines.extend(getattr(part, 'geoms', [part]))
+        return geometry.MultiLineString(lines)
+    else:
+        points = []
+        for part in parts:
+            points.extend(getattr(part, 'geoms', [part]))
+        return geometry.MultiPoint(points)
+
+
+def _reduce_geometry(feature_layers, unpadded_bounds, nominal_zoom, plan):
+    """
+    Clip, simplify and drop invisible parts of the features according to
+    each layer's configuration.
+
+    Layers with is_clipped set are clipped to their clip_factor padded
+    bounds. From the layer's simplify_start zoom up to (but not including)
+    z16, shapes are simplified to about a pixel, either before clipping
+    (to a slightly larger box, so that simplifying doesn't move the edges
+    of the tile) or after, depending on simplify_before_intersect. Below
+    z16, polygons and parts of multipolygons with an area smaller than the
+    layer's area_threshold in square pixels are dropped.
+
+    Returns the new feature layers, and the number of vertices and WKB
+    bytes before and after for each layer.
+    """
+
+    meters_per_pixel_dim = calc_meters_per_pixel_dim(nominal_zoom)
+    meters_per_pixel_area = calc_meters_per_pixel_area(nominal_zoom)
+    tolerance = tolerance_for_zoom(nominal_zoom)
+
+    reduction = {}
+    reduced_feature_layers = []
+    for feature_layer in feature_layers:
+        layer_datum = feature_layer['layer_datum']
+        layer_name = layer_datum['name']
+        is_clipped = layer_datum.get('is_clipped', True)
+        clip_factor = layer_datum.get('clip_factor', 1.0)
+        simplify_start = layer_datum.get('simplify_start', 0)
+        simplify_before_intersect = layer_datum.get(
+            'simplify_before_intersect', False)
+        area_threshold_meters = \
+            meters_per_pixel_area * layer_datum.get('area_threshold', 1)
+        should_simplify = simplify_start <= nominal_zoom < 16
+
+        padded_bounds = plan.pad_fn(layer_name)(
+            unpadded_bounds, meters_per_pixel_dim)
+
+        vertices_in = vertices_out = 0
+        bytes_in = bytes_out = 0
+        reduced_features = []
+        for shape, props, feature_id in feature_layer['features']:
+            original_geom_type = shape.type
+            vertices_in += _count_vertices(shape)
+            bytes_in += _wkb_size(shape)
+
+            if shape.is_empty or original_geom_type == 'GeometryCollection':
+                reduced_features.append((shape, props, feature_id))
+                vertices_out += _count_vertices(shape)
+                bytes_out += _wkb_size(shape)
+                continue
+
+            geom_type = normalize_geometry_type(original_geom_type)
+            layer_padded_bounds = calculate_padded_bounds(
+                clip_factor, padded_bounds[geom_type]).bounds
+
+            if should_simplify and simplify_before_intersect:
+                # clip to a box a little larger than the tile before
+                # simplifying, so that simplifying huge shapes doesn't take
+                # too long, but the simplification doesn't pull the shape
+                # away from the edges of the tile.
+                min_x, min_y, max_x, max_y = layer_padded_bounds
+                gutter = (max_x - min_x) * 0.1
+                gutter_bounds = (min_x - gutter, min_y - gutter,
+                                 max_x + gutter, max_y + gutter)
+                shape = clip_to_rect(shape, gutter_bounds)
+                shape = shape.simplify(tolerance, preserve_topology=True)
+                shape = _make_valid_if_necessary(shape)
+
+            if is_clipped and shape is not None:
+                shape = clip_to_rect(shape, layer_padded_bounds)
+
+            if should_simplify and not simplify_before_intersect and \
+                    shape is not None:
+                shape = shape.simplify(tolerance, preserve_topology=True)
+                shape = _make_valid_if_necessary(shape)
+
+            # this could alter multipolygon geometries
+            if nominal_zoom < 16:
+                shape = _visible_shape(shape, area_threshold_meters)
+
+            if shape is None or shape.is_empty:
+                continue
+
+            # if clipping and simplifying made a geometry collection, for
+            # example by a polygon just touching the clip box, then trim it
+            # back to the original type of geometry.
+            if shape.type == 'GeometryCollection':
+                shape = _filter_geom_types(shape, original_geom_type)
+                if shape is None:
+                    continue
+
+            vertices_out += _count_vertices(shape)
+            bytes_out += _wkb_size(shape)
+            reduced_features.append((shape, props, feature_id))
+
+        reduction[layer_name] = dict(
+            vertices_in=vertices_in,
+            vertices_out=vertices_out,
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+        )
+
+        reduced_feature_layer = dict(feature_layer)
+        reduced_feature_layer['features'] = reduced_features
+        reduced_feature_layers.append(reduced_feature_layer)
+
+    return reduced_feature_layers, reduction
+
+
 def _create_formatted_tile(
         feature_layers, format, scale, unpadded_bounds, unpadded_bounds_lnglat,
-        coord, nominal_zoom, layer, meters_per_pixel_dim, buffer_cfg):
+        coord, nominal_zoom, layer, meters_per_pixel_dim, plan,
+        projection_cache, clip_cache=None):
 
     # perform format specific transformations
     transformed_feature_layers = transform_feature_layers_shape(
         feature_layers, format, scale, unpadded_bounds,
-        meters_per_pixel_dim, buffer_cfg)
+        meters_per_pixel_dim, plan.buffer_cfg, plan.buffer_pixels,
+        projection_cache, clip_cache)
 
     # use the formatter to generate the tile
     tile_data_file = StringIO()
@@ -258,7 +817,11 @@ def meta_for_properties(query_props):
 
 def process_coord_no_format(
         feature_layers, nominal_zoom, unpadded_bounds, post_process_data,
-        output_calc_mapping):
+        output_calc_mapping, plan=None):
+
+    if plan is None:
+        plan = ProcessingPlan(
+            None, post_process_data, None, output_calc_mapping)
 
     extra_data = dict(size={})
     processed_feature_layers = []
@@ -269,14 +832,9 @@ def process_coord_no_format(
         geometry_types = layer_datum['geometry_types']
         padded_bounds = feature_layer['padded_bounds']
 
-        transform_fn_names = layer_datum['transform_fn_names']
-        if transform_fn_names:
-            transform_fns = resolve_transform_fns(transform_fn_names)
-            layer_transform_fn = make_transform_fn(transform_fns)
-        else:
-            layer_transform_fn = None
-
-        layer_output_calc = output_calc_mapping.get(layer_name)
+        layer_plan = plan.layer_plan(layer_datum)
+        layer_transform_fn = layer_plan.transform_fn
+        layer_output_calc = layer_plan.output_calc
         assert layer_output_calc, 'output_calc_mapping missing layer: %s' % \
             layer_name
 
@@ -375,10 +933,8 @@ def process_coord_no_format(
 
         extra_data['size'][layer_datum['name']] = features_size
 
-        sort_fn_name = layer_datum['sort_fn_name']
-        if sort_fn_name:
-            sort_fn = resolve(sort_fn_name)
-            features = sort_fn(features, nominal_zoom)
+        if layer_plan.sort_fn:
+            features = layer_plan.sort_fn(features, nominal_zoom)
 
         feature_layer = dict(
             name=layer_name,
@@ -390,15 +946,22 @@ def process_coord_no_format(
 
     # post-process data here, before it gets formatted
     processed_feature_layers = _postprocess_data(
-        processed_feature_layers, post_process_data, nominal_zoom,
+        processed_feature_layers, plan.post_process_steps, nominal_zoom,
         unpadded_bounds)
 
+    # reduce the geometry to what's needed at this zoom, which saves work
+    # cutting and formatting it later.
+    if plan.simplify_geometry:
+        processed_feature_layers, extra_data['reduction'] = \
+            _reduce_geometry(processed_feature_layers, unpadded_bounds,
+                             nominal_zoom, plan)
+
     return processed_feature_layers, extra_data
 
 
 def _format_feature_layers(
         processed_feature_layers, coord, nominal_zoom, formats,
-        unpadded_bounds, scale, buffer_cfg):
+        unpadded_bounds, scale, plan, projection_cache):
 
     meters_per_pixel_dim = calc_meters_per_pixel_dim(nominal_zoom)
 
@@ -408,31 +971,45 @@ def _format_feature_layers(
         mercator_point_to_lnglat(unpadded_bounds[2], unpadded_bounds[3]))
 
     # now, perform the format specific transformations
-    # and format the tile itself
+    # and format the tile itself. formats which would make the same tile,
+    # such as mvt and mvtb with the same buffers, share it, and the others
+    # share any clipping which is the same between them.
     formatted_tiles = []
     layer = 'all'
+    layer_names = tuple(fl['name'] for fl in processed_feature_layers)
+    clip_cache = ClipCache() if len(formats) > 1 else None
+    tiles_by_signature = {}
     for format in formats:
-        formatted_tile = _create_formatted_tile(
-            processed_feature_layers, format, scale, unpadded_bounds,
-            unpadded_bounds_lnglat, coord, nominal_zoom, layer,
-            meters_per_pixel_dim, buffer_cfg)
+        signature = plan.format_signature(format, layer_names)
+        tile = tiles_by_signature.get(signature)
+        if tile is None:
+            formatted_tile = _create_formatted_tile(
+                processed_feature_layers, format, scale, unpadded_bounds,
+                unpadded_bounds_lnglat, coord, nominal_zoom, layer,
+                meters_per_pixel_dim, plan, projection_cache, clip_cache)
+            tiles_by_signature[signature] = formatted_tile['tile']
+        else:
+            formatted_tile = dict(
+                format=format, tile=tile, coord=coord, layer=layer)
         formatted_tiles.append(formatted_tile)
 
     return formatted_tiles
 
 
 def _cut_child_tiles(
-        feature_layers, cut_coord, nominal_zoom, formats, scale, buffer_cfg):
+        feature_layers, cut_coord, nominal_zoom, formats, scale, plan,
+        projection_cache, layer_indexes=None):
 
     unpadded_cut_bounds = coord_to_mercator_bounds(cut_coord)
     meters_per_pixel_dim = calc_meters_per_pixel_dim(nominal_zoom)
 
     cut_feature_layers = _cut_coord(
-        feature_layers, unpadded_cut_bounds, meters_per_pixel_dim, buffer_cfg)
+        feature_layers, unpadded_cut_bounds, meters_per_pixel_dim, plan,
+        layer_indexes)
 
     return _format_feature_layers(
         cut_feature_layers, cut_coord, nominal_zoom, formats,
-        unpadded_cut_bounds, scale, buffer_cfg)
+        unpadded_cut_bounds, scale, plan, projection_cache)
 
 
 def _calculate_scale(scale, coord, nominal_zoom):
@@ -447,7 +1024,24 @@ def _calculate_scale(scale, coord, nominal_zoom):
 
 def format_coord(
         coord, nominal_zoom, processed_feature_layers, formats,
-        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale):
+        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale,
+        plan=None):
+
+    if plan is None:
+        plan = ProcessingPlan(None, (), buffer_cfg, {})
+
+    # index the features once, the first time a child tile needs cutting,
+    # so that each cut only looks at the features near it.
+    layer_indexes = None
+
+    # shapes projected to lnglat, shared by all the tiles in the metatile.
+    projection_cache = LngLatProjectionCache()
+
+    hierarchical_cutter = None
+    if plan.cut_strategy == 'hierarchical':
+        hierarchical_cutter = _HierarchicalCutter(
+            coord, processed_feature_layers,
+            calc_meters_per_pixel_dim(nominal_zoom), plan)
 
     formatted_tiles = []
     for cut_coord in cut_coords:
@@ -457,12 +1051,24 @@ def format_coord(
             # no need for cutting if this is the original tile.
             tiles = _format_feature_layers(
                 processed_feature_layers, coord, nominal_zoom, formats,
-                unpadded_bounds, cut_scale, buffer_cfg)
+                unpadded_bounds, cut_scale, plan, projection_cache)
+
+        elif hierarchical_cutter is not None and \
+                hierarchical_cutter.is_descendant(cut_coord):
+            tiles = _cut_child_tiles(
+                hierarchical_cutter.parent_feature_layers(cut_coord),
+                cut_coord, nominal_zoom, formats,
+                _calculate_scale(scale, cut_coord, nominal_zoom), plan,
+                projection_cache)
 
         else:
+            if layer_indexes is None:
+                layer_indexes = _index_feature_layers(
+                    processed_feature_layers, unpadded_bounds)
             tiles = _cut_child_tiles(
                 processed_feature_layers, cut_coord, nominal_zoom, formats,
-                _calculate_scale(scale, cut_coord, nominal_zoom), buffer_cfg)
+                _calculate_scale(scale, cut_coord, nominal_zoom), plan,
+                projection_cache, layer_indexes)
 
         formatted_tiles.extend(tiles)
 
@@ -486,16 +1092,24 @@ def format_coord(
 # note that the coordinate `coord` is not implicitly rendered and formatted,
 # it must be included in `cut_coords` if a formatted version is wanted in
 # the output.
+#
+# the plan is a ProcessingPlan built from the same post-process data, buffer
+# config and output calc spec. workers processing many tiles should build one
+# up front and pass it in, otherwise one is built for each call.
 def process_coord(coord, nominal_zoom, feature_layers, post_process_data,
                   formats, unpadded_bounds, cut_coords, buffer_cfg,
-                  output_calc_spec, scale=4096):
+                  output_calc_spec, scale=4096, plan=None):
+    if plan is None:
+        plan = ProcessingPlan(
+            None, post_process_data, buffer_cfg, output_calc_spec)
+
     processed_feature_layers, extra_data = process_coord_no_format(
         feature_layers, nominal_zoom, unpadded_bounds, post_process_data,
-        output_calc_spec)
+        output_calc_spec, plan)
 
     all_formatted_tiles, extra_data = format_coord(
         coord, nominal_zoom, processed_feature_layers, formats,
-        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale)
+        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale, plan)
 
     return all_formatted_tiles, extra_data
 
@@ -1,5 +1,6 @@
 from tilequeue.query.fixture import make_fixture_data_fetcher
 from tilequeue.query.pool import DBConnectionPool
+from tilequeue.query.pool import split_conn_info
 from tilequeue.query.postgres import make_db_data_fetcher
 from tilequeue.query.rawr import make_rawr_data_fetcher
 from tilequeue.query.split import make_split_data_fetcher
@@ -11,13 +12,14 @@ __all__ = [
     'make_db_data_fetcher',
     'make_fixture_data_fetcher',
     'make_data_fetcher',
+    'split_conn_info',
 ]
 
 
-def make_data_fetcher(cfg, layer_data, query_cfg, io_pool):
+def make_data_fetcher(cfg, layer_data, query_cfg, io_pool, stats=None):
     db_fetcher = make_db_data_fetcher(
         cfg.postgresql_conn_info, cfg.template_path, cfg.reload_templates,
-        query_cfg, io_pool)
+        query_cfg, io_pool, stats, cfg.prepared_queries)
 
     if cfg.yml.get('use-rawr-tiles'):
         rawr_fetcher = _make_rawr_fetcher(
@@ -1,56 +1,245 @@
+from collections import Counter
+from collections import defaultdict
 from itertools import cycle
 from itertools import islice
+from psycopg2.extensions import connection as PsycopgConnection
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import register_hstore, register_json
+from tilequeue.utils import convert_seconds_to_millis
 import psycopg2
 import threading
+import time
 import ujson
 
 
+# keys of the postgresql config which are tilequeue settings, rather than
+# connection parameters for libpq.
+NON_CONN_INFO_KEYS = ('dbnames', 'max_conns_per_db', 'fetch_batch_size')
+
+
+def split_conn_info(postgresql_conn_info):
+    """Split the postgresql config into connection parameters and settings
+
+    Returns a dict of the parameters to pass to psycopg2.connect, and a dict
+    of the tilequeue settings, with each of NON_CONN_INFO_KEYS set to None
+    if it isn't configured.
+    """
+
+    conn_info = dict(postgresql_conn_info)
+    settings = dict((key, conn_info.pop(key, None))
+                    for key in NON_CONN_INFO_KEYS)
+    return conn_info, settings
+
+
+class PooledConnection(PsycopgConnection):
+
+    """Connection which remembers the pool database it was opened for
+
+    It also tracks the names of the statements prepared on it, as those only
+    exist for the lifetime of the connection, and when it was last returned
+    to the pool.
+    """
+
+    pool_dbname = None
+    prepared_statements = None
+    idle_since = None
+
+
 class ConnectionsContextManager(object):
 
-    """Handle automatically closing connections via with statement"""
+    """Handle automatically returning connections via with statement"""
 
-    def __init__(self, conns):
+    def __init__(self, pool, conns):
+        self.pool = pool
         self.conns = conns
 
     def __enter__(self):
         return self.conns
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for conn in self.conns:
-            try:
-                conn.close()
-            except Exception:
-                pass
+        self.pool.put_conns(self.conns)
         suppress_exception = False
         return suppress_exception
 
 
 class DBConnectionPool(object):
 
-    """Manage database connections with varying database names"""
+    """Manage database connections with varying database names
 
-    def __init__(self, dbnames, conn_info, readonly=True):
+    Connections are kept open and re-used across calls to get_conns. At most
+    max_conns_per_db connections are opened to each database, if set, and
+    callers wait for connections to be returned when that limit is reached.
+
+    Connections which are found to be broken, either when they are handed
+    out or when they are returned, are closed and replaced with new ones.
+    Idle connections are polled before being handed out, so that ones closed
+    by the server (e.g: after a Postgres or pgbouncer restart) are noticed,
+    and those idle for longer than idle_check_seconds are also sent a
+    "SELECT 1" to check that the server is still there.
+    """
+
+    def __init__(self, dbnames, conn_info, readonly=True,
+                 max_conns_per_db=None, stats=None, idle_check_seconds=30):
         self.dbnames = cycle(dbnames)
         self.conn_info = conn_info
-        self.conn_mapping = {}
-        self.lock = threading.Lock()
         self.readonly = readonly
+        self.max_conns_per_db = max_conns_per_db
+        self.stats = stats
+        self.idle_check_seconds = idle_check_seconds
 
-    def _make_conn(self, conn_info):
-        conn = psycopg2.connect(**conn_info)
+        self.lock = threading.Lock()
+        self.conns_available = threading.Condition(self.lock)
+        self.idle_conns = defaultdict(list)
+        self.n_open = defaultdict(int)
+        self.n_in_use = 0
+
+    def _make_conn(self, dbname):
+        conn_info_with_db = dict(self.conn_info, dbname=dbname)
+        conn = psycopg2.connect(
+            connection_factory=PooledConnection, **conn_info_with_db)
+        conn.pool_dbname = dbname
+        conn.prepared_statements = set()
         conn.set_session(readonly=self.readonly, autocommit=True)
         register_hstore(conn)
         register_json(conn, loads=ujson.loads)
         return conn
 
+    def _is_usable(self, conn):
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != TRANSACTION_STATUS_IDLE:
+            # a query was interrupted part way through, or something
+            # opened a transaction and didn't finish it.
+            try:
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        try:
+            # reads anything the server sent while the connection was idle,
+            # which raises if the server has closed the connection.
+            conn.poll()
+            idle_seconds = time.time() - (conn.idle_since or 0)
+            if idle_seconds >= self.idle_check_seconds:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _can_satisfy(self, n_needed_by_dbname):
+        if self.max_conns_per_db is None:
+            return True
+        for dbname, n_needed in n_needed_by_dbname.items():
+            n_idle = len(self.idle_conns[dbname])
+            n_unopened = self.max_conns_per_db - self.n_open[dbname]
+            if n_idle + n_unopened < n_needed:
+                return False
+        return True
+
     def get_conns(self, n_conn):
-        with self.lock:
+        start = time.time()
+        with self.conns_available:
             dbnames = list(islice(self.dbnames, n_conn))
+            n_needed_by_dbname = Counter(dbnames)
+            if self.max_conns_per_db is not None:
+                assert max(n_needed_by_dbname.values()) <= \
+                    self.max_conns_per_db, \
+                    'Requested more connections than the pool allows'
+
+            # wait until all the connections can be taken at once, rather
+            # than holding some while waiting for others, which could
+            # deadlock with other callers doing the same.
+            while not self._can_satisfy(n_needed_by_dbname):
+                self.conns_available.wait()
+
+            # take idle connections where possible, and reserve a slot for
+            # each connection which needs to be opened.
+            reserved = []
+            for dbname in dbnames:
+                idle_conns = self.idle_conns[dbname]
+                if idle_conns:
+                    reserved.append((dbname, idle_conns.pop()))
+                else:
+                    self.n_open[dbname] += 1
+                    reserved.append((dbname, None))
+            self.n_in_use += n_conn
+        wait_millis = convert_seconds_to_millis(time.time() - start)
+
+        # connecting happens outside the lock, so that slow connections
+        # don't hold up everyone else using the pool.
         conns = []
-        for dbname in dbnames:
-            conn_info_with_db = dict(self.conn_info, dbname=dbname)
-            conn = self._make_conn(conn_info_with_db)
-            conns.append(conn)
-        conns_ctx_mgr = ConnectionsContextManager(conns)
+        try:
+            for dbname, conn in reserved:
+                if conn is not None and self._is_alive(conn):
+                    conns.append(conn)
+                    continue
+                if conn is not None:
+                    # connection broke while idle, replace it
+                    self._close(conn)
+                conns.append(self._make_conn(dbname))
+        except Exception:
+            # return the slots that couldn't be filled, along with any
+            # connections we did manage to get.
+            with self.conns_available:
+                for dbname, _ in reserved[len(conns):]:
+                    self.n_open[dbname] -= 1
+                self.n_in_use -= n_conn - len(conns)
+                self.conns_available.notify_all()
+            self.put_conns(conns)
+            raise
+
+        self._emit_stats(wait_millis)
+        conns_ctx_mgr = ConnectionsContextManager(self, conns)
         return conns_ctx_mgr
+
+    def put_conns(self, conns):
+        usable = [(conn, self._is_usable(conn)) for conn in conns]
+        now = time.time()
+        with self.conns_available:
+            for conn, is_usable in usable:
+                if is_usable:
+                    conn.idle_since = now
+                    self.idle_conns[conn.pool_dbname].append(conn)
+                else:
+                    self.n_open[conn.pool_dbname] -= 1
+            self.n_in_use -= len(conns)
+            self.conns_available.notify_all()
+        for conn, is_usable in usable:
+            if not is_usable:
+                self._close(conn)
+
+    def closeall(self):
+        with self.conns_available:
+            conns = []
+            for dbname, idle_conns in self.idle_conns.items():
+                conns.extend(idle_conns)
+                self.n_open[dbname] -= len(idle_conns)
+            self.idle_conns.clear()
+        for conn in conns:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _emit_stats(self, wait_millis):
+        if self.stats is None:
+            return
+        with self.lock:
+            n_in_use = self.n_in_use
+            n_open = sum(self.n_open.values())
+        with self.stats.pipeline() as pipe:
+            pipe.timing('db.pool.wait', wait_millis)
+            pipe.gauge('db.pool.in_use', n_in_use)
+            pipe.gauge('db.pool.open', n_open)
@@ -1,15 +1,27 @@
 from collections import namedtuple
+from hashlib import md5
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
-from psycopg2.extras import RealDictCursor
+from numbers import Number
+from psycopg2.extensions import new_type
+from psycopg2.extensions import register_type
 from tilequeue.query import DBConnectionPool
+from tilequeue.query.pool import split_conn_info
 from tilequeue.transform import calculate_padded_bounds
+from tilequeue.utils import convert_seconds_to_millis
+import psycopg2
 import sys
+import time
 
 
 TemplateSpec = namedtuple('TemplateSpec', 'template start_zoom end_zoom')
 DataSource = namedtuple('DataSource', 'name template_specs')
 
+# a query compiled into a server side prepared statement. the sql is only
+# needed the first time the statement is used on each connection, after that
+# only the name and the bind parameters (the tile bounds) are sent.
+PreparedQuery = namedtuple('PreparedQuery', 'name source sql params')
+
 
 class TemplateFinder(object):
 
@@ -55,6 +67,10 @@ class TemplateQueryGenerator(object):
         return query
 
 
+def _union_queries(template_queries):
+    return '\nUNION ALL\n'.join(template_queries)
+
+
 class SourcesQueriesGenerator(object):
 
     def __init__(self, sources, query_generator):
@@ -72,78 +88,248 @@ class SourcesQueriesGenerator(object):
                         template_spec.template, bounds, zoom)
                     template_queries.append(template_query)
             if template_queries:
-                source_query = '\nUNION ALL\n'.join(template_queries)
+                source_query = _union_queries(template_queries)
                 queries.append(source_query)
         return queries
 
 
+class PreparedSourcesQueriesGenerator(object):
+
+    """Generate prepared queries for each source
+
+    The templates for each source are rendered once per zoom with the
+    bounds as bind parameters, so the SQL text doesn't change from tile to
+    tile. The zoom is still rendered into the SQL, as the templates use it
+    for control flow. Statements are named after a hash of their SQL, so
+    zooms which render identically share a statement.
+    """
+
+    def __init__(self, sources, query_generator, cache_queries):
+        self.sources = sources
+        self.query_generator = query_generator
+        self.cache_queries = cache_queries
+        self.compiled = {}
+
+    def _compile(self, source, zoom):
+        key = source.name, zoom
+        compiled = self.compiled.get(key) if self.cache_queries else None
+        if compiled is None:
+            template_queries = []
+            for template_spec in source.template_specs:
+                # NOTE: end_zoom is exclusive
+                if template_spec.start_zoom <= zoom < template_spec.end_zoom:
+                    template_query = self.query_generator(
+                        template_spec.template, bounds_params, zoom)
+                    template_queries.append(template_query)
+            if template_queries:
+                sql = _union_queries(template_queries)
+                name = 'tilequeue_%s' % md5(sql.encode('utf-8')).hexdigest()
+                compiled = name, sql
+            else:
+                compiled = ()
+            if self.cache_queries:
+                self.compiled[key] = compiled
+        return compiled
+
+    def __call__(self, zoom, bounds):
+        params = tuple(float(x) for x in bounds)
+        queries = []
+        for source in self.sources:
+            compiled = self._compile(source, zoom)
+            if compiled:
+                name, sql = compiled
+                queries.append(PreparedQuery(name, source.name, sql, params))
+        return queries
+
+
+class BoundsParams(object):
+
+    """Stand-in for the tile bounds when compiling prepared statements
+
+    The jinja filters render these as references to the statement's bind
+    parameters rather than as literal numbers, so that the same statement
+    can be executed for any tile.
+    """
+
+    def __init__(self, exprs):
+        self.exprs = tuple(exprs)
+
+    def __getitem__(self, index):
+        return self.exprs[index]
+
+    def __len__(self):
+        return len(self.exprs)
+
+    def padded(self, factor):
+        min_x, min_y, max_x, max_y = self.exprs
+        f = 0.5 * (factor - 1.0)
+        dx = '(%s - %s) * %.12f' % (max_x, min_x, f)
+        dy = '(%s - %s) * %.12f' % (max_y, min_y, f)
+        return BoundsParams((
+            '(%s - %s)' % (min_x, dx),
+            '(%s - %s)' % (min_y, dy),
+            '(%s + %s)' % (max_x, dx),
+            '(%s + %s)' % (max_y, dy),
+        ))
+
+
+bounds_params = BoundsParams(('$1', '$2', '$3', '$4'))
+
+
+def _coord_sql(value):
+    if isinstance(value, Number):
+        return '%.12f' % value
+    return value
+
+
+def _bbox_sql(bounds, srid):
+    min_point = 'ST_MakePoint(%s, %s)' % (
+        _coord_sql(bounds[0]), _coord_sql(bounds[1]))
+    max_point = 'ST_MakePoint(%s, %s)' % (
+        _coord_sql(bounds[2]), _coord_sql(bounds[3]))
+    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
+    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    return bbox
+
+
 def jinja_filter_geometry(value):
     return 'ST_AsBinary(%s)' % value
 
 
 def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(bounds, srid)
     bbox_filter = '%s && %s' % (geometry_col_name, bbox)
     return bbox_filter
 
 
 def jinja_filter_bbox_intersection(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(bounds, srid)
     bbox_intersection = 'st_intersection(%s, %s)' % (geometry_col_name, bbox)
     return bbox_intersection
 
 
 def jinja_filter_bbox_padded_intersection(
         bounds, geometry_col_name, pad_factor=1.1, srid=3857):
-    padded_bounds = calculate_padded_bounds(pad_factor, bounds)
+    if isinstance(bounds, BoundsParams):
+        padded_bounds = bounds.padded(pad_factor)
+    else:
+        padded_bounds = calculate_padded_bounds(pad_factor, bounds).bounds
     return jinja_filter_bbox_intersection(
-        padded_bounds.bounds, geometry_col_name, srid)
+        padded_bounds, geometry_col_name, srid)
 
 
 def jinja_filter_bbox(bounds, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(bounds, srid)
     return bbox
 
 
 def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(bounds, srid)
     bbox_filter = \
         '((%(col)s && %(bbox)s) AND st_overlaps(%(col)s, %(bbox)s))' \
         % dict(col=geometry_col_name, bbox=bbox)
     return bbox_filter
 
 
-def execute_query(conn, query):
-    try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query)
-        rows = list(cursor.fetchall())
+def _execute_prepared(cursor, conn, query, stats):
+    if query.name not in conn.prepared_statements:
+        start = time.time()
+        cursor.execute('PREPARE %s (float8, float8, float8, float8) AS %s' %
+                       (query.name, query.sql))
+        conn.prepared_statements.add(query.name)
+        if stats is not None:
+            stats.timing('db.query.%s.prepare' % query.source,
+                         convert_seconds_to_millis(time.time() - start))
+
+    start = time.time()
+    cursor.execute('EXECUTE %s (%%s, %%s, %%s, %%s)' % query.name,
+                   query.params)
+    if stats is not None:
+        stats.timing('db.query.%s.execute' % query.source,
+                     convert_seconds_to_millis(time.time() - start))
+
+
+def _cast_bytea(value, cursor):
+    # the stock caster returns a buffer, which would need copying into a
+    # string before it can be parsed or pickled anyway.
+    buf = psycopg2.BINARY(value, cursor)
+    if buf is None:
+        return None
+    return bytes(buf)
+
+
+BYTEA_AS_BYTES = new_type(psycopg2.BINARY.values, 'BYTEA_AS_BYTES',
+                          _cast_bytea)
+
+# number of rows to read at a time when the results are read in batches.
+DEFAULT_FETCH_BATCH_SIZE = 2000
+
+
+def _read_rows(cursor, batch_size):
+    # build each row as a dict directly from the tuples returned by the
+    # cursor, leaving out nulls, rather than going via a dict cursor and
+    # then copying every row again to filter them.
+    col_names = None
+    rows = []
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        if col_names is None:
+            col_names = [col.name for col in cursor.description]
+        for values in batch:
+            row = {}
+            for k, v in zip(col_names, values):
+                if v is not None:
+                    row[k] = v
+            rows.append(row)
+    return rows
 
-        return rows
-    except Exception:
-        # TODO this kind of thing is only necessary if we re-use connections
 
-        # If any exception occurs during query execution, close the
-        # connection to ensure it is not in an invalid state. The
-        # connection pool knows to create new connections to replace
-        # those that are closed
+def execute_query(conn, query, stats=None, fetch_batch_size=None):
+    """Run a query and return its rows as dicts without null values
+
+    If fetch_batch_size is set, the results are streamed from a server side
+    cursor in batches of that size, rather than having the whole result set
+    sent in one go. This isn't possible for prepared queries, as postgres
+    can't declare a cursor for an EXECUTE, so those are always sent in one
+    go, but still read in batches.
+    """
+
+    # connections are returned to the pool afterwards, which checks that
+    # they're still usable and replaces them if not. so there's no need to
+    # close the connection here if the query fails.
+    use_named_cursor = fetch_batch_size is not None and \
+        not isinstance(query, PreparedQuery)
+    batch_size = fetch_batch_size or DEFAULT_FETCH_BATCH_SIZE
+
+    if use_named_cursor:
+        # server side cursors only exist inside a transaction, and the
+        # pooled connections are in autocommit mode.
+        conn.autocommit = False
+        cursor = conn.cursor(name='tilequeue_fetch')
+        cursor.itersize = batch_size
+    else:
+        cursor = conn.cursor()
+    register_type(BYTEA_AS_BYTES, cursor)
+
+    try:
+        if isinstance(query, PreparedQuery):
+            _execute_prepared(cursor, conn, query, stats)
+        else:
+            cursor.execute(query)
+        rows = _read_rows(cursor, batch_size)
+        return rows
+    finally:
         try:
-            conn.close()
+            cursor.close()
+            if use_named_cursor:
+                conn.rollback()
+                conn.autocommit = True
         except Exception:
+            # the connection is broken, which the pool will notice. don't
+            # hide the error which broke it.
             pass
-        raise
 
 
 class DataFetchException(Exception):
@@ -158,15 +344,18 @@ class DataFetchException(Exception):
 
 class DataFetcher(object):
 
-    def __init__(self, conn_info, queries_generator, io_pool):
-        self.conn_info = dict(conn_info)
+    def __init__(self, conn_info, queries_generator, io_pool, stats=None):
+        self.conn_info, settings = split_conn_info(conn_info)
         self.queries_generator = queries_generator
         self.io_pool = io_pool
+        self.stats = stats
 
-        self.dbnames = self.conn_info.pop('dbnames')
+        self.dbnames = settings['dbnames']
+        self.fetch_batch_size = settings['fetch_batch_size']
         self.dbnames_query_index = 0
         self.sql_conn_pool = DBConnectionPool(
-            self.dbnames, self.conn_info)
+            self.dbnames, self.conn_info,
+            max_conns_per_db=settings['max_conns_per_db'], stats=stats)
 
     def fetch_tiles(self, all_data):
         # postgres data fetcher doesn't need this kind of session management,
@@ -184,7 +373,8 @@ class DataFetcher(object):
             async_results = []
             for query, conn in zip(queries, sql_conns):
                 async_result = self.io_pool.apply_async(
-                    execute_query, (conn, query))
+                    execute_query,
+                    (conn, query, self.stats, self.fetch_batch_size))
                 async_results.append(async_result)
 
             all_source_rows = []
@@ -204,17 +394,7 @@ class DataFetcher(object):
             if async_exceptions:
                 raise DataFetchException(async_exceptions)
 
-        read_rows = []
-        for row in all_source_rows:
-            read_row = {}
-            for k, v in row.items():
-                if isinstance(v, buffer):
-                    v = bytes(v)
-                if v is not None:
-                    read_row[k] = v
-            read_rows.append(read_row)
-
-        return read_rows
+        return all_source_rows
 
 
 def make_jinja_environment(template_path):
@@ -229,12 +409,17 @@ def make_jinja_environment(template_path):
     return environment
 
 
-def make_queries_generator(sources, template_path, reload_templates):
+def make_queries_generator(sources, template_path, reload_templates,
+                           prepared=False):
     jinja_environment = make_jinja_environment(template_path)
     cache_templates = not reload_templates
     template_finder = TemplateFinder(jinja_environment, cache_templates)
     query_generator = TemplateQueryGenerator(template_finder)
-    queries_generator = SourcesQueriesGenerator(sources, query_generator)
+    if prepared:
+        queries_generator = PreparedSourcesQueriesGenerator(
+            sources, query_generator, cache_templates)
+    else:
+        queries_generator = SourcesQueriesGenerator(sources, query_generator)
     return queries_generator
 
 
@@ -256,14 +441,18 @@ def parse_source_data(queries_cfg):
 
 
 def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
-                         query_cfg, io_pool):
+                         query_cfg, io_pool, stats=None, prepared=False):
     """
     Returns an object which is callable with the zoom and unpadded bounds and
     which returns a list of rows.
+
+    If prepared is set, the queries are compiled into server side prepared
+    statements with the bounds as bind parameters, rather than rendered
+    with literal bounds for every tile.
     """
 
     sources = parse_source_data(query_cfg)
     queries_generator = make_queries_generator(
-        sources, template_path, reload_templates)
+        sources, template_path, reload_templates, prepared)
     return DataFetcher(
-        postgresql_conn_info, queries_generator, io_pool)
+        postgresql_conn_info, queries_generator, io_pool, stats)
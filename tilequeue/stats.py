@@ -20,6 +20,28 @@ class TileProcessingStatsHandler(object):
                       coord_proc_data.store_info['stored'])
             pipe.incr('process.storage.skipped',
                       coord_proc_data.store_info['not_stored'])
+            if 'index_hits' in coord_proc_data.store_info:
+                pipe.incr('process.storage.index.hits',
+                          coord_proc_data.store_info['index_hits'])
+                pipe.incr('process.storage.index.misses',
+                          coord_proc_data.store_info['index_misses'])
+
+            transport_info = coord_proc_data.transport_info
+            if transport_info:
+                pipe.gauge('process.transport.bytes', transport_info['bytes'])
+
+            reduction = coord_proc_data.reduction
+            if reduction:
+                for layer_name, layer_reduction in reduction.items():
+                    prefix = 'process.reduction.%s' % layer_name
+                    pipe.gauge(prefix + '.vertices',
+                               layer_reduction['vertices_out'])
+                    pipe.gauge(prefix + '.vertices_removed',
+                               layer_reduction['vertices_in'] -
+                               layer_reduction['vertices_out'])
+                    pipe.gauge(prefix + '.bytes_removed',
+                               layer_reduction['bytes_in'] -
+                               layer_reduction['bytes_out'])
 
     def processed_pyramid(self, parent_tile,
                           start_time, stop_time):
@@ -88,3 +110,36 @@ class RawrTilePipelineStatsHandler(object):
 
             prefix = 'rawr.process.time'
             emit_time_dict(pipe, timing, prefix)
+
+
+class StoreStatsHandler(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __call__(self, op, extension, zoom, millis, bytes_in, bytes_out,
+                 retries, error_class):
+        prefix = 'store.%s.%s.%s' % (op, extension, zoom)
+        with self.stats.pipeline() as pipe:
+            pipe.timing(prefix + '.time', millis)
+            if bytes_in:
+                pipe.incr(prefix + '.bytes_in', bytes_in)
+            if bytes_out:
+                pipe.incr(prefix + '.bytes_out', bytes_out)
+            if retries:
+                pipe.incr(prefix + '.retries', retries)
+            if error_class:
+                pipe.incr('%s.errors.%s' % (prefix, error_class))
+
+
+class TierStatsHandler(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __call__(self, tier_name, op, millis, hit):
+        prefix = 'store.tier.%s.%s' % (tier_name, op)
+        with self.stats.pipeline() as pipe:
+            pipe.timing(prefix + '.time', millis)
+            if hit is not None:
+                pipe.incr(prefix + ('.hits' if hit else '.misses'))
@@ -3,15 +3,27 @@
 from boto import connect_s3
 from boto.s3.bucket import Bucket
 from builtins import range
+from collections import OrderedDict
 from future.utils import raise_from
+import atexit
+import json
 import md5
 from ModestMaps.Core import Coordinate
 import os
+from tilequeue.metatile import metatile_digest
 from tilequeue.metatile import metatiles_are_equal
+from tilequeue.format import indexed_metatile_format
 from tilequeue.format import zip_format
 import random
+import socket
+import sqlite3
 import threading
 import time
+import zipfile
+
+
+# name of the S3 object metadata holding the digest of the tile.
+TILE_DIGEST_METADATA = 'tile-digest'
 
 
 def calc_hash(s):
@@ -21,6 +33,30 @@ def calc_hash(s):
     return md5_hash[:5]
 
 
+def _is_metatile_format(fmt):
+    return fmt is not None and fmt in (zip_format, indexed_metatile_format)
+
+
+def calc_tile_digest(tile_data, fmt):
+    """
+    Return a hex digest of the tile data, such that tiles_are_equal tiles
+    have the same digest.
+
+    For most formats this is the MD5 of the bytes, which is also the ETag S3
+    gives to objects uploaded in one part. Metatiles use a digest of their
+    contents instead, see tilequeue.metatile.metatile_digest.
+    """
+
+    if _is_metatile_format(fmt):
+        try:
+            return metatile_digest(tile_data)
+        except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
+            # not a proper metatile, so fall back to the bytes.
+            pass
+
+    return md5.new(tile_data).hexdigest()
+
+
 def s3_tile_key(date, path, layer, coord, extension):
     prefix = '/%s' % path if path else ''
     path_to_hash = '%(prefix)s/%(layer)s/%(z)d/%(x)d/%(y)d.%(ext)s' % dict(
@@ -59,6 +95,17 @@ def parse_coordinate_from_path(path, extension, layer):
                         pass
 
 
+# per thread count of retries done by _backoff_and_retry, while it's being
+# counted by an InstrumentedStore.
+_retries = threading.local()
+
+
+def _count_retry():
+    count = getattr(_retries, 'count', None)
+    if count is not None:
+        _retries.count = count + 1
+
+
 # decorates a function to back off and retry
 def _backoff_and_retry(ExceptionType, num_tries=5, retry_factor=2,
                        retry_interval=1, logger=None):
@@ -81,6 +128,7 @@ def _backoff_and_retry(ExceptionType, num_tries=5, retry_factor=2,
                     if logger:
                         logger.warning("Failed. Backing off and retrying. "
                                        "Error: %s" % str(e))
+                    _count_retry()
 
                 sleep(interval)
                 interval *= factor
@@ -109,6 +157,8 @@ class S3(object):
         key_name = s3_tile_key(
             self.date_prefix, self.path, layer, coord, format.extension)
         key = self.bucket.new_key(key_name)
+        key.set_metadata(
+            TILE_DIGEST_METADATA, calc_tile_digest(tile_data, format))
 
         @_backoff_and_retry(Exception, logger=self.logger)
         def write_to_s3():
@@ -130,6 +180,36 @@ class S3(object):
         tile_data = key.get_contents_as_string()
         return tile_data
 
+    def tile_digest(self, coord, format, layer):
+        """
+        Return the digest of the stored tile, or None if there isn't one.
+
+        This only needs a HEAD request when the tile was written with its
+        digest in the object metadata, or when the format's digest is the
+        same as the ETag. Otherwise the tile has to be read.
+        """
+
+        key_name = s3_tile_key(
+            self.date_prefix, self.path, layer, coord, format.extension)
+        # boto does a HEAD request here, which gets the metadata and ETag.
+        key = self.bucket.get_key(key_name)
+        if key is None:
+            return None
+
+        digest = key.get_metadata(TILE_DIGEST_METADATA)
+        if digest:
+            return digest
+
+        if not _is_metatile_format(format):
+            # the ETag of an object uploaded in one part is the MD5 of its
+            # contents, but multipart ETags have a '-' in them.
+            etag = (key.etag or '').strip('"')
+            if etag and '-' not in etag:
+                return etag
+
+        tile_data = key.get_contents_as_string()
+        return calc_tile_digest(tile_data, format)
+
     def delete_tiles(self, coords, format, layer):
         key_names = [
             s3_tile_key(self.date_prefix, self.path, layer, coord,
@@ -249,12 +329,59 @@ def os_replace(src, dst):
         raise_from(OSError('failed to replace'), error)
 
 
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _list_column_dir(args):
+    # coordinates of the tiles in one z/x directory with the extension.
+    column_path, zoom, column, extension = args
+    coords = []
+    try:
+        names = os.listdir(column_path)
+    except OSError:
+        return coords
+    for name in names:
+        fields = name.split('.', 1)
+        if len(fields) != 2 or fields[1] != extension:
+            continue
+        try:
+            row = int(fields[0])
+        except ValueError:
+            continue
+        coords.append(Coordinate(zoom=zoom, column=column, row=row))
+    return coords
+
+
+def _int_dir_names(path):
+    # the names of the directories in path which are integers, as integers.
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    result = []
+    for name in names:
+        try:
+            result.append(int(name))
+        except ValueError:
+            pass
+    return sorted(result)
+
+
 class TileDirectory(object):
     '''
     Writes tiles to individual files in a local directory.
+
+    Directories known to exist are remembered, so that they're only created
+    once. Set fsync_batch_size to sync written tiles to disk, fsync_batch_size
+    at a time, and list_workers to the number of threads used to list tiles.
     '''
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, fsync_batch_size=None, list_workers=4):
         if os.path.exists(base_path):
             if not os.path.isdir(base_path):
                 raise IOError(
@@ -263,13 +390,67 @@ class TileDirectory(object):
             os.makedirs(base_path)
 
         self.base_path = base_path
-
-    def write_tile(self, tile_data, coord, format, layer):
-        dir_path = make_dir_path(self.base_path, coord, layer)
+        self.fsync_batch_size = fsync_batch_size
+        self.list_workers = list_workers
+        self.lock = threading.Lock()
+        self.created_dirs = set()
+        self.unsynced_paths = []
+        if fsync_batch_size:
+            # sync the last, partial, batch when the process exits.
+            atexit.register(self.flush)
+
+    def _make_dirs(self, dir_path):
+        if dir_path in self.created_dirs:
+            return
         try:
             os.makedirs(dir_path)
         except OSError:
             pass
+        with self.lock:
+            self.created_dirs.add(dir_path)
+
+    def _synced(self, file_path):
+        with self.lock:
+            self.unsynced_paths.append(file_path)
+            if len(self.unsynced_paths) < self.fsync_batch_size:
+                return
+            paths = self.unsynced_paths
+            self.unsynced_paths = []
+        self._fsync(paths)
+
+    def _fsync(self, paths):
+        dir_paths = set()
+        for path in paths:
+            try:
+                _fsync_path(path)
+            except OSError:
+                # the tile was deleted or replaced since, and there's
+                # nothing left to sync.
+                pass
+            dir_paths.add(os.path.dirname(path))
+        # the directories hold the renames of the swap files.
+        for dir_path in dir_paths:
+            try:
+                _fsync_path(dir_path)
+            except OSError:
+                # the directory was removed since, along with the tiles
+                # in it.
+                pass
+
+    def flush(self):
+        '''
+        Sync any tiles written since the last batch to disk.
+        '''
+
+        with self.lock:
+            paths = self.unsynced_paths
+            self.unsynced_paths = []
+        if paths:
+            self._fsync(paths)
+
+    def write_tile(self, tile_data, coord, format, layer):
+        dir_path = make_dir_path(self.base_path, coord, layer)
+        self._make_dirs(dir_path)
 
         file_path = make_file_path(self.base_path, coord, layer,
                                    format.extension)
@@ -281,7 +462,17 @@ class TileDirectory(object):
         )
 
         try:
-            with open(swap_file_path, 'w') as tile_fp:
+            try:
+                tile_fp = open(swap_file_path, 'w')
+            except IOError:
+                # the directory might have been removed since it was
+                # created, so make sure it's there.
+                with self.lock:
+                    self.created_dirs.discard(dir_path)
+                self._make_dirs(dir_path)
+                tile_fp = open(swap_file_path, 'w')
+
+            with tile_fp:
                 tile_fp.write(tile_data)
 
             # write file as atomic operation
@@ -293,6 +484,9 @@ class TileDirectory(object):
                 pass
             raise e
 
+        if self.fsync_batch_size:
+            self._synced(file_path)
+
     def read_tile(self, coord, format, layer):
         file_path = make_file_path(self.base_path, coord, layer,
                                    format.extension)
@@ -303,6 +497,16 @@ class TileDirectory(object):
         except IOError:
             return None
 
+    def tile_digest(self, coord, format, layer):
+        """
+        Return the digest of the tile file, or None if there isn't one.
+        """
+
+        tile_data = self.read_tile(coord, format, layer)
+        if tile_data is None:
+            return None
+        return calc_tile_digest(tile_data, format)
+
     def delete_tiles(self, coords, format, layer):
         delete_count = 0
         for coord in coords:
@@ -314,41 +518,916 @@ class TileDirectory(object):
 
         return delete_count
 
+    def _column_dirs(self, format, layer):
+        layer_path = os.path.join(self.base_path, layer)
+        for zoom in _int_dir_names(layer_path):
+            zoom_path = os.path.join(layer_path, str(zoom))
+            for column in _int_dir_names(zoom_path):
+                yield (os.path.join(zoom_path, str(column)), zoom, column,
+                       format.extension)
+
     def list_tiles(self, format, layer):
-        ext = '.' + format.extension
-        for root, dirs, files in os.walk(self.base_path):
-            for name in files:
-                tile_path = '%s/%s' % (root, name)
-                coord = parse_coordinate_from_path(tile_path, ext, layer)
-                if coord:
+        """
+        Yield the coordinates of the tiles with the format and layer.
+
+        Each z/x directory is listed by one of list_workers threads, and
+        coordinates are yielded as each directory is listed.
+        """
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(self.list_workers)
+        try:
+            for coords in pool.imap(
+                    _list_column_dir, self._column_dirs(format, layer)):
+                for coord in coords:
                     yield coord
+        finally:
+            pool.terminate()
 
 
-def make_tile_file_store(base_path=None):
+def make_tile_file_store(base_path=None, fsync_batch_size=None):
     if base_path is None:
         base_path = 'tiles'
-    return TileDirectory(base_path)
+    return TileDirectory(base_path, fsync_batch_size)
 
 
-class Memory(object):
+# the MBTiles spec allows pbf, jpg, png or webp as the format, or an IETF
+# media type for anything else.
+MBTILES_FORMATS = {
+    'mvt': 'pbf',
+    'mvtb': 'pbf',
+    # vtm_format has an image/png mimetype, but the tiles are protobufs.
+    'vtm': 'application/x-protobuf',
+}
 
-    def __init__(self):
-        self.data = None
+
+def mbtiles_format(format):
+    return MBTILES_FORMATS.get(format.extension, format.mimetype)
+
+
+class _MBTilesFile(object):
+    """
+    A single MBTiles file, holding the tiles of one layer and format.
+
+    With dedupe, tile data is kept once per distinct MD5 of its bytes in the
+    images table and referred to from the map table, and the tiles view
+    joins them as the MBTiles spec allows. The map table also keeps each
+    tile's calc_tile_digest, which for metatiles isn't a hash of the bytes
+    and so can't safely identify an image. Otherwise tiles are kept in a
+    tiles table.
+    """
+
+    def __init__(self, path, name, format, dedupe):
+        self.dedupe = dedupe
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        tables = set(row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"))
+        if 'tiles' in tables:
+            # an existing file decides whether it's deduplicated.
+            self.dedupe = 'map' in tables
+            if self.dedupe:
+                self._add_digest_column()
+        else:
+            self._create(name, format)
+
+    def _create(self, name, format):
+        self.conn.execute(
+            'CREATE TABLE metadata (name TEXT, value TEXT)')
+        self.conn.executemany(
+            'INSERT INTO metadata (name, value) VALUES (?, ?)', [
+                ('name', name),
+                ('format', mbtiles_format(format)),
+                ('type', 'baselayer'),
+                ('version', '1'),
+            ])
+
+        if self.dedupe:
+            self.conn.execute(
+                'CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, '
+                'tile_row INTEGER, tile_id TEXT, tile_digest TEXT)')
+            self.conn.execute(
+                'CREATE UNIQUE INDEX map_index ON map '
+                '(zoom_level, tile_column, tile_row)')
+            self.conn.execute('CREATE INDEX map_tile_id ON map (tile_id)')
+            self.conn.execute(
+                'CREATE TABLE images (tile_id TEXT PRIMARY KEY, '
+                'tile_data BLOB)')
+            self.conn.execute(
+                'CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, '
+                'map.tile_column AS tile_column, map.tile_row AS tile_row, '
+                'images.tile_data AS tile_data FROM map '
+                'JOIN images ON images.tile_id = map.tile_id')
+        else:
+            self.conn.execute(
+                'CREATE TABLE tiles (zoom_level INTEGER, '
+                'tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+            self.conn.execute(
+                'CREATE UNIQUE INDEX tile_index ON tiles '
+                '(zoom_level, tile_column, tile_row)')
+        self.conn.commit()
+
+    def _add_digest_column(self):
+        columns = set(row[1] for row in self.conn.execute(
+            'PRAGMA table_info(map)'))
+        if 'tile_digest' not in columns:
+            # tiles from before have no digest, and will be rewritten.
+            self.conn.execute('ALTER TABLE map ADD COLUMN tile_digest TEXT')
+            self.conn.commit()
+
+    def _release_image(self, tile_id):
+        self.conn.execute(
+            'DELETE FROM images WHERE tile_id = ? AND NOT EXISTS '
+            '(SELECT 1 FROM map WHERE tile_id = ?)', (tile_id, tile_id))
+
+    def _map_row(self, z, x, y):
+        return self.conn.execute(
+            'SELECT tile_id, tile_digest FROM map WHERE zoom_level = ? AND '
+            'tile_column = ? AND tile_row = ?', (z, x, y)).fetchone()
+
+    def write(self, z, x, y, tile_data, digest):
+        if not self.dedupe:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, '
+                'tile_row, tile_data) VALUES (?, ?, ?, ?)',
+                (z, x, y, sqlite3.Binary(tile_data)))
+            return
+
+        tile_id = md5.new(tile_data).hexdigest()
+        row = self._map_row(z, x, y)
+        old_tile_id = row[0] if row else None
+        if row == (tile_id, digest):
+            return
+        self.conn.execute(
+            'INSERT OR IGNORE INTO images (tile_id, tile_data) '
+            'VALUES (?, ?)', (tile_id, sqlite3.Binary(tile_data)))
+        self.conn.execute(
+            'INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, '
+            'tile_id, tile_digest) VALUES (?, ?, ?, ?, ?)',
+            (z, x, y, tile_id, digest))
+        if old_tile_id is not None and old_tile_id != tile_id:
+            self._release_image(old_tile_id)
+
+    def read(self, z, x, y):
+        row = self.conn.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+            'tile_column = ? AND tile_row = ?', (z, x, y)).fetchone()
+        return str(row[0]) if row else None
+
+    def digest(self, z, x, y):
+        # only deduplicated files know the digest without reading the tile.
+        assert self.dedupe
+        row = self._map_row(z, x, y)
+        return row[1] if row else None
+
+    def delete(self, z, x, y):
+        if not self.dedupe:
+            cursor = self.conn.execute(
+                'DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                'AND tile_row = ?', (z, x, y))
+            return cursor.rowcount
+
+        row = self._map_row(z, x, y)
+        if row is None:
+            return 0
+        tile_id = row[0]
+        self.conn.execute(
+            'DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND '
+            'tile_row = ?', (z, x, y))
+        self._release_image(tile_id)
+        return 1
+
+    def coords(self):
+        table = 'map' if self.dedupe else 'tiles'
+        return self.conn.execute(
+            'SELECT zoom_level, tile_column, tile_row FROM %s' % table
+        ).fetchall()
+
+
+class MBTiles(object):
+    """
+    Writes tiles to MBTiles files in a local directory, one for each layer
+    and format, named <layer>.<extension>.mbtiles. When writing metatiles
+    there's only one.
+
+    Writes are grouped into transactions of up to batch_size tiles, which
+    are committed when full, when commit_interval seconds have passed since
+    the last commit, or on flush. Reads see uncommitted writes. Access from
+    several threads, such as the io_pool, is serialised with a lock.
+
+    With dedupe, identical tiles are stored once, keyed by the MD5 of their
+    bytes.
+    """
+
+    def __init__(self, base_path, dedupe=True, batch_size=1000,
+                 commit_interval=5):
+        if os.path.exists(base_path):
+            if not os.path.isdir(base_path):
+                raise IOError(
+                    '`{}` exists and is not a directory!'.format(base_path))
+        else:
+            os.makedirs(base_path)
+
+        self.base_path = base_path
+        self.dedupe = dedupe
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.files = {}
+        self.num_pending = 0
+        self.last_commit = time.time()
+        atexit.register(self.flush)
+
+    def _file(self, format, layer, create):
+        key = (layer, format.extension)
+        mbtiles = self.files.get(key)
+        if mbtiles is None:
+            path = os.path.join(
+                self.base_path, '%s.%s.mbtiles' % (layer, format.extension))
+            if not create and not os.path.exists(path):
+                return None
+            mbtiles = _MBTilesFile(path, layer, format, self.dedupe)
+            self.files[key] = mbtiles
+        return mbtiles
+
+    def _written(self, num_written):
+        self.num_pending += num_written
+        if self.num_pending >= self.batch_size or \
+           time.time() - self.last_commit >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit any pending writes.
+        """
+
+        with self.lock:
+            for mbtiles in self.files.itervalues():
+                mbtiles.conn.commit()
+            self.num_pending = 0
+            self.last_commit = time.time()
 
     def write_tile(self, tile_data, coord, format, layer):
-        self.data = tile_data, coord, format, layer
+        z, x, y = _mbtiles_coord(coord)
+        with self.lock:
+            self._file(format, layer, True).write(
+                z, x, y, tile_data, calc_tile_digest(tile_data, format))
+            self._written(1)
 
     def read_tile(self, coord, format, layer):
-        if self.data is None:
+        z, x, y = _mbtiles_coord(coord)
+        with self.lock:
+            mbtiles = self._file(format, layer, False)
+            if mbtiles is None:
+                return None
+            return mbtiles.read(z, x, y)
+
+    def tile_digest(self, coord, format, layer):
+        z, x, y = _mbtiles_coord(coord)
+        with self.lock:
+            mbtiles = self._file(format, layer, False)
+            if mbtiles is None:
+                return None
+            if mbtiles.dedupe:
+                return mbtiles.digest(z, x, y)
+            tile_data = mbtiles.read(z, x, y)
+        if tile_data is None:
             return None
-        tile_data, coord, format, layer = self.data
+        return calc_tile_digest(tile_data, format)
+
+    def delete_tiles(self, coords, format, layer):
+        delete_count = 0
+        with self.lock:
+            mbtiles = self._file(format, layer, False)
+            if mbtiles is None:
+                return 0
+            for coord in coords:
+                z, x, y = _mbtiles_coord(coord)
+                delete_count += mbtiles.delete(z, x, y)
+            self._written(delete_count)
+        return delete_count
+
+    def list_tiles(self, format, layer):
+        with self.lock:
+            mbtiles = self._file(format, layer, False)
+            if mbtiles is None:
+                return
+            rows = mbtiles.coords()
+        for z, x, y in rows:
+            yield Coordinate(zoom=z, column=x, row=(1 << z) - 1 - y)
+
+
+def _mbtiles_coord(coord):
+    # MBTiles rows count up from the south, as in TMS.
+    z = int(coord.zoom)
+    return z, int(coord.column), (1 << z) - 1 - int(coord.row)
+
+
+def make_mbtiles_store(base_path=None, dedupe=True, batch_size=1000,
+                       commit_interval=5):
+    if base_path is None:
+        base_path = 'tiles'
+    return MBTiles(base_path, dedupe, batch_size, commit_interval)
+
+
+def _memory_key(coord, format, layer):
+    return (int(coord.zoom), int(coord.column), int(coord.row),
+            format.extension, layer)
+
+
+class Memory(object):
+    """
+    Keeps tiles in memory, up to max_bytes of tile data in total, or without
+    limit if max_bytes is None. When full, the least recently used tiles are
+    evicted to make room.
+
+    Counts of hits, misses and evictions are kept in counts. Access from
+    several threads is serialised with a lock.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.num_bytes = 0
+        self.counts = dict(hits=0, misses=0, evictions=0)
+
+    def _remove(self, key):
+        tile_data = self.tiles.pop(key, None)
+        if tile_data is None:
+            return False
+        self.num_bytes -= len(tile_data)
+        return True
+
+    def write_tile(self, tile_data, coord, format, layer):
+        key = _memory_key(coord, format, layer)
+        with self.lock:
+            self._remove(key)
+            if self.max_bytes is not None:
+                if len(tile_data) > self.max_bytes:
+                    # would never fit, so don't evict everything else for it.
+                    return
+                while self.num_bytes + len(tile_data) > self.max_bytes:
+                    _, evicted = self.tiles.popitem(last=False)
+                    self.num_bytes -= len(evicted)
+                    self.counts['evictions'] += 1
+            self.tiles[key] = tile_data
+            self.num_bytes += len(tile_data)
+
+    def read_tile(self, coord, format, layer):
+        key = _memory_key(coord, format, layer)
+        with self.lock:
+            tile_data = self.tiles.pop(key, None)
+            if tile_data is None:
+                self.counts['misses'] += 1
+                return None
+            # move to the most recently used end.
+            self.tiles[key] = tile_data
+            self.counts['hits'] += 1
+            return tile_data
+
+    def delete_tiles(self, coords, format, layer):
+        delete_count = 0
+        with self.lock:
+            for coord in coords:
+                if self._remove(_memory_key(coord, format, layer)):
+                    delete_count += 1
+        return delete_count
+
+    def list_tiles(self, format, layer):
+        with self.lock:
+            keys = list(self.tiles)
+        for z, x, y, extension, tile_layer in keys:
+            if extension == format.extension and tile_layer == layer:
+                yield Coordinate(zoom=z, column=x, row=y)
+
+
+def make_memory_store(max_bytes=None):
+    return Memory(max_bytes)
+
+
+def _tile_index_key(coord, format, layer):
+    return '%s/%d/%d/%d.%s' % (
+        layer, coord.zoom, coord.column, coord.row, format.extension)
+
+
+class TileHashIndex(object):
+    """
+    A local SQLite index of the digest of the last tile written for each
+    (coord, format, layer).
+
+    The index is only correct if every write to the store goes through it.
+    A tile written around it, for example by a worker with an index of its
+    own, leaves the digest here stale, and writing the tile it replaced
+    would then be skipped. So the index can only be used when the store is
+    written from a single host, and all the workers on that host must share
+    one index file on local disk. The file is in SQLite's WAL mode, which
+    doesn't work on network filesystems. To catch a file being shared by
+    several hosts, the index records the host which created it, and refuses
+    to open on any other.
+
+    The index holds at most max_entries tiles, dropping those which haven't
+    been written in the last max_entries writes. The write order comes from
+    the database, within the write transaction, so that it holds across all
+    the processes sharing it.
+    """
+
+    def __init__(self, path, max_entries=1000000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tile_digest ('
+            'key TEXT PRIMARY KEY, digest TEXT NOT NULL, '
+            'written INTEGER NOT NULL)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS tile_digest_written '
+            'ON tile_digest (written)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS index_host (host TEXT NOT NULL)')
+        self._check_host(path)
+        self.conn.commit()
+
+    def _check_host(self, path):
+        host = socket.gethostname()
+        row = self.conn.execute('SELECT host FROM index_host').fetchone()
+        if row is None:
+            self.conn.execute(
+                'INSERT INTO index_host (host) VALUES (?)', (host,))
+        elif row[0] != host:
+            self.conn.close()
+            raise IOError(
+                'Tile hash index `{}` was created on host `{}`, not `{}`. '
+                'The index must be on local disk, and only used when a '
+                'single host writes the store. If the store has moved '
+                'host, remove the index file.'.format(path, row[0], host))
+
+    @property
+    def num_entries(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM tile_digest').fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT digest FROM tile_digest WHERE key = ?',
+                (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, digest):
+        with self.lock, self.conn:
+            # each write is numbered one past the last, so the entries not
+            # written in the last max_entries writes can be found from the
+            # written index, without counting the rows.
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tile_digest (key, digest, written) '
+                'VALUES (?, ?, (SELECT COALESCE(MAX(written), 0) + 1 '
+                'FROM tile_digest))', (key, digest))
+            self.conn.execute(
+                'DELETE FROM tile_digest WHERE written <= '
+                '(SELECT MAX(written) FROM tile_digest) - ?',
+                (self.max_entries,))
+
+    def invalidate(self, keys):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM tile_digest WHERE key = ?',
+                [(key,) for key in keys])
+
+
+class HashIndexedStore(object):
+    """
+    Wraps a store, keeping the digest of each tile written through it in a
+    TileHashIndex. Finding the digest of a tile in the index doesn't need
+    any request to the store, so write_tile_if_changed can skip unchanged
+    tiles without one.
+
+    Keys in the index start with the namespace, which should identify the
+    store, so that an index shared between stores, or kept when the store
+    changes, doesn't mistake the tiles of one for another. All writers to
+    the store must share the index, see TileHashIndex.
+
+    The index is only an optimisation, so failing to update it, for example
+    when the database is locked, doesn't fail the store operation. The
+    failure is logged, and the tile dropped from the index.
+
+    Counts of index hits and misses are kept in index_counts.
+    """
+
+    def __init__(self, store, index, namespace='', logger=None):
+        self.store = store
+        self.index = index
+        self.namespace = namespace
+        self.logger = logger
+        self.counts_lock = threading.Lock()
+        self.index_counts = dict(hits=0, misses=0)
+
+    def _key(self, coord, format, layer):
+        return self.namespace + _tile_index_key(coord, format, layer)
+
+    def _count(self, name):
+        with self.counts_lock:
+            self.index_counts[name] += 1
+
+    def _put(self, key, digest):
+        try:
+            self.index.put(key, digest)
+        except sqlite3.Error as e:
+            if self.logger:
+                self.logger.warning(
+                    'Failed to update tile hash index for %s: %s' %
+                    (key, str(e)))
+            # an entry left from before would now be stale.
+            try:
+                self.index.invalidate([key])
+            except sqlite3.Error as e:
+                if self.logger:
+                    self.logger.error(
+                        'Failed to invalidate tile hash index for %s: %s' %
+                        (key, str(e)))
+
+    def write_tile(self, tile_data, coord, format, layer):
+        self.store.write_tile(tile_data, coord, format, layer)
+        self._put(self._key(coord, format, layer),
+                  calc_tile_digest(tile_data, format))
+
+    def read_tile(self, coord, format, layer):
+        return self.store.read_tile(coord, format, layer)
+
+    def tile_digest(self, coord, format, layer):
+        digest = self.index.get(self._key(coord, format, layer))
+        if digest is not None:
+            self._count('hits')
+            return digest
+
+        self._count('misses')
+        store_tile_digest = getattr(self.store, 'tile_digest', None)
+        if store_tile_digest is not None:
+            digest = store_tile_digest(coord, format, layer)
+        else:
+            tile_data = self.store.read_tile(coord, format, layer)
+            if tile_data is None:
+                return None
+            digest = calc_tile_digest(tile_data, format)
+
+        # remember tiles which are already in the store too, so that the
+        # index warms up even when they're unchanged and not written.
+        if digest is not None:
+            self._put(self._key(coord, format, layer), digest)
+        return digest
+
+    def delete_tiles(self, coords, format, layer):
+        self.index.invalidate(
+            self._key(coord, format, layer) for coord in coords)
+        return self.store.delete_tiles(coords, format, layer)
+
+    def list_tiles(self, format, layer):
+        return self.store.list_tiles(format, layer)
+
+    def flush(self):
+        flush_store(self.store)
+
+
+class _TierStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+        self.read_time = 0.0
+        self.writes = 0
+        self.write_time = 0.0
+        self.digests = 0
+        self.digest_time = 0.0
+
+    def as_dict(self):
+        return dict(
+            name=self.name,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=(float(self.hits) / (self.hits + self.misses)
+                       if self.hits + self.misses else None),
+            read_millis=(self.read_time * 1000.0 / self.reads
+                         if self.reads else None),
+            write_millis=(self.write_time * 1000.0 / self.writes
+                          if self.writes else None),
+            digest_millis=(self.digest_time * 1000.0 / self.digests
+                           if self.digests else None),
+        )
+
+
+class Tiered(object):
+    """
+    Puts an ordered list of stores, fastest first, behind the store interface.
+    For example, a memory store, then a local directory, then S3.
+
+    Reads try each tier in turn, and a tile found in a slower tier is written
+    to the faster tiers before it's returned. With the 'through' write policy
+    tiles are written to every tier, slowest first. With 'back' they're only
+    written to the first tier, and kept until write_back_batch_size tiles are
+    waiting, or flush is called, when they're written to the other tiers.
+
+    Hits, misses and mean read, write and digest latency are kept for each
+    tier, see tier_stats. A digest lookup which finds the tile counts as a
+    hit, as a read does. If a logger is given, they're logged every
+    report_interval reads. Each tier operation is also passed to
+    stats_handler, if given, see tilequeue.stats.TierStatsHandler.
+    """
+
+    def __init__(self, tiers, names=None, write_policy='through',
+                 write_back_batch_size=1000, logger=None,
+                 report_interval=10000, stats_handler=None):
+        assert tiers, 'Tiered store needs at least one tier'
+        if write_policy not in ('through', 'back'):
+            raise ValueError(
+                'Unknown tiered store write policy: `{}`'.format(
+                    write_policy))
+        if names is None:
+            names = [type(tier).__name__.lower() for tier in tiers]
+
+        self.tiers = tiers
+        self.write_policy = write_policy
+        self.write_back_batch_size = write_back_batch_size
+        self.logger = logger
+        self.report_interval = report_interval
+        self.stats_handler = stats_handler
+        self.lock = threading.Lock()
+        self.stats = [_TierStats(name) for name in names]
+        self.num_reads = 0
+        # tiles written to the first tier only, by _memory_key.
+        self.dirty = OrderedDict()
+        atexit.register(self.flush)
+
+    def _tier_op(self, i, op, elapsed, hit=None):
+        with self.lock:
+            stats = self.stats[i]
+            if op == 'write_tile':
+                stats.writes += 1
+                stats.write_time += elapsed
+            elif op == 'read_tile':
+                stats.reads += 1
+                stats.read_time += elapsed
+            else:
+                stats.digests += 1
+                stats.digest_time += elapsed
+            if hit is not None:
+                if hit:
+                    stats.hits += 1
+                else:
+                    stats.misses += 1
+        if self.stats_handler:
+            self.stats_handler(
+                self.stats[i].name, op, elapsed * 1000.0, hit)
+
+    def _read_tier(self, i, coord, format, layer):
+        start = time.time()
+        tile_data = self.tiers[i].read_tile(coord, format, layer)
+        self._tier_op(i, 'read_tile', time.time() - start,
+                      tile_data is not None)
         return tile_data
 
+    def _digest_tier(self, i, tier_tile_digest, coord, format, layer):
+        start = time.time()
+        digest = tier_tile_digest(coord, format, layer)
+        self._tier_op(i, 'tile_digest', time.time() - start,
+                      digest is not None)
+        return digest
+
+    def _write_tier(self, i, tile_data, coord, format, layer):
+        start = time.time()
+        self.tiers[i].write_tile(tile_data, coord, format, layer)
+        self._tier_op(i, 'write_tile', time.time() - start)
+
+    def _populate(self, num_tiers, tile_data, coord, format, layer):
+        # failing to fill a cache tier shouldn't fail the read.
+        for i in reversed(range(num_tiers)):
+            try:
+                self._write_tier(i, tile_data, coord, format, layer)
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning(
+                        'Failed to populate tier %s: %s' %
+                        (self.stats[i].name, str(e)))
+
+    def _read_done(self):
+        if not self.logger:
+            return
+        with self.lock:
+            self.num_reads += 1
+            report = self.num_reads % self.report_interval == 0
+        if report:
+            self.logger.info('Tiered store stats: %r' % self.tier_stats())
+
+    def tier_stats(self):
+        """
+        Return a list of dicts of the name, hits, misses, hit ratio and mean
+        read, write and digest latency in milliseconds of each tier.
+        """
+
+        with self.lock:
+            return [stats.as_dict() for stats in self.stats]
+
+    def read_tile(self, coord, format, layer):
+        with self.lock:
+            dirty = self.dirty.get(_memory_key(coord, format, layer))
+        if dirty is not None:
+            return dirty[0]
+
+        try:
+            for i in range(len(self.tiers)):
+                tile_data = self._read_tier(i, coord, format, layer)
+                if tile_data is not None:
+                    self._populate(i, tile_data, coord, format, layer)
+                    return tile_data
+            return None
+        finally:
+            self._read_done()
+
+    def tile_digest(self, coord, format, layer):
+        with self.lock:
+            dirty = self.dirty.get(_memory_key(coord, format, layer))
+        if dirty is not None:
+            return calc_tile_digest(dirty[0], format)
+
+        try:
+            for i, tier in enumerate(self.tiers):
+                tier_tile_digest = getattr(tier, 'tile_digest', None)
+                if tier_tile_digest is not None:
+                    digest = self._digest_tier(
+                        i, tier_tile_digest, coord, format, layer)
+                    if digest is not None:
+                        return digest
+                else:
+                    tile_data = self._read_tier(i, coord, format, layer)
+                    if tile_data is not None:
+                        return calc_tile_digest(tile_data, format)
+            return None
+        finally:
+            self._read_done()
+
+    def write_tile(self, tile_data, coord, format, layer):
+        if self.write_policy == 'through' or len(self.tiers) == 1:
+            for i in reversed(range(len(self.tiers))):
+                self._write_tier(i, tile_data, coord, format, layer)
+            return
+
+        self._write_tier(0, tile_data, coord, format, layer)
+        with self.lock:
+            key = _memory_key(coord, format, layer)
+            self.dirty.pop(key, None)
+            self.dirty[key] = (tile_data, coord, format, layer)
+            flush = len(self.dirty) >= self.write_back_batch_size
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write tiles waiting to be written back to the slower tiers, and flush
+        any tiers which can be.
+        """
+
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = OrderedDict()
+
+        try:
+            while dirty:
+                key, (tile_data, coord, format, layer) = dirty.popitem(
+                    last=False)
+                for i in reversed(range(1, len(self.tiers))):
+                    self._write_tier(i, tile_data, coord, format, layer)
+        except Exception:
+            # keep what hasn't been written, including the tile which
+            # failed, unless it's been written again since.
+            dirty[key] = (tile_data, coord, format, layer)
+            with self.lock:
+                for new_key, value in self.dirty.iteritems():
+                    dirty.pop(new_key, None)
+                    dirty[new_key] = value
+                self.dirty = dirty
+            raise
+
+        for tier in self.tiers:
+            tier_flush = getattr(tier, 'flush', None)
+            if tier_flush is not None:
+                tier_flush()
+
     def delete_tiles(self, coords, format, layer):
-        pass
+        coords = list(coords)
+        with self.lock:
+            for coord in coords:
+                self.dirty.pop(_memory_key(coord, format, layer), None)
+
+        delete_count = 0
+        for tier in self.tiers:
+            delete_count = tier.delete_tiles(coords, format, layer)
+        # the slowest tier has everything, so its count is the one to trust.
+        return delete_count
 
     def list_tiles(self, format, layer):
-        return [self.data] if self.data else []
+        self.flush()
+        return self.tiers[-1].list_tiles(format, layer)
+
+
+def _zoom_key(coords):
+    zooms = set(int(coord.zoom) for coord in coords)
+    if len(zooms) == 1:
+        return zooms.pop()
+    return 'mixed'
+
+
+class InstrumentedStore(object):
+    """
+    Wraps a store, recording the latency, bytes read and written, retries
+    and class of any error of each read_tile, write_tile, tile_digest and
+    delete_tiles call, by format and zoom.
+
+    Each operation is passed to stats_handler and store_logger, see
+    tilequeue.stats.StoreStatsHandler and tilequeue.log.JsonStoreLogger.
+    Anything else, such as list_tiles, is passed to the wrapped store as is.
+    """
+
+    def __init__(self, store, stats_handler=None, store_logger=None):
+        self.store = store
+        self.stats_handler = stats_handler
+        self.store_logger = store_logger
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+        attr = getattr(self.store, name)
+        if name == 'tile_digest':
+            def tile_digest(coord, format, layer):
+                return self._instrument(
+                    'tile_digest', attr, (coord, format, layer), coord,
+                    format, layer)
+            return tile_digest
+        return attr
+
+    def _instrument(self, op, fn, args, coord, format, layer,
+                    bytes_out=0, zoom=None):
+        outer_retries = getattr(_retries, 'count', None)
+        _retries.count = 0
+        error_class = None
+        start = time.time()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            error_class = type(e).__name__
+            raise
+        finally:
+            millis = (time.time() - start) * 1000.0
+            retries = _retries.count
+            _retries.count = None if outer_retries is None else \
+                outer_retries + retries
+            bytes_in = 0
+            if error_class is None and op == 'read_tile' and result:
+                bytes_in = len(result)
+            if zoom is None:
+                zoom = int(coord.zoom)
+            self._record(op, format.extension, layer, coord, zoom, millis,
+                         bytes_in, bytes_out, retries, error_class)
+        return result
+
+    def _record(self, op, extension, layer, coord, zoom, millis, bytes_in,
+                bytes_out, retries, error_class):
+        if self.stats_handler:
+            self.stats_handler(op, extension, zoom, millis, bytes_in,
+                               bytes_out, retries, error_class)
+        if self.store_logger:
+            self.store_logger.operation(
+                op, extension, layer, coord, millis, bytes_in, bytes_out,
+                retries, error_class)
+
+    def write_tile(self, tile_data, coord, format, layer):
+        return self._instrument(
+            'write_tile', self.store.write_tile,
+            (tile_data, coord, format, layer), coord, format, layer,
+            bytes_out=len(tile_data))
+
+    def read_tile(self, coord, format, layer):
+        return self._instrument(
+            'read_tile', self.store.read_tile, (coord, format, layer),
+            coord, format, layer)
+
+    def delete_tiles(self, coords, format, layer):
+        coords = list(coords)
+        if not coords:
+            return self.store.delete_tiles(coords, format, layer)
+        return self._instrument(
+            'delete_tiles', self.store.delete_tiles, (coords, format, layer),
+            None, format, layer, zoom=_zoom_key(coords))
+
+    def list_tiles(self, format, layer):
+        return self.store.list_tiles(format, layer)
 
 
 def make_s3_store(bucket_name,
@@ -370,37 +1449,128 @@ def tiles_are_equal(tile_data_1, tile_data_2, fmt):
     metadata such as timestamps and doesn't control file ordering.
     """
 
-    if fmt and fmt == zip_format:
+    if _is_metatile_format(fmt):
         return metatiles_are_equal(tile_data_1, tile_data_2)
 
     else:
         return tile_data_1 == tile_data_2
 
 
+def flush_store(store):
+    """
+    Flush any writes the store is holding on to, for stores which can.
+    """
+
+    store_flush = getattr(store, 'flush', None)
+    if store_flush is not None:
+        store_flush()
+
+
 def write_tile_if_changed(store, tile_data, coord, format, layer):
     """
     Only write tile data if different from existing.
 
-    Try to read the tile data from the store first. If the existing
-    data matches, don't write. Returns whether the tile was written.
+    If the store has a tile_digest method, compare the digest of the existing
+    tile with that of the new one. Otherwise, try to read the tile data from
+    the store first. If the existing data matches, don't write. Returns
+    whether the tile was written.
     """
 
-    existing_data = store.read_tile(coord, format, layer)
-    if not existing_data or \
-       not tiles_are_equal(existing_data, tile_data, format):
-        store.write_tile(tile_data, coord, format, layer)
-        return True
+    tile_digest = getattr(store, 'tile_digest', None)
+    if tile_digest is not None:
+        existing_digest = tile_digest(coord, format, layer)
+        if existing_digest is not None and \
+           existing_digest == calc_tile_digest(tile_data, format):
+            return False
+
     else:
-        return False
+        existing_data = store.read_tile(coord, format, layer)
+        if existing_data and \
+           tiles_are_equal(existing_data, tile_data, format):
+            return False
+
+    store.write_tile(tile_data, coord, format, layer)
+    return True
+
+
+def _store_identity(yml):
+    # the settings which decide where a store's tiles are.
+    identity = dict((k, yml.get(k)) for k in (
+        'type', 'name', 'path', 'date-prefix'))
+    if yml.get('tiers'):
+        identity['tiers'] = [_store_identity(tier) for tier in yml['tiers']]
+    return identity
 
 
-def make_store(yml, credentials={}, logger=None):
+def _store_namespace(yml):
+    """
+    Return a prefix for hash index keys which identifies the store
+    configured by yml.
+    """
+
+    identity = json.dumps(_store_identity(yml), sort_keys=True)
+    return md5.new(identity).hexdigest()[:16] + ':'
+
+
+def make_store(yml, credentials={}, logger=None, tier_stats_handler=None):
+    store = _make_store_of_type(yml, credentials, logger, tier_stats_handler)
+
+    hash_index_cfg = yml.get('hash-index')
+    if hash_index_cfg and hash_index_cfg.get('path'):
+        if yml.get('type') == 'tiered' and yml.get('write-policy') == 'back':
+            # the index would record tiles which are only in the first
+            # tier, and if they're lost before being written back, later
+            # renders of the same tile would be skipped.
+            raise ValueError(
+                'A hash index can\'t be used with a tiered store using the '
+                'back write policy')
+        index = TileHashIndex(
+            hash_index_cfg['path'],
+            hash_index_cfg.get('max-entries') or 1000000)
+        store = HashIndexedStore(
+            store, index, _store_namespace(yml), logger)
+
+    return store
+
+
+def _make_store_of_type(yml, credentials, logger, tier_stats_handler=None):
     store_type = yml.get('type')
 
-    if store_type == 'directory':
+    if store_type == 'tiered':
+        tiers_cfg = yml.get('tiers')
+        assert tiers_cfg, 'Tiered store configured, but no tiers given.'
+        tiers = [_make_store_of_type(
+                     tier_cfg, credentials, logger, tier_stats_handler)
+                 for tier_cfg in tiers_cfg]
+        names = ['%d-%s' % (i, tier_cfg.get('type'))
+                 for i, tier_cfg in enumerate(tiers_cfg)]
+        return Tiered(
+            tiers, names,
+            write_policy=yml.get('write-policy') or 'through',
+            write_back_batch_size=yml.get('write-back-batch-size') or 1000,
+            logger=logger,
+            stats_handler=tier_stats_handler)
+
+    elif store_type == 'directory':
+        path = yml.get('path')
+        name = yml.get('name')
+        fsync_batch_size = yml.get('fsync-batch-size')
+        return make_tile_file_store(path or name, fsync_batch_size)
+
+    elif store_type == 'memory':
+        return make_memory_store(yml.get('max-bytes'))
+
+    elif store_type == 'mbtiles':
         path = yml.get('path')
         name = yml.get('name')
-        return make_tile_file_store(path or name)
+        dedupe = yml.get('dedupe')
+        batch_size = yml.get('batch-size')
+        commit_interval = yml.get('commit-interval')
+        return make_mbtiles_store(
+            path or name,
+            dedupe=True if dedupe is None else dedupe,
+            batch_size=batch_size or 1000,
+            commit_interval=5 if commit_interval is None else commit_interval)
 
     elif store_type == 's3':
         bucket = yml.get('name')
@@ -2,16 +2,24 @@ from numbers import Number
 from shapely import geometry
 from shapely.ops import transform
 from shapely.wkb import dumps
+from tilequeue.coords import half_circumference_meters
+from tilequeue.coords import make_rescale
+from tilequeue.coords import map_coords
+from tilequeue.coords import mercator_to_lnglat
 from tilequeue.format import json_format
 from tilequeue.format import topojson_format
 from tilequeue.format import vtm_format
 from tilequeue.tile import bounds_buffer
 from tilequeue.tile import normalize_geometry_type
 import math
+import numpy
 import shapely.errors
 
-
-half_circumference_meters = 20037508.342789244
+try:
+    # only in newer versions of shapely, and needs GEOS >= 3.5
+    from shapely.ops import clip_by_rect as _geos_clip_by_rect
+except ImportError:
+    _geos_clip_by_rect = None
 
 
 def mercator_point_to_lnglat(x, y, z=None):
@@ -26,6 +34,86 @@ def mercator_point_to_lnglat(x, y, z=None):
     return x, y
 
 
+def mercator_bounds_to_lnglat(bounds):
+    # the projection is monotonic in each axis, so the corners of a box are
+    # the corners of the projected box.
+    return (mercator_point_to_lnglat(bounds[0], bounds[1]) +
+            mercator_point_to_lnglat(bounds[2], bounds[3]))
+
+
+class LngLatProjectionCache(object):
+
+    """
+    Cache of shapes projected to lnglat.
+
+    Within a metatile, the same processed shapes are formatted for each of
+    the child tiles, and for both the JSON and TopoJSON formats. This keeps
+    the projected version of each shape so that it only has to be projected
+    once. It should only be kept for as long as the shapes it's been used
+    with, as it's keyed on their identity.
+    """
+
+    def __init__(self):
+        self.projected = {}
+
+    def __call__(self, shape):
+        key = id(shape)
+        entry = self.projected.get(key)
+        if entry is None:
+            projected = map_coords(mercator_to_lnglat, shape)
+            # keep a reference to the original shape, so that its id can't
+            # be re-used by another shape while it's in the cache.
+            entry = shape, projected
+            self.projected[key] = entry
+        return entry[1]
+
+
+class ClipCache(object):
+
+    """
+    Cache of shapes clipped to tile bounds.
+
+    When several formats are made for the same tile, layers and geometry
+    types which are buffered the same way in each format are clipped to the
+    same bounds. This keeps the clipped shapes so that each distinct clip is
+    only done once. Like LngLatProjectionCache, it's keyed on the identity
+    of the shapes and should only be kept for as long as they are.
+    """
+
+    def __init__(self):
+        self.clipped = {}
+
+    def clip(self, shape, clip_bounds, is_clipped):
+        shape_buf_bounds, layer_padded_bounds = clip_bounds
+        key = (id(shape), shape_buf_bounds.bounds, layer_padded_bounds.bounds,
+               is_clipped)
+        entry = self.clipped.get(key)
+        if entry is None:
+            clipped = _clip_shape(
+                shape, shape_buf_bounds, layer_padded_bounds, is_clipped)
+            # keep a reference to the original shape, so that its id can't
+            # be re-used by another shape while it's in the cache.
+            entry = shape, clipped
+            self.clipped[key] = entry
+        return entry[1]
+
+
+def format_transform_kind(format):
+    """
+    Return the kind of geometry transformation done for the format before
+    it's encoded: 'lnglat' for formats which are projected to lnglat,
+    'rescale' for formats which are rescaled to tile coordinates, or None
+    for formats which are encoded in mercator.
+    """
+
+    if format in (json_format, topojson_format):
+        return 'lnglat'
+    elif format == vtm_format:
+        return 'rescale'
+    else:
+        return None
+
+
 def rescale_point(bounds, scale):
     minx, miny, maxx, maxy = bounds
 
@@ -61,19 +149,18 @@ def _noop(shape):
     return shape
 
 
-def calc_buffered_bounds(
-        format, bounds, meters_per_pixel_dim, layer_name, geometry_type,
-        buffer_cfg):
+def calc_buffer_pixels(format, layer_name, geometry_type, buffer_cfg):
     """
-    Calculate the buffered bounds per format per layer based on config.
+    Calculate the number of pixels to buffer the bounds by per format per
+    layer based on config, or None if the bounds aren't buffered.
     """
 
     if not buffer_cfg:
-        return bounds
+        return None
 
     format_buffer_cfg = buffer_cfg.get(format.extension)
     if format_buffer_cfg is None:
-        return bounds
+        return None
 
     geometry_type = normalize_geometry_type(geometry_type)
 
@@ -82,19 +169,265 @@ def calc_buffered_bounds(
         layer_geom_pixels = per_layer_cfg.get(geometry_type)
         if layer_geom_pixels is not None:
             assert isinstance(layer_geom_pixels, Number)
-            result = bounds_buffer(
-                bounds, meters_per_pixel_dim * layer_geom_pixels)
-            return result
+            return layer_geom_pixels
 
     by_geometry_pixels = format_buffer_cfg.get('geometry', {}).get(
         geometry_type)
     if by_geometry_pixels is not None:
         assert isinstance(by_geometry_pixels, Number)
-        result = bounds_buffer(
-            bounds, meters_per_pixel_dim * by_geometry_pixels)
-        return result
+        return by_geometry_pixels
+
+    return None
+
+
+def calc_buffered_bounds(
+        format, bounds, meters_per_pixel_dim, layer_name, geometry_type,
+        buffer_cfg):
+    """
+    Calculate the buffered bounds per format per layer based on config.
+    """
+
+    pixels = calc_buffer_pixels(
+        format, layer_name, geometry_type, buffer_cfg)
+    if pixels is None:
+        return bounds
+
+    return bounds_buffer(bounds, meters_per_pixel_dim * pixels)
+
+
+def _bounds_contains(bounds, shape_bounds):
+    minx, miny, maxx, maxy = bounds
+    s_minx, s_miny, s_maxx, s_maxy = shape_bounds
+    return (minx <= s_minx and s_maxx <= maxx and
+            miny <= s_miny and s_maxy <= maxy)
 
-    return bounds
+
+def _bounds_strictly_contains(bounds, shape_bounds):
+    minx, miny, maxx, maxy = bounds
+    s_minx, s_miny, s_maxx, s_maxy = shape_bounds
+    return (minx < s_minx and s_maxx < maxx and
+            miny < s_miny and s_maxy < maxy)
+
+
+def _bounds_disjoint(bounds, shape_bounds):
+    minx, miny, maxx, maxy = bounds
+    s_minx, s_miny, s_maxx, s_maxy = shape_bounds
+    return s_maxx < minx or s_minx > maxx or s_maxy < miny or s_miny > maxy
+
+
+def _clip_line_coords(coords, bounds):
+    """
+    Clip a line, given as an (N, 2) array, to the bounds using Liang-Barsky
+    on all of its segments at once. Returns a list of arrays, one for each
+    piece of the line left inside the bounds.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    p0 = coords[:-1]
+    p1 = coords[1:]
+    d = p1 - p0
+    n = len(d)
+
+    t0 = numpy.zeros(n)
+    t1 = numpy.ones(n)
+    visible = numpy.ones(n, dtype=bool)
+    edges = (
+        (-d[:, 0], p0[:, 0] - minx),
+        (d[:, 0], maxx - p0[:, 0]),
+        (-d[:, 1], p0[:, 1] - miny),
+        (d[:, 1], maxy - p0[:, 1]),
+    )
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, q in edges:
+            visible &= ~((p == 0) & (q < 0))
+            r = q / p
+            t0 = numpy.where(p < 0, numpy.maximum(t0, r), t0)
+            t1 = numpy.where(p > 0, numpy.minimum(t1, r), t1)
+    visible &= t0 <= t1
+
+    index = numpy.flatnonzero(visible)
+    if not len(index):
+        return []
+
+    lo = numpy.array([minx, miny])
+    hi = numpy.array([maxx, maxy])
+    starts = numpy.where(
+        (t0 == 0)[:, None], p0, numpy.clip(p0 + t0[:, None] * d, lo, hi))
+    ends = numpy.where(
+        (t1 == 1)[:, None], p1, numpy.clip(p0 + t1[:, None] * d, lo, hi))
+
+    # consecutive visible segments join up into the same piece, unless the
+    # line left the bounds in between.
+    joined = ((index[1:] == index[:-1] + 1) &
+              (t1[index[:-1]] == 1) & (t0[index[1:]] == 0))
+    breaks = numpy.flatnonzero(~joined) + 1
+
+    pieces = []
+    for group in numpy.split(index, breaks):
+        piece = numpy.vstack((starts[group[0]][None, :], ends[group]))
+        # a line which only touches the bounds leaves a single point.
+        if len(piece) == 2 and (piece[0] == piece[1]).all():
+            continue
+        pieces.append(piece)
+    return pieces
+
+
+def _clip_ring_half_plane(ring, axis, value, keep_greater):
+    """
+    One Sutherland-Hodgman pass, clipping the ring, an (N, 2) array without
+    the closing point, to one side of an axis aligned line.
+
+    Returns None if the ring crosses the line more than twice, as the
+    result might then have parts which touch along the line, which isn't
+    valid. The same goes for a ring with a vertex on the line, which can
+    touch the line without being counted as crossing it.
+    """
+
+    coord = ring[:, axis]
+    if keep_greater:
+        inside = coord >= value
+    else:
+        inside = coord <= value
+    if inside.all():
+        return ring
+    if (coord == value).any():
+        return None
+
+    nxt = numpy.roll(ring, -1, axis=0)
+    crossing = inside != numpy.roll(inside, -1)
+    if numpy.count_nonzero(crossing) > 2:
+        return None
+
+    points = numpy.empty((len(ring), 2, 2))
+    points[:, 0] = ring
+    # edges which don't cross the line give junk here, but aren't kept.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = (value - coord) / (nxt[:, axis] - coord)
+        points[:, 1] = ring + t[:, None] * (nxt - ring)
+    points[:, 1, axis] = value
+    keep = numpy.column_stack((inside, crossing))
+    return points[keep]
+
+
+def _clip_ring(ring_coords, bounds):
+    """
+    Clip a ring to the bounds. Returns the clipped ring as an array, which
+    may have fewer than 3 points if nothing is left, or None if it couldn't
+    be clipped this way.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    ring = numpy.array(ring_coords, dtype=numpy.float64)[:-1, :2]
+    for axis, value, keep_greater in ((0, minx, True), (0, maxx, False),
+                                      (1, miny, True), (1, maxy, False)):
+        ring = _clip_ring_half_plane(ring, axis, value, keep_greater)
+        if ring is None or len(ring) < 3:
+            return ring
+
+    # remove repeated points, which happen when a vertex is on the bounds.
+    changed = (ring != numpy.roll(ring, 1, axis=0)).any(axis=1)
+    return ring[changed]
+
+
+def _clip_polygon(poly, bounds):
+    """
+    Clip a valid polygon to the bounds, returning None if this can't be
+    done without possibly making an invalid polygon.
+    """
+
+    shell = _clip_ring(poly.exterior.coords, bounds)
+    if shell is None:
+        return None
+    if len(shell) < 3:
+        return geometry.Polygon()
+
+    holes = []
+    for interior in poly.interiors:
+        hole_bounds = interior.bounds
+        # a hole on the bounds would share a segment with the clipped
+        # shell, which runs along them, so it has to be strictly inside.
+        if _bounds_strictly_contains(bounds, hole_bounds):
+            holes.append(interior.coords)
+        elif not _bounds_disjoint(bounds, hole_bounds):
+            # clipped holes would touch the clipped shell.
+            return None
+
+    clipped = geometry.Polygon(shell, holes)
+    if clipped.area == 0:
+        return geometry.Polygon()
+    return clipped
+
+
+def _geos_clip(shape, bounds):
+    if _geos_clip_by_rect is not None:
+        clipped = _geos_clip_by_rect(shape, *bounds)
+        if not shape.type.endswith('Polygon') or clipped.is_valid:
+            return clipped
+    return shape.intersection(geometry.box(*bounds))
+
+
+def clip_to_rect(shape, bounds):
+    """
+    Return the parts of shape within the axis aligned rectangle bounds.
+
+    This is a faster alternative to intersecting with a box, which avoids
+    GEOS' general overlay where possible. Shapes inside or outside the
+    bounds are returned directly, lines are clipped with Liang-Barsky and
+    polygons with Sutherland-Hodgman, falling back to GEOS for polygons
+    which cross the bounds too often to be sure the result is valid.
+
+    Polygons are assumed to be valid, and then so is the result.
+    """
+
+    if shape.is_empty:
+        return shape
+
+    shape_bounds = shape.bounds
+    if _bounds_contains(bounds, shape_bounds):
+        return shape
+    if _bounds_disjoint(bounds, shape_bounds):
+        return geometry.GeometryCollection()
+
+    geom_type = shape.type
+    if geom_type in ('LineString', 'MultiLineString'):
+        if geom_type == 'LineString':
+            lines = [shape]
+        else:
+            lines = shape.geoms
+        pieces = []
+        for line in lines:
+            coords = numpy.array(line.coords, dtype=numpy.float64)[:, :2]
+            pieces.extend(_clip_line_coords(coords, bounds))
+        if not pieces:
+            return geometry.GeometryCollection()
+        elif len(pieces) == 1:
+            return geometry.LineString(pieces[0])
+        return geometry.MultiLineString(pieces)
+
+    elif geom_type == 'Polygon':
+        clipped = _clip_polygon(shape, bounds)
+        if clipped is None:
+            clipped = _geos_clip(shape, bounds)
+        return clipped
+
+    elif geom_type == 'MultiPolygon':
+        polys = []
+        for poly in shape.geoms:
+            clipped = clip_to_rect(poly, bounds)
+            polys.extend(_polygons_of(clipped))
+        return geometry.MultiPolygon(polys)
+
+    return _geos_clip(shape, bounds)
+
+
+def _polygons_of(shape):
+    if shape.type == 'Polygon':
+        if not shape.is_empty:
+            return [shape]
+    elif shape.type in ('MultiPolygon', 'GeometryCollection'):
+        return [p for p in shape.geoms
+                if p.type == 'Polygon' and not p.is_empty]
+    return []
 
 
 def _intersect_multipolygon(shape, tile_bounds, clip_bounds):
@@ -106,40 +439,51 @@ def _intersect_multipolygon(shape, tile_bounds, clip_bounds):
     polygons.
     """
 
+    tile_rect = tile_bounds.bounds
+    clip_rect = clip_bounds.bounds
     polys = []
     for poly in shape.geoms:
-        if tile_bounds.intersects(poly):
-            if not clip_bounds.contains(poly):
-                poly = clip_bounds.intersection(poly)
+        if poly.is_empty:
+            continue
+        poly_bounds = poly.bounds
+        if _bounds_disjoint(tile_rect, poly_bounds):
+            continue
+        if not _bounds_contains(tile_rect, poly_bounds) and \
+                not tile_bounds.intersects(poly):
+            continue
+
+        if _bounds_contains(clip_rect, poly_bounds):
+            polys.append(poly)
+            continue
+
+        clipped = _clip_polygon(poly, clip_rect)
+        if clipped is None:
+            clipped = _geos_clip(poly, clip_rect)
 
             # the intersection operation can make the resulting polygon
             # invalid. including it in a MultiPolygon would make that
             # invalid too. instead, we skip it, and hope it wasn't too
             # important.
-            if not poly.is_valid:
+            if not clipped.is_valid:
                 continue
 
-            if poly.type == 'Polygon':
-                polys.append(poly)
-            elif poly.type == 'MultiPolygon':
-                polys.extend(poly.geoms)
+        polys.extend(_polygons_of(clipped))
 
     return geometry.MultiPolygon(polys)
 
 
-def _clip_shape(shape, buffer_padded_bounds, is_clipped, clip_factor):
+def _clip_shape(shape, shape_buf_bounds, layer_padded_bounds, is_clipped):
     """
-    Return the shape clipped to a clip_factor expansion of buffer_padded_bounds
-    if is_clipped is True. Otherwise return the original shape, or None if the
-    shape does not intersect buffer_padded_bounds at all.
+    Return the shape clipped to layer_padded_bounds, the clip_factor
+    expansion of the buffered bounds, if is_clipped is True. Otherwise return
+    the original shape, or None if the shape does not intersect
+    shape_buf_bounds, the buffered bounds, at all.
 
     This is used to reduce the size of the geometries which are encoded in the
     tiles by removing things which aren't in the tile, and clipping those which
     are to the clip_factor expanded bounding box.
     """
 
-    shape_buf_bounds = geometry.box(*buffer_padded_bounds)
-
     if not shape_buf_bounds.intersects(shape):
         return None
 
@@ -147,15 +491,12 @@ def _clip_shape(shape, buffer_padded_bounds, is_clipped, clip_factor):
         # now we know that we should include the geometry, but
         # if the geometry should be clipped, we'll clip to the
         # layer-specific padded bounds
-        layer_padded_bounds = calculate_padded_bounds(
-            clip_factor, buffer_padded_bounds)
-
         if shape.type == 'MultiPolygon':
             shape = _intersect_multipolygon(
                 shape, shape_buf_bounds, layer_padded_bounds)
         else:
             try:
-                shape = shape.intersection(layer_padded_bounds)
+                shape = clip_to_rect(shape, layer_padded_bounds.bounds)
             except shapely.errors.TopologicalError:
                 return None
 
@@ -164,12 +505,38 @@ def _clip_shape(shape, buffer_padded_bounds, is_clipped, clip_factor):
 
 def transform_feature_layers_shape(
         feature_layers, format, scale, unpadded_bounds,
-        meters_per_pixel_dim, buffer_cfg):
-    if format in (json_format, topojson_format):
-        transform_fn = apply_to_all_coords(mercator_point_to_lnglat)
-    elif format == vtm_format:
-        transform_fn = apply_to_all_coords(
-            rescale_point(unpadded_bounds, scale))
+        meters_per_pixel_dim, buffer_cfg, buffer_pixels_fn=None,
+        projection_cache=None, clip_cache=None):
+    # buffer_pixels_fn, if given, is used in place of calc_buffer_pixels to
+    # look up the buffer for each layer and geometry type. it's called
+    # with the format, layer name and geometry type.
+    if buffer_pixels_fn is None:
+        def buffer_pixels_fn(format, layer_name, geometry_type):
+            return calc_buffer_pixels(
+                format, layer_name, geometry_type, buffer_cfg)
+
+    if clip_cache is None:
+        def clip_fn(shape, clip_bounds, is_clipped):
+            shape_buf_bounds, layer_padded_bounds = clip_bounds
+            return _clip_shape(
+                shape, shape_buf_bounds, layer_padded_bounds, is_clipped)
+    else:
+        clip_fn = clip_cache.clip
+
+    # formats in lnglat are clipped after projecting, so that the projected
+    # shapes can be shared between tiles and formats via the cache.
+    project_fn = None
+    transform_kind = format_transform_kind(format)
+    if transform_kind == 'lnglat':
+        if projection_cache is None:
+            projection_cache = LngLatProjectionCache()
+        project_fn = projection_cache
+        transform_fn = _noop
+    elif transform_kind == 'rescale':
+        rescale = make_rescale(unpadded_bounds, scale)
+
+        def transform_fn(shape):
+            return map_coords(rescale, shape)
     else:
         # mvt and unknown formats get no geometry transformation
         transform_fn = _noop
@@ -183,18 +550,37 @@ def transform_feature_layers_shape(
         layer_datum = feature_layer['layer_datum']
         is_clipped = layer_datum['is_clipped']
         clip_factor = layer_datum.get('clip_factor', 1.0)
+        # the bounds only depend on the geometry type within a layer
+        clip_bounds_by_type = {}
 
         for shape, props, feature_id in feature_layer['features']:
 
             if shape.is_empty or shape.type == 'GeometryCollection':
                 continue
 
-            buffer_padded_bounds = calc_buffered_bounds(
-                format, unpadded_bounds, meters_per_pixel_dim, layer_name,
-                shape.type, buffer_cfg)
-
-            shape = _clip_shape(
-                shape, buffer_padded_bounds, is_clipped, clip_factor)
+            clip_bounds = clip_bounds_by_type.get(shape.type)
+            if clip_bounds is None:
+                pixels = buffer_pixels_fn(format, layer_name, shape.type)
+                if pixels is None:
+                    buffer_padded_bounds = unpadded_bounds
+                else:
+                    buffer_padded_bounds = bounds_buffer(
+                        unpadded_bounds, meters_per_pixel_dim * pixels)
+                layer_padded_bounds = calculate_padded_bounds(
+                    clip_factor, buffer_padded_bounds).bounds
+                if project_fn is not None:
+                    buffer_padded_bounds = mercator_bounds_to_lnglat(
+                        buffer_padded_bounds)
+                    layer_padded_bounds = mercator_bounds_to_lnglat(
+                        layer_padded_bounds)
+                clip_bounds = (geometry.box(*buffer_padded_bounds),
+                               geometry.box(*layer_padded_bounds))
+                clip_bounds_by_type[shape.type] = clip_bounds
+
+            if project_fn is not None:
+                shape = project_fn(shape)
+
+            shape = clip_fn(shape, clip_bounds, is_clipped)
             if shape is None or shape.is_empty:
                 continue
 
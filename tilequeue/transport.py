@@ -0,0 +1,124 @@
+# transports for handing fetched source rows from the data fetch threads to
+# the processing processes.
+#
+# the default is to pass the rows inline through the multiprocessing queue,
+# which pickles the whole payload into the queue's pipe and unpickles it again
+# on the other side. for large tiles (metatiles at z10, for example) that means
+# the WKB blobs are copied several times and held twice in memory while in
+# flight.
+#
+# the mmap transport instead writes the rows into a file-backed arena,
+# ideally on a memory filesystem such as /dev/shm, and only passes a small
+# descriptor over the queue. the processor maps the arena, reads the rows
+# straight out of the mapping and frees the arena once it has them.
+
+from collections import namedtuple
+import cPickle
+import mmap
+import os
+import tempfile
+
+
+# descriptor sent over the queue in place of the source rows when they have
+# been written to an arena.
+ArenaDescriptor = namedtuple('ArenaDescriptor', 'path size')
+
+
+class QueueTransport(object):
+
+    """Pass source rows inline through the queue"""
+
+    name = 'queue'
+
+    def put(self, source_rows):
+        # the size isn't known without pickling, which the queue will do
+        # later anyway, so it isn't reported.
+        return source_rows, None
+
+    def take(self, payload):
+        return payload
+
+    def release(self, payload):
+        pass
+
+
+class MmapTransport(object):
+
+    """Pass source rows through a memory mapped arena file
+
+    Each payload gets its own arena file in arena_path, which is removed as
+    soon as the receiving side has read it (or released it without reading,
+    for example when discarding queued work at shutdown).
+    """
+
+    name = 'mmap'
+
+    def __init__(self, arena_path):
+        self.arena_path = arena_path
+
+    def put(self, source_rows):
+        fd, path = tempfile.mkstemp(
+            prefix='tilequeue-', suffix='.rows', dir=self.arena_path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                cPickle.dump(source_rows, fp, cPickle.HIGHEST_PROTOCOL)
+                size = fp.tell()
+        except Exception:
+            _remove_arena(path)
+            raise
+        return ArenaDescriptor(path, size), size
+
+    def take(self, payload):
+        try:
+            with open(payload.path, 'rb') as fp:
+                mapped = mmap.mmap(
+                    fp.fileno(), payload.size, access=mmap.ACCESS_READ)
+                try:
+                    # unpickle directly from the mapping, rather than reading
+                    # the whole arena into a string first.
+                    source_rows = cPickle.load(mapped)
+                finally:
+                    mapped.close()
+        finally:
+            _remove_arena(payload.path)
+        return source_rows
+
+    def release(self, payload):
+        if isinstance(payload, ArenaDescriptor):
+            _remove_arena(payload.path)
+
+
+def _remove_arena(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _default_arena_path():
+    # prefer a memory backed filesystem when there's one available, so that
+    # the arenas never have to touch the disk.
+    shm_path = '/dev/shm'
+    if os.path.isdir(shm_path) and os.access(shm_path, os.W_OK):
+        return shm_path
+    return tempfile.gettempdir()
+
+
+def make_source_rows_transport(transport_yaml):
+    if not transport_yaml:
+        return QueueTransport()
+
+    transport_type = transport_yaml.get('type') or 'queue'
+    if transport_type == 'queue':
+        return QueueTransport()
+
+    elif transport_type == 'mmap':
+        arena_path = transport_yaml.get('path') or _default_arena_path()
+        assert os.path.isdir(arena_path), \
+            'Invalid source rows transport arena path: %s' % arena_path
+        return MmapTransport(arena_path)
+
+    else:
+        raise ValueError(
+            'Unrecognized source rows transport type: `{}`'.format(
+                transport_type))
@@ -8,12 +8,15 @@ from tilequeue.metatile import common_parent
 from tilequeue.metatile import make_metatiles
 from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
+from tilequeue.process import ProcessingPlan
 from tilequeue.queue import JobProgressException
 from tilequeue.queue.message import QueueHandle
+from tilequeue.store import flush_store
 from tilequeue.store import write_tile_if_changed
 from tilequeue.tile import coord_children_subrange
 from tilequeue.tile import coord_to_mercator_bounds
 from tilequeue.tile import serialize_coord
+from tilequeue.transport import QueueTransport
 from tilequeue.utils import convert_seconds_to_millis
 from tilequeue.utils import format_stacktrace_one_line
 import Queue
@@ -39,12 +42,18 @@ def _non_blocking_put(q, data):
         return True
 
 
-def _force_empty_queue(q):
+def _force_empty_queue(q, discard_fn=None):
     # expects a sentinel None value to get enqueued
     # throws out all messages until we receive the sentinel
     # with no sentinel this will block indefinitely
-    while q.get() is not None:
-        continue
+    # the optional discard_fn is called with each message thrown out, so
+    # that any resources it holds can be freed.
+    while True:
+        data = q.get()
+        if data is None:
+            break
+        if discard_fn is not None:
+            discard_fn(data)
 
 
 # OutputQueue wraps the process of sending data to a multiprocessing queue
@@ -308,7 +317,7 @@ class DataFetch(object):
     def __init__(
             self, fetcher, input_queue, output_queue, io_pool,
             tile_proc_logger, stats_handler, metatile_zoom, max_zoom,
-            metatile_start_zoom=0):
+            metatile_start_zoom=0, source_rows_transport=None):
         self.fetcher = fetcher
         self.input_queue = input_queue
         self.output_queue = output_queue
@@ -318,6 +327,9 @@ class DataFetch(object):
         self.metatile_zoom = metatile_zoom
         self.max_zoom = max_zoom
         self.metatile_start_zoom = metatile_start_zoom
+        if source_rows_transport is None:
+            source_rows_transport = QueueTransport()
+        self.source_rows_transport = source_rows_transport
 
     def __call__(self, stop):
         saw_sentinel = False
@@ -354,7 +366,17 @@ class DataFetch(object):
 
     def _fetch_and_output(self, fetch, coord, metadata, output):
         data = self._fetch(fetch, coord, metadata)
-        return output(coord, data)
+        sent = False
+        try:
+            should_stop = output(coord, data)
+            # output only returns True when it gave up on sending
+            sent = not should_stop
+            return should_stop
+        finally:
+            if not sent:
+                # the processors will never see this payload, so make sure
+                # that it doesn't leak.
+                self.source_rows_transport.release(data['source_rows'])
 
     def _fetch(self, fetch, coord, metadata):
         nominal_zoom = coord.zoom + self.metatile_zoom
@@ -368,6 +390,14 @@ class DataFetch(object):
         metadata['timing']['fetch'] = convert_seconds_to_millis(
             time.time() - start)
 
+        source_rows, transport_bytes = self.source_rows_transport.put(
+            source_rows)
+        if transport_bytes is not None:
+            metadata['transport'] = dict(
+                type=self.source_rows_transport.name,
+                bytes=transport_bytes,
+            )
+
         # every tile job that we get from the queue is a "parent" tile
         # and its four children to cut from it. at zoom 15, this may
         # also include a whole bunch of other children below the max
@@ -391,7 +421,8 @@ class ProcessAndFormatData(object):
 
     def __init__(self, post_process_data, formats, input_queue,
                  output_queue, buffer_cfg, output_calc_mapping, layer_data,
-                 tile_proc_logger, stats_handler):
+                 tile_proc_logger, stats_handler, source_rows_transport=None,
+                 cut_strategy='flat', simplify_geometry=False):
         formats.sort(key=attrgetter('sort_key'))
         self.post_process_data = post_process_data
         self.formats = formats
@@ -402,6 +433,14 @@ class ProcessAndFormatData(object):
         self.layer_data = layer_data
         self.tile_proc_logger = tile_proc_logger
         self.stats_handler = stats_handler
+        if source_rows_transport is None:
+            source_rows_transport = QueueTransport()
+        self.source_rows_transport = source_rows_transport
+        # resolve everything which only depends on configuration once, up
+        # front, rather than for every tile.
+        self.plan = ProcessingPlan(
+            layer_data, post_process_data, buffer_cfg, output_calc_mapping,
+            cut_strategy, simplify_geometry)
 
     def __call__(self, stop):
         # ignore ctrl-c interrupts when run from terminal
@@ -423,18 +462,20 @@ class ProcessAndFormatData(object):
             unpadded_bounds = data['unpadded_bounds']
             cut_coords = data['cut_coords']
             nominal_zoom = data['nominal_zoom']
-            source_rows = data['source_rows']
 
             start = time.time()
 
             try:
+                source_rows = self.source_rows_transport.take(
+                    data['source_rows'])
                 feature_layers = convert_source_data_to_feature_layers(
                     source_rows, self.layer_data, unpadded_bounds,
                     nominal_zoom)
                 formatted_tiles, extra_data = process_coord(
                     coord, nominal_zoom, feature_layers,
                     self.post_process_data, self.formats, unpadded_bounds,
-                    cut_coords, self.buffer_cfg, self.output_calc_mapping)
+                    cut_coords, self.buffer_cfg, self.output_calc_mapping,
+                    plan=self.plan)
             except Exception as e:
                 stacktrace = format_stacktrace_one_line()
                 self.tile_proc_logger.error(
@@ -457,20 +498,26 @@ class ProcessAndFormatData(object):
                 break
 
         if not saw_sentinel:
-            _force_empty_queue(self.input_queue)
+            _force_empty_queue(self.input_queue, self._discard)
         self.tile_proc_logger.lifecycle('processor stopped')
 
+    def _discard(self, data):
+        self.source_rows_transport.release(data['source_rows'])
+
 
 class S3Storage(object):
 
     def __init__(self, input_queue, output_queue, io_pool, store,
-                 tile_proc_logger, metatile_size):
+                 tile_proc_logger, metatile_size, metatile_container='zip',
+                 metatile_compress=False):
         self.input_queue = input_queue
         self.output_queue = output_queue
         self.io_pool = io_pool
         self.store = store
         self.tile_proc_logger = tile_proc_logger
         self.metatile_size = metatile_size
+        self.metatile_container = metatile_container
+        self.metatile_compress = metatile_compress
 
     def __call__(self, stop):
         saw_sentinel = False
@@ -490,6 +537,7 @@ class S3Storage(object):
             coord = data['coord']
 
             start = time.time()
+            index_counts = self._index_counts()
             try:
                 async_jobs = self.save_tiles(data['formatted_tiles'])
 
@@ -531,6 +579,12 @@ class S3Storage(object):
                 stored=n_stored,
                 not_stored=n_not_stored,
             )
+            if index_counts is not None:
+                # only this coordinate's tiles are being written, so the
+                # change in the counts is down to them.
+                for name, count in self._index_counts().items():
+                    metadata['store']['index_' + name] = \
+                        count - index_counts[name]
 
             data = dict(
                 coord=coord,
@@ -542,13 +596,30 @@ class S3Storage(object):
 
         if not saw_sentinel:
             _force_empty_queue(self.input_queue)
+
+        try:
+            flush_store(self.store)
+        except Exception as e:
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.error('Store flush error', e, stacktrace)
+
         self.tile_proc_logger.lifecycle('s3 storage stopped')
 
+    def _index_counts(self):
+        # hit and miss counts of the store's hash index, if it has one.
+        index_counts = getattr(self.store, 'index_counts', None)
+        if index_counts is None:
+            return None
+        return dict(index_counts)
+
     def save_tiles(self, tiles):
         async_jobs = []
 
         if self.metatile_size:
-            tiles = make_metatiles(self.metatile_size, tiles)
+            tiles = make_metatiles(
+                self.metatile_size, tiles,
+                container=self.metatile_container,
+                compress=self.metatile_compress)
 
         for tile in tiles:
 
@@ -570,7 +641,8 @@ class S3Storage(object):
 
 CoordProcessData = namedtuple(
     'CoordProcessData',
-    ('coord', 'timing', 'size', 'store_info',),
+    ('coord', 'timing', 'size', 'store_info', 'transport_info',
+     'reduction',),
 )
 
 
@@ -633,12 +705,16 @@ class TileQueueWriter(object):
             size = layers['size']
 
             store_info = metadata['store']
+            transport_info = metadata.get('transport')
+            reduction = layers.get('reduction')
 
             coord_proc_data = CoordProcessData(
                 coord,
                 timing,
                 size,
                 store_info,
+                transport_info,
+                reduction,
             )
             self.tile_proc_logger.log_processed_coord(coord_proc_data)
             self.stats_handler.processed_coord(coord_proc_data)